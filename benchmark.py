@@ -0,0 +1,292 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks of the bot's hot paths, run against fake_minqlbot.
+
+Every benchmark is timed as the best of a few runs, in microseconds per operation, and
+compared to the baseline in benchmark_baseline.json if there is one. Since the baseline
+was likely taken on another machine, or the same one under a different load, ratios are
+compared to the median ratio of the benchmarks that ran, and only benchmarks that are
+still slower when run again count as regressions.
+
+The correctness checks of the parser are in tests/.
+
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from fake_minqlbot import FakeQuake, CS_PLAYERS, player_configstring
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, "benchmark_baseline.json")
+# How much slower than the others a benchmark can get before it's a regression.
+TOLERANCE = 1.5
+
+benchmarks = []
+
+def benchmark(number):
+    """Register a benchmark. The decorated function gets the FakeQuake and the bot's
+    namespace, and returns the function to time, which is called 'number' times per run.
+
+    """
+    def wrap(setup):
+        benchmarks.append((setup.__name__, number, setup))
+        return setup
+    return wrap
+
+def start(players=16):
+    fake = FakeQuake()
+    bot = fake.load(FloodRate="0", FloodCommandRate="0")
+    teams = ("red", "blue")
+    fake.connect(dict((cid, ("player{}".format(cid), teams[cid % 2])) for cid in range(players)))
+    return fake, bot
+
+def bench_plugin(bot, hooks=(), commands=()):
+    class Bench(bot["minqlbot"].Plugin):
+        def __init__(self):
+            super().__init__()
+            for event in hooks:
+                self.add_hook(event, self.handle)
+            for name in commands:
+                self.add_command(name, self.cmd)
+
+        def handle(self, *args):
+            pass
+
+        def cmd(self, player, msg, channel):
+            channel.reply("pong")
+
+    return Bench()
+
+# ====================================================================
+#                              PARSER
+# ====================================================================
+
+@benchmark(20000)
+def parse_print(fake, bot):
+    return lambda: bot["handle_message"]('print "player3 ^7has entered the arena\\n"')
+
+@benchmark(5000)
+def parse_player_configstring(fake, bot):
+    cs = player_configstring("player5", "blue")
+    return lambda: bot["handle_message"]('cs {} "{}"'.format(CS_PLAYERS + 5, cs))
+
+@benchmark(5000)
+def parse_chat(fake, bot):
+    return lambda: bot["handle_message"]('chat "03 player3^7\x19: ^2gg wp"')
+
+@benchmark(1000)
+def parse_scores_ca(fake, bot):
+    scores = " ".join("{} 1 0 10 50 100 5 2 40 7 50 1200 0 0 0 0 1".format(cid) for cid in range(16))
+    return lambda: bot["handle_message"]("scores_ca 16 3 1 " + scores)
+
+@benchmark(5000)
+def parse_chat_line(fake, bot):
+    return lambda: bot["parse_chat"]("chat", '"03 clan player3^7\x19: ^2gg wp"')
+
+# A tchat line that never closes. It takes the old patterns quadratic time to give up on it.
+WORST_CASE_CHAT = '"01 \x19(' + "a\x19) (" * 2000 + '"'
+
+@benchmark(200)
+def parse_chat_worst_case(fake, bot):
+    return lambda: bot["parse_chat"]("tchat", WORST_CASE_CHAT)
+
+# ====================================================================
+#                           CONFIGSTRINGS
+# ====================================================================
+
+# As sent by a CA server in the gamestate.
+SAMPLE_SERVERINFO = ("\\sv_hostname\\#1 Clan Arena EU\\sv_location\\Frankfurt\\sv_maxclients\\16"
+    "\\sv_premium\\0\\sv_skillRating\\0\\sv_ranked\\1\\sv_gtid\\2119\\sv_adXmitDelay\\300000"
+    "\\sv_advertising\\1\\sv_allowDownload\\0\\sv_fps\\40\\sv_minRate\\0\\sv_maxRate\\0"
+    "\\sv_privateClients\\0\\sv_punkbuster\\0\\sv_floodProtect\\1\\dmflags\\28\\fraglimit\\50"
+    "\\timelimit\\0\\capturelimit\\8\\g_customSettings\\0\\g_gametype\\4\\g_gameState\\IN_PROGRESS"
+    "\\g_instaGib\\0\\g_loadout\\0\\g_freezeRoundDelay\\4000\\g_levelStartTime\\1429812397"
+    "\\g_maxGameClients\\0\\g_needpass\\0\\g_overtime\\0\\g_quadDamageFactor\\3\\g_teamSizeMin\\1"
+    "\\g_voteFlags\\0\\mapname\\campgrounds\\mercylimit\\0\\protocol\\91\\roundlimit\\10"
+    "\\roundtimelimit\\180\\ruleset\\1\\scorelimit\\150\\teamsize\\4\\version\\QuakeLive  1.0.0 win-x86"
+    "\\gamename\\baseqz\\g_adCaptureScoreBonus\\3\\g_adElimScoreBonus\\2\\g_adTouchScoreBonus\\1")
+SAMPLE_PLAYER = "n\\player5\\t\\2\\model\\sarge\\hmodel\\sarge\\c1\\4\\c2\\5\\hc\\100\\w\\0\\l\\0" \
+    "\\tt\\0\\tl\\0\\rp\\0\\p\\0\\so\\0\\pq\\0\\wp\\mg\\ws\\sg\\cn\\\\su\\0\\xcn\\\\c\\"
+
+@benchmark(20000)
+def parse_variables_serverinfo(fake, bot):
+    return lambda: bot["parse_variables"](SAMPLE_SERVERINFO)
+
+@benchmark(20000)
+def parse_variables_player(fake, bot):
+    return lambda: bot["parse_variables"](SAMPLE_PLAYER)
+
+@benchmark(20000)
+def make_variables_serverinfo(fake, bot):
+    cvars = bot["parse_variables"](SAMPLE_SERVERINFO, ordered=True)
+    return lambda: bot["make_variables"](cvars)
+
+@benchmark(20000)
+def set_variable_serverinfo(fake, bot):
+    return lambda: bot["set_variable"](SAMPLE_SERVERINFO, "g_gameState", "COUNT_DOWN")
+
+# ====================================================================
+#                              EVENTS
+# ====================================================================
+
+@benchmark(20000)
+def dispatch_10_hooks(fake, bot):
+    for i in range(10):
+        bench_plugin(bot, hooks=("round_start",))
+    event = bot["event_handlers"]["round_start"]
+    return lambda: event.trigger(1)
+
+# ====================================================================
+#                             COMMANDS
+# ====================================================================
+
+@benchmark(2000)
+def chat_command(fake, bot):
+    bench_plugin(bot, commands=("ping",))
+    return lambda: bot["handle_message"]('chat "03 player3^7\x19: ^2!ping"')
+
+@benchmark(20000)
+def unknown_chat_command(fake, bot):
+    return lambda: bot["commands"].handle_input(bot["minqlbot"].Player(3), "!nope", bot["minqlbot"].CHAT_CHANNEL)
+
+# ====================================================================
+#                              PLAYERS
+# ====================================================================
+
+@benchmark(2000)
+def players(fake, bot):
+    return bot["minqlbot"].Plugin.players
+
+@benchmark(2000)
+def find_player(fake, bot):
+    return lambda: bot["minqlbot"].Plugin.find_player("player1")
+
+@benchmark(5000)
+def get_player(fake, bot):
+    return lambda: bot["get_player"]("player15")
+
+# ====================================================================
+#                             DATABASE
+# ====================================================================
+
+@benchmark(2000)
+def permission_uncached(fake, bot):
+    core = bot["core_plugin"]
+    core.db_query("CREATE TABLE IF NOT EXISTS Players (name TEXT PRIMARY KEY, permission INTEGER)")
+    core.db_query("INSERT OR REPLACE INTO Players VALUES ('player3', 3)")
+    player = bot["minqlbot"].Player(3)
+    cache = bot["minqlbot"].PERMISSION_CACHE
+    def run():
+        cache.invalidate()
+        core.get_permission(player)
+    return run
+
+@benchmark(20000)
+def permission_cached(fake, bot):
+    core = bot["core_plugin"]
+    core.db_query("CREATE TABLE IF NOT EXISTS Players (name TEXT PRIMARY KEY, permission INTEGER)")
+    player = bot["minqlbot"].Player(3)
+    return lambda: core.get_permission(player)
+
+@benchmark(200)
+def write_behind_100_rows(fake, bot):
+    core = bot["core_plugin"]
+    core.db_query("CREATE TABLE IF NOT EXISTS Bench (n INTEGER)")
+    def run():
+        for i in range(100):
+            core.db_write_async("INSERT INTO Bench VALUES (?)", i)
+        core.db_flush()
+    return run
+
+# ====================================================================
+#                               MAIN
+# ====================================================================
+
+def run(name, number, setup, repeat):
+    fake, bot = start()
+    try:
+        func = setup(fake, bot)
+        func() # Warm up lazily compiled patterns, caches and such.
+        best = None
+        for i in range(repeat):
+            begin = time.perf_counter()
+            for j in range(number):
+                func()
+            elapsed = time.perf_counter() - begin
+            best = elapsed if best is None else min(best, elapsed)
+        return best / number * 1000000
+    finally:
+        fake.unload()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("names", nargs="*", help="Only run benchmarks with these names.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per benchmark. The best one counts.")
+    parser.add_argument("--save", action="store_true", help="Store the results as the new baseline.")
+    parser.add_argument("--check", action="store_true", help="Exit with 1 if there are regressions.")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+        help="A benchmark is a regression if its ratio to the baseline is more than this many "
+        "times the median ratio. Default: %(default)s")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.isfile(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+    results = {}
+    print("{:<28} {:>12} {:>12} {:>8}".format("benchmark", "us/op", "baseline", "ratio"))
+    for name, number, setup in benchmarks:
+        if args.names and name not in args.names:
+            continue
+        us = results[name] = run(name, number, setup, args.repeat)
+        base = baseline.get(name)
+        print("{:<28} {:>12.2f} {:>12} {:>8}".format(name, us, "{:.2f}".format(base) if base else "-",
+            "{:.2f}".format(us / base) if base else "-"))
+
+    # With too few benchmarks to go by, the median would just be the one we're checking.
+    ratios = sorted(results[name] / baseline[name] for name in results if baseline.get(name))
+    median = ratios[len(ratios) // 2] if len(ratios) >= 3 else 1
+    regressions = []
+    for name, number, setup in benchmarks:
+        if name not in results or not baseline.get(name) or results[name] / baseline[name] <= median * args.tolerance:
+            continue
+        # Give it another go before blaming it on the code.
+        results[name] = min(results[name], run(name, number, setup, args.repeat * 2))
+        if results[name] / baseline[name] > median * args.tolerance:
+            regressions.append(name)
+
+    if args.save:
+        baseline.update((name, round(us, 2)) for name, us in results.items())
+        with open(BASELINE, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("Saved the baseline to {}.".format(BASELINE))
+
+    if regressions:
+        print("Slower than the baseline by more than {}x the median ratio of {:.2f}: {}".format(
+            args.tolerance, median, ", ".join(regressions)))
+        if args.check:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""A pure-Python stand-in for the native minqlbot module, so that plugin.py and
+minqlbot.py can run outside of Quake Live for development, profiling and benchmarks.
+
+It mimics the DLL as closely as it reasonably can: a table of 1024 configstrings,
+an outgoing queue that lets a command through every 600 ms, a cvar table and the
+connection status going through the same states as the client's. Time is virtual
+and only moves forward with advance(), so that runs are reproducible.
+
+Example:
+    fake = FakeQuake()
+    bot = fake.load(nickname="bot", plugins_folder="python/plugins", plugins="balance")
+    fake.connect({0: ("bot", "spectator"), 1: ("mino", "red")})
+    fake.server_command("chat \"01 mino^7\\x19: ^2!elo\"")
+    fake.advance(1)
+    print(fake.sent)
+
+"""
+
+import os
+import sys
+import types
+import shutil
+import tempfile
+import collections
+import configparser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+MAX_CONFIGSTRINGS = 1024
+CS_SERVERINFO = 0
+CS_PLAYERS = 529
+DELAY_SEND_COMMAND = 0.6 # Same as DELAY_SEND_COMMAND in quake.h, but in seconds.
+
+# Connection states in the same order as the client's.
+CA_UNINITIALIZED, CA_DISCONNECTED, CA_AUTHORIZING, CA_CONNECTING, CA_CHALLENGING, \
+    CA_CONNECTED, CA_LOADING, CA_PRIMED, CA_ACTIVE = range(9)
+
+DEFAULT_SERVERINFO = {
+    "sv_hostname": "fake server", "sv_location": "nowhere", "sv_maxclients": "16",
+    "sv_premium": "0", "sv_skillrating": "0", "g_gametype": "4", "g_gameState": "PRE_GAME",
+    "g_instaGib": "0", "mapname": "campgrounds", "ruleset": "3", "teamsize": "4",
+    "timelimit": "0", "fraglimit": "0", "roundlimit": "10", "roundtimelimit": "180",
+    "capturelimit": "8", "scorelimit": "150"}
+
+def make_variables(variables):
+    """The opposite of minqlbot.py's parse_variables()."""
+    return "".join("\\{}\\{}".format(k, v) for k, v in variables.items())
+
+def player_configstring(name, team="spectator", clan="", full_clan=""):
+    team = ("free", "red", "blue", "spectator").index(team) if isinstance(team, str) else team
+    return make_variables(collections.OrderedDict((("n", name), ("t", team), ("model", "sarge"),
+        ("c1", "4"), ("c2", "5"), ("cn", clan), ("xcn", full_clan), ("c", ""))))
+
+class FakeQuake:
+    """The fake client. Its module attribute is what gets installed as "minqlbot"."""
+    def __init__(self, is_debug=False, version="fake"):
+        self.configstrings = [None] * MAX_CONFIGSTRINGS
+        self.cvars = {}
+        self.status = CA_DISCONNECTED
+        self.now = 0.0
+        self.queue = collections.deque()
+        self.sent = [] # (time, command) in the order the "server" got them.
+        self.console = []
+        self.debug_lines = []
+        self.executed = []
+        self.reinitialized = 0
+        self.namespace = None
+        self.__last_send = None
+        self.__tempdir = None
+        self.config_file = None
+        self.__bcs = {}
+        self.module = self.__make_module(is_debug, version)
+
+    def __make_module(self, is_debug, version):
+        module = types.ModuleType("minqlbot")
+        module.debug = self.debug
+        module.debug_ex = self.debug_ex
+        module.send_command = self.send_command
+        module.console_print = self.console_print
+        module._configstring = self._configstring
+        module._configstring_range = self._configstring_range
+        module.version = lambda: version
+        module.reinitialize = self.reinitialize
+        module.connection_status = self.connection_status
+        module.get_cvar = self.get_cvar
+        module.console_command = self.console_command
+        module.IS_DEBUG = is_debug
+        return module
+
+    # ====================================================================
+    #                     THE NATIVE MODULE'S FUNCTIONS
+    # ====================================================================
+
+    def debug(self, msg):
+        self.debug_lines.append(msg)
+
+    def debug_ex(self, msg, newline=True):
+        self.debug_lines.append(msg)
+
+    def send_command(self, cmd):
+        # Like HAddReliableCommand, disconnecting skips the queue.
+        if cmd == "disconnect":
+            self.sent.append((self.now, cmd))
+        else:
+            self.queue.append(cmd)
+            self.__pump()
+
+    def console_print(self, msg):
+        # Like HConsolePrint, the bot sees its own prints.
+        self.console.append(msg)
+        if self.namespace:
+            self.namespace["handle_console_print"](msg)
+
+    def _configstring(self, index):
+        if 0 <= index < MAX_CONFIGSTRINGS - 1 and self.configstrings[index] is not None:
+            return self.configstrings[index]
+        return ""
+
+    def _configstring_range(self, i, j):
+        if i >= MAX_CONFIGSTRINGS or j >= MAX_CONFIGSTRINGS:
+            return {}
+        return dict((k, self.configstrings[k]) for k in range(i, j + 1) if self.configstrings[k] is not None)
+
+    def reinitialize(self):
+        self.reinitialized += 1
+        return 0
+
+    def connection_status(self):
+        return self.status
+
+    def get_cvar(self, name):
+        return self.cvars.get(name)
+
+    def console_command(self, cmd):
+        self.executed.append(cmd)
+
+    # ====================================================================
+    #                             DRIVING
+    # ====================================================================
+
+    def advance(self, seconds):
+        """Move the virtual clock forward and let queued commands through at the native pace."""
+        end = self.now + seconds
+        while self.queue:
+            due = self.now if self.__last_send is None else self.__last_send + DELAY_SEND_COMMAND
+            if due > end:
+                break
+            self.now = max(self.now, due)
+            # Forced, since now - last send can come out a hair under the delay in floats.
+            self.__pump(force=True)
+        self.now = end
+
+    def __pump(self, force=False):
+        if self.queue and (force or self.__last_send is None or self.now - self.__last_send >= DELAY_SEND_COMMAND):
+            self.sent.append((self.now, self.queue.popleft()))
+            self.__last_send = self.now
+
+    def load(self, nickname="bot", plugins="", plugins_folder=None, database=None, **options):
+        """Install the module, run plugin.py and minqlbot.py like python.cpp does, and load
+        the config and plugins like the main block does.
+
+        Any other keyword arguments are put in the config's Core section.
+
+        Returns:
+            The namespace the scripts ran in.
+
+        """
+        namespace = self.__run_scripts()
+        self.__tempdir = tempfile.mkdtemp(prefix="minqlbot_")
+        core = {"Nickname": nickname, "Plugins": plugins, "LogFile": "", "MetricsInterval": "0",
+            "PluginsFolder": plugins_folder or os.path.join(self.__tempdir, "plugins"),
+            "DatabasePath": database or os.path.join(self.__tempdir, "minqlbot.db")}
+        core.update((k, str(v)) for k, v in options.items())
+        if not plugins_folder:
+            os.makedirs(core["PluginsFolder"])
+        cfg = configparser.ConfigParser()
+        cfg["Core"] = core
+        self.config_file = os.path.join(self.__tempdir, "config.cfg")
+        with open(self.config_file, "w") as f:
+            cfg.write(f)
+
+        namespace["load_config"](self.config_file)
+        namespace["Core"].db_migrate()
+        if plugins:
+            namespace["load_preset_plugins"]()
+        return namespace
+
+    def restart(self):
+        """Same as \\bot restart: unload, run the scripts again like the main block does,
+        snapshot included, and pass the connection status again like the native main loop.
+
+        Returns:
+            The new namespace.
+
+        """
+        self.namespace["handle_unload"]()
+        namespace = self.__run_scripts()
+        namespace["load_config"](self.config_file)
+        namespace["Core"].db_migrate()
+        namespace["restore_snapshot"](getattr(self.module, "_SNAPSHOT", None))
+        setattr(self.module, "_SNAPSHOT", None)
+        namespace["load_preset_plugins"]()
+        if self.status != CA_DISCONNECTED:
+            namespace["handle_connection_status"](self.status)
+        return namespace
+
+    def __run_scripts(self):
+        sys.modules["minqlbot"] = self.module
+        namespace = {"__name__": "minqlbot_fake", "minqlbot": self.module}
+        for name in ("plugin.py", "minqlbot.py"):
+            path = os.path.join(HERE, name)
+            with open(path) as f:
+                exec(compile(f.read(), path, "exec"), namespace)
+        self.namespace = namespace
+        # The pacing of the native queue is done by advance(), so don't wait twice.
+        self.module.COMMAND_QUEUE.DELAY = 0
+        return namespace
+
+    def unload(self):
+        """Call handle_unload like \\bot exit does, and remove the folder load() made."""
+        if self.namespace:
+            self.namespace["handle_unload"]()
+            self.namespace = None
+        if sys.modules.get("minqlbot") is self.module:
+            del sys.modules["minqlbot"]
+        if self.__tempdir:
+            shutil.rmtree(self.__tempdir, ignore_errors=True)
+            self.__tempdir = None
+
+    def set_status(self, status):
+        self.status = status
+        if self.namespace:
+            self.namespace["handle_connection_status"](status)
+
+    def connect(self, players=None, serverinfo=None, configstrings=None):
+        """Go through the connection states, sending the gamestate along the way.
+
+        Args:
+            players: A dictionary with client IDs as keys and (name, team) tuples as values.
+            serverinfo: Overrides of DEFAULT_SERVERINFO.
+            configstrings: Any other configstrings, with indices as keys.
+
+        """
+        info = dict(DEFAULT_SERVERINFO)
+        info.update(serverinfo or {})
+        gamestate = {CS_SERVERINFO: make_variables(info)}
+        for cid, (name, team) in (players or {}).items():
+            gamestate[CS_PLAYERS + cid] = player_configstring(name, team)
+        gamestate.update(configstrings or {})
+
+        for status in (CA_CONNECTING, CA_CHALLENGING, CA_CONNECTED, CA_LOADING):
+            self.set_status(status)
+        for index in sorted(gamestate):
+            self.configstrings[index] = gamestate[index]
+            if self.namespace:
+                self.namespace["handle_gamestate"](index, gamestate[index])
+        for status in (CA_PRIMED, CA_ACTIVE):
+            self.set_status(status)
+
+    def disconnect(self):
+        self.set_status(CA_DISCONNECTED)
+        self.configstrings = [None] * MAX_CONFIGSTRINGS
+
+    def server_command(self, cmd):
+        """Pass a server command to the bot. "cs" and "bcs" commands update the configstring
+        table afterwards, since the bot sees them before the client does."""
+        if self.namespace:
+            self.namespace["handle_message"](cmd)
+        if cmd.startswith("cs "):
+            index, _, value = cmd[3:].partition(" ")
+            self.configstrings[int(index)] = value.strip('"')
+        elif cmd.startswith("bcs"):
+            # Big configstrings come in fragments: bcs0 starts one, bcs1 continues and bcs2 ends it.
+            index, _, value = cmd[5:].partition(" ")
+            index = int(index)
+            if cmd[3] == "0":
+                self.__bcs[index] = value.strip('"')
+            elif index in self.__bcs:
+                self.__bcs[index] += value.strip('"')
+                if cmd[3] == "2":
+                    self.configstrings[index] = self.__bcs.pop(index)
+
+    def set_configstring(self, index, value):
+        self.server_command('cs {} "{}"'.format(index, value))
+
+    def console_input(self, cmd):
+        """Same as typing "\\bot py <cmd>" in the console."""
+        self.namespace["handle_console_command"](cmd)
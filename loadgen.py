@@ -0,0 +1,394 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Synthetic match load for stress testing the bot against fake_minqlbot.
+
+MatchGenerator plays out matches a second at a time and produces the server commands a
+client would get: chat bursts, joins and leaves, team switches, rounds, votes, scoreboards,
+end-of-game stats and fragmented configstrings. The driver feeds them to handle_message
+and handle_gamestate at increasing rates until the bot can't keep up, and reports how
+that compares to the rate of a real match.
+
+"""
+
+import time
+import random
+import argparse
+import collections
+from fake_minqlbot import (FakeQuake, DEFAULT_SERVERINFO, CS_SERVERINFO, CS_PLAYERS,
+    make_variables, player_configstring)
+
+CS_RED_SCORE = 6
+CS_BLUE_SCORE = 7
+CS_VOTE_STRING = 9
+CS_VOTE_YES = 10
+CS_VOTE_NO = 11
+CS_GAME_END = 14
+CS_ROUND = 661
+
+GAMETYPES = {"ffa": 0, "race": 2, "ca": 4, "ctf": 5}
+TEAM_GAMETYPES = ("ca", "ctf")
+
+CHAT_LINES = ("gg", "nice shot", "lol", "wp", "rematch?", "brb", "who's on lg?", "ez", "gl hf", "afk 1 min")
+COMMANDS = ("!elo", "!teams", "!balance", "!seen player1", "!time", "!help")
+VOTES = ("map campgrounds", "map bloodrun", "kick player3", "shuffle", "g_gametype ctf")
+
+class MatchGenerator:
+    """Produces the commands of one second of a match at a time with second().
+
+    Items are ("message", command) for handle_message, or ("gamestate", index, configstring)
+    for handle_gamestate when the map changes. Rates are per player per second.
+
+    """
+    def __init__(self, players=16, gametype="ca", seed=None, chat_rate=0.03, command_ratio=0.2,
+        join_rate=0.001, switch_rate=0.002, vote_rate=0.003, roundlimit=5, timelimit=600):
+        if gametype not in GAMETYPES:
+            raise ValueError("Unknown gametype '{}'. Valid ones are: {}".format(gametype, ", ".join(GAMETYPES)))
+        self.random = random.Random(seed)
+        self.players = players
+        self.gametype = gametype
+        self.chat_rate = chat_rate
+        self.command_ratio = command_ratio
+        self.join_rate = join_rate
+        self.switch_rate = switch_rate
+        self.vote_rate = vote_rate
+        self.roundlimit = roundlimit
+        self.timelimit = timelimit
+        self.names = ["player{}".format(cid) for cid in range(players)]
+        self.teams = {}
+        for cid in range(players):
+            self.teams[cid] = (1 + cid % 2) if gametype in TEAM_GAMETYPES else 0
+        self.present = set(range(players))
+        self.state = "PRE_GAME"
+        self.clock = 0
+        self.scores = [0, 0]
+        self.round = 0
+        self.next_event = 20 # Seconds of warmup.
+        self.round_live = False
+
+    def serverinfo(self):
+        info = dict(DEFAULT_SERVERINFO)
+        info.update({"g_gametype": GAMETYPES[self.gametype], "g_gameState": self.state,
+            "sv_maxclients": max(16, self.players), "roundlimit": self.roundlimit})
+        return make_variables(info)
+
+    def gamestate(self):
+        """Get the configstrings a client gets on connecting, with indices as keys."""
+        cs = {CS_SERVERINFO: self.serverinfo(), CS_RED_SCORE: "0", CS_BLUE_SCORE: "0"}
+        for cid in self.present:
+            cs[CS_PLAYERS + cid] = player_configstring(self.names[cid], self.teams[cid])
+        return cs
+
+    def second(self):
+        out = []
+        self.clock += 1
+        self.__match(out)
+        self.__chat(out)
+        self.__roster(out)
+        if self.random.random() < self.vote_rate:
+            self.__vote(out)
+        if self.state == "IN_PROGRESS" and self.random.random() < 0.5:
+            self.__scoreboard(out) # Someone's holding tab.
+        return out
+
+    def rate(self, seconds=3600):
+        """Get the average number of commands per second over 'seconds' seconds of a copy of this match."""
+        copy = MatchGenerator(self.players, self.gametype, self.random.random(), self.chat_rate,
+            self.command_ratio, self.join_rate, self.switch_rate, self.vote_rate, self.roundlimit, self.timelimit)
+        return sum(len(copy.second()) for i in range(seconds)) / seconds
+
+    def __msg(self, out, cmd):
+        out.append(("message", cmd))
+
+    def __set_state(self, out, state):
+        self.state = state
+        info = self.serverinfo()
+        if self.random.random() < 0.5:
+            self.__msg(out, 'cs {} "{}"'.format(CS_SERVERINFO, info))
+        else:
+            # Send it as a big configstring in three fragments.
+            a, b = len(info) // 3, 2 * len(info) // 3
+            for mode, fragment in enumerate((info[:a], info[a:b], info[b:])):
+                self.__msg(out, 'bcs{} {} "{}"'.format(mode, CS_SERVERINFO, fragment))
+
+    def __match(self, out):
+        if self.clock < self.next_event:
+            return
+
+        if self.state == "PRE_GAME":
+            self.__set_state(out, "COUNT_DOWN")
+            self.next_event = self.clock + 10
+        elif self.state == "COUNT_DOWN":
+            self.__set_state(out, "IN_PROGRESS")
+            self.scores = [0, 0]
+            self.round = 0
+            self.game_started = self.clock
+            self.__next_round(out)
+        elif self.gametype == "ca" and not self.round_live:
+            self.__msg(out, 'cs {} "\\round\\{}"'.format(CS_ROUND, self.round))
+            self.round_live = True
+            self.next_event = self.clock + self.random.randint(30, 90)
+        elif self.gametype == "ca":
+            winner = self.random.randint(0, 1)
+            self.scores[winner] += 1
+            self.__msg(out, 'cs {} "{}"'.format(CS_RED_SCORE + winner, self.scores[winner]))
+            self.round_live = False
+            if max(self.scores) >= self.roundlimit:
+                self.__end(out)
+            else:
+                self.__next_round(out)
+        else:
+            self.__end(out)
+
+    def __next_round(self, out):
+        if self.gametype == "ca":
+            self.round += 1
+            self.__msg(out, 'cs {} "\\round\\{}\\time\\{}"'.format(CS_ROUND, self.round, self.clock + 10))
+            self.next_event = self.clock + 10
+        else:
+            self.next_event = self.clock + self.timelimit
+
+    def __end(self, out):
+        if self.gametype in TEAM_GAMETYPES:
+            for team in range(2):
+                self.__msg(out, 'cs {} "{}"'.format(CS_RED_SCORE + team, self.scores[team] or 1 - team))
+        self.__msg(out, 'cs {} "1"'.format(CS_GAME_END))
+        if self.gametype == "ca":
+            # castats come right after the last scoreboard, in the same order.
+            order = self.__scoreboard(out)
+            for cid in order:
+                stats = [cid, self.random.randint(0, 20000), self.random.randint(0, 20000)]
+                stats += [self.random.randint(0, 100) for i in range(30)]
+                self.__msg(out, "castats " + " ".join(str(i) for i in stats))
+        self.state = "PRE_GAME"
+        self.next_event = self.clock + 30
+
+        if self.random.random() < 0.5:
+            # Map change, so everything's sent again as a gamestate.
+            for index, cs in sorted(self.gamestate().items()):
+                out.append(("gamestate", index, cs))
+        else:
+            self.__set_state(out, "PRE_GAME")
+
+    def __scoreboard(self, out):
+        order = sorted(self.present)
+        if self.gametype == "ca":
+            rows = []
+            for cid in order:
+                rows += [cid, self.teams[cid], 0, self.random.randint(0, 200), self.random.randint(10, 150),
+                    self.clock, self.random.randint(0, 30), self.random.randint(0, 30), self.random.randint(0, 60),
+                    self.random.randint(1, 8), self.random.randint(0, 60), self.random.randint(0, 20000),
+                    0, 0, 0, 0, self.random.randint(0, 1)]
+            self.__msg(out, "scores_ca {} {} {} {}".format(len(order), self.scores[0], self.scores[1],
+                " ".join(str(i) for i in rows)))
+        elif self.gametype == "race":
+            rows = []
+            for cid in order:
+                rows += [cid, 0, self.random.randint(10000, 60000), self.random.randint(10, 150), self.clock]
+            self.__msg(out, "scores_race {} {}".format(len(order), " ".join(str(i) for i in rows)))
+        else:
+            # The bot doesn't parse these, but they still go through handle_message.
+            rows = " ".join("{} {} {}".format(cid, self.random.randint(0, 50), self.random.randint(10, 150))
+                for cid in order)
+            self.__msg(out, "scores {} {}".format(len(order), rows))
+        return order
+
+    def __chat(self, out):
+        for cid in sorted(self.present):
+            if self.random.random() >= self.chat_rate:
+                continue
+            # Now and then, someone has a lot to say.
+            lines = self.random.randint(3, 8) if self.random.random() < 0.1 else 1
+            name = self.names[cid]
+            for i in range(lines):
+                if self.random.random() < self.command_ratio:
+                    text = self.random.choice(COMMANDS)
+                else:
+                    text = self.random.choice(CHAT_LINES)
+                kind = self.random.random()
+                if kind < 0.7:
+                    self.__msg(out, 'chat "{:02d} {}^7\x19: ^2{}"'.format(cid, name, text))
+                elif kind < 0.9 and self.teams[cid] in (1, 2):
+                    self.__msg(out, 'tchat "{:02d} \x19({}^7\x19)\x19: ^5{}"'.format(cid, name, text))
+                else:
+                    self.__msg(out, 'chat "{:02d} \x19[{}^7\x19]\x19: ^6{}"'.format(cid, name, text))
+
+    def __roster(self, out):
+        for cid in range(self.players):
+            if self.random.random() >= self.join_rate:
+                continue
+            name = self.names[cid]
+            if cid in self.present:
+                self.present.remove(cid)
+                self.__msg(out, 'print "{} disconnected\\n"'.format(name))
+                self.__msg(out, 'cs {} ""'.format(CS_PLAYERS + cid))
+            else:
+                self.present.add(cid)
+                self.__msg(out, 'print "{} connected\\n"'.format(name))
+                self.__msg(out, 'cs {} "{}"'.format(CS_PLAYERS + cid, player_configstring(name, self.teams[cid])))
+
+        if self.gametype not in TEAM_GAMETYPES:
+            return
+        for cid in sorted(self.present):
+            if self.random.random() < self.switch_rate:
+                self.teams[cid] = 3 if self.teams[cid] in (1, 2) else self.random.randint(1, 2)
+                self.__msg(out, 'cs {} "{}"'.format(CS_PLAYERS + cid,
+                    player_configstring(self.names[cid], self.teams[cid])))
+
+    def __vote(self, out):
+        if not self.present:
+            return
+        caller = self.random.choice(sorted(self.present))
+        self.__msg(out, 'print "{} called a vote.\\n"'.format(self.names[caller]))
+        self.__msg(out, 'cs {} "{}"'.format(CS_VOTE_STRING, self.random.choice(VOTES)))
+        yes, no = 1, 0
+        self.__msg(out, 'cs {} "{}"'.format(CS_VOTE_YES, yes))
+        self.__msg(out, 'cs {} "{}"'.format(CS_VOTE_NO, no))
+        for cid in sorted(self.present):
+            if cid != caller and self.random.random() < 0.7:
+                if self.random.random() < 0.6:
+                    yes += 1
+                    self.__msg(out, 'cs {} "{}"'.format(CS_VOTE_YES, yes))
+                else:
+                    no += 1
+                    self.__msg(out, 'cs {} "{}"'.format(CS_VOTE_NO, no))
+        self.__msg(out, 'print "Vote {}.\\n"'.format("passed" if yes > no else "failed"))
+        self.__msg(out, 'cs {} ""'.format(CS_VOTE_STRING))
+
+def message_type(item):
+    """Group commands for the per-type breakdown."""
+    if item[0] == "gamestate":
+        return "gamestate"
+    cmd = item[1].split(" ", 2)
+    if cmd[0] != "cs":
+        return cmd[0]
+    index = int(cmd[1])
+    if CS_PLAYERS <= index < CS_PLAYERS + 24:
+        return "cs players"
+    return "cs {}".format(index)
+
+class Driver:
+    """Feeds a generator's commands to the bot at a target rate, on the wall clock."""
+    def __init__(self, fake, generator):
+        self.fake = fake
+        self.generator = generator
+        self.pending = collections.deque()
+
+    def items(self):
+        while True:
+            if not self.pending:
+                self.pending.extend(self.generator.second())
+                self.fake.advance(1)
+                continue
+            yield self.pending.popleft()
+
+    def feed(self, item):
+        if item[0] == "message":
+            self.fake.server_command(item[1])
+        else:
+            self.fake.configstrings[item[1]] = item[2]
+            self.fake.namespace["handle_gamestate"](item[1], item[2])
+
+    def run(self, rate, duration):
+        """Feed commands at 'rate' per second for 'duration' seconds.
+
+        Returns:
+            A dictionary with the rate actually achieved, how busy the bot was, the
+            latency percentiles in milliseconds and the mean cost of each command type.
+
+        """
+        interval = 1 / rate
+        costs = collections.defaultdict(list)
+        latencies = []
+        items = self.items()
+        begin = time.perf_counter()
+        deadline = begin + duration
+        due = begin
+        busy = 0.0
+        count = 0
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            if now < due:
+                time.sleep(due - now)
+            item = next(items)
+            start = time.perf_counter()
+            self.feed(item)
+            end = time.perf_counter()
+            busy += end - start
+            costs[message_type(item)].append(end - start)
+            latencies.append(end - due) # How long it's been since it "arrived".
+            due += interval
+            count += 1
+
+        elapsed = time.perf_counter() - begin
+        latencies.sort()
+        percentile = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+        return {"target": rate, "achieved": count / elapsed, "busy": busy / elapsed,
+            "p50": percentile(0.5), "p99": percentile(0.99), "behind": max(0.0, due - deadline),
+            "costs": dict((k, (len(v), sum(v) / len(v) * 1000)) for k, v in costs.items())}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--players", type=int, default=24)
+    parser.add_argument("--gametype", choices=sorted(GAMETYPES), default="ca")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--duration", type=float, default=3, help="Seconds per step of the ramp.")
+    parser.add_argument("--start-rate", type=float, default=50, help="Commands per second of the first step.")
+    parser.add_argument("--max-rate", type=float, default=100000)
+    parser.add_argument("--plugins", default="", help="Comma-separated plugins to load, like in the config.")
+    parser.add_argument("--plugins-folder", default=None)
+    args = parser.parse_args()
+
+    generator = MatchGenerator(args.players, args.gametype, args.seed)
+    real_rate = generator.rate()
+    fake = FakeQuake()
+    fake.load(plugins=args.plugins, plugins_folder=args.plugins_folder, FloodRate="0", FloodCommandRate="0")
+    fake.connect(configstrings=generator.gamestate())
+    driver = Driver(fake, generator)
+
+    print("{} players of {}: a real match averages {:.1f} commands/s.".format(args.players, args.gametype, real_rate))
+    print("{:>10} {:>10} {:>7} {:>9} {:>9}".format("target/s", "achieved/s", "busy", "p50 ms", "p99 ms"))
+    rate = args.start_rate
+    saturated = None
+    last = None
+    try:
+        while rate <= args.max_rate:
+            res = driver.run(rate, args.duration)
+            last = res
+            print("{:>10.0f} {:>10.0f} {:>6.0%} {:>9.2f} {:>9.2f}".format(rate, res["achieved"], res["busy"],
+                res["p50"], res["p99"]))
+            if res["achieved"] < rate * 0.95 or res["behind"] > 1:
+                saturated = res["achieved"]
+                break
+            rate *= 2
+    finally:
+        fake.unload()
+
+    if saturated:
+        print("Saturates at about {:.0f} commands/s, {:.0f}x a real match.".format(saturated, saturated / real_rate))
+    else:
+        print("Didn't saturate below {:.0f} commands/s.".format(args.max_rate))
+
+    print("\n{:<16} {:>8} {:>10}".format("command", "count", "mean ms"))
+    for name, (count, mean) in sorted(last["costs"].items(), key=lambda i: i[1][1], reverse=True):
+        print("{:<16} {:>8} {:>10.3f}".format(name, count, mean))
+
+if __name__ == "__main__":
+    main()
@@ -27,6 +27,24 @@ import configparser
 import re
 import traceback
 import importlib
+import threading
+import time
+import json
+import cProfile
+import pstats
+import io
+import gc
+import weakref
+import tracemalloc
+import hashlib
+import ast
+import concurrent.futures
+import array
+import collections
+import socket
+import struct
+import base64
+import ipaddress
 import minqlbot
 
 # ====================================================================
@@ -50,36 +68,82 @@ setattr(minqlbot, "RET_NONE", 0)
 setattr(minqlbot, "RET_STOP", 1)
 setattr(minqlbot, "RET_USAGE", 2)
 
+class LazyPattern:
+    """A regular expression that isn't compiled until it's first used, so that loading
+    the bot doesn't compile patterns for events that might never happen.
+
+    Attributes of the compiled pattern are copied onto the instance the first time they're
+    looked up, so after that, calling match() and such costs the same as usual.
+
+    """
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+        self.__compiled = None
+
+    def __getattr__(self, attr):
+        if self.__compiled is None:
+            self.__compiled = re.compile(self.pattern, self.flags)
+        value = getattr(self.__compiled, attr)
+        setattr(self, attr, value)
+        return value
+
+setattr(minqlbot, "LazyPattern", LazyPattern)
+
 # ====================================================================
 #                         LOW-LEVEL HANDLERS
 #       These are all called by the C++ code, not within Python.  
 # ====================================================================
 
 # Regex to catch "cs" commands.
-re_cs = re.compile(r'cs (?P<index>[^ ]+) "(?P<cvars>.*)"$')
+re_cs = LazyPattern(r'cs (?P<index>[^ ]+) "(?P<cvars>.*)"$')
 # Regex to get the current vote and its arguments.
-re_vote = re.compile('(?P<vote>.+) "*(?P<args>.*?)"*')
+re_vote = LazyPattern('(?P<vote>.+) "*(?P<args>.*?)"*')
 # Regex to catch colors.
-re_color_tag = re.compile(r"\^.")
-
-def handle_message(msg):
+re_color_tag = LazyPattern(r"\^.")
+
+message_count = minqlbot.METRICS.counter("minqlbot_messages_total",
+    "Server commands received, by command.", ("command",))
+event_count = minqlbot.METRICS.counter("minqlbot_events_total", "Events triggered, by event.", ("event",))
+handler_errors = minqlbot.METRICS.counter("minqlbot_handler_errors_total",
+    "Exceptions raised by hooks, by plugin.", ("plugin",))
+command_count = minqlbot.METRICS.counter("minqlbot_commands_total", "Commands executed, by command.", ("command",))
+command_throttled = minqlbot.METRICS.counter("minqlbot_commands_throttled_total", "Commands dropped by flood control.")
+
+def handle_message(msg, forward=True):
+    # Stamp it so that we can tell how long it takes until we reply to it. Plugins can
+    # call us from a handler, so put the trace of the outer message back when we're done.
+    context = minqlbot.COMMAND_QUEUE.context
+    outer = getattr(context, "trace", None)
+    context.trace = Trace()
     msg = msg.replace("\n", "")
+    message_count.inc(msg.split(" ", 1)[0])
+    if forward and plugin_bridge.connected:
+        plugin_bridge.publish("msg", msg)
 
-    # Cache configstrings.
-    res = re_cs.match(msg)
-    if res:
-        index = int(res.group("index"))
-        cvars = res.group("cvars")
-        with minqlbot._CS_CACHE_LOCK:
-            minqlbot._CS_CACHE[index] = cvars
-
-    parse(msg)
-    event_handlers["raw"].trigger(msg)
+    profiling = profiler.active and profiler.enable()
+    try:
+        # Cache configstrings.
+        res = re_cs.match(msg)
+        if res:
+            index = int(res.group("index"))
+            cvars = res.group("cvars")
+            with minqlbot._CS_CACHE_LOCK:
+                minqlbot._CS_CACHE[index] = cvars
+
+        parse(msg)
+        event_handlers["raw"].trigger(msg)
+    finally:
+        if profiling:
+            profiler.disable()
+        context.trace = outer
     
 def handle_gamestate(index, configstring):
     configstring = configstring.replace("\n", "")
     with minqlbot._CS_CACHE_LOCK:  # Cache the gamestate.
         minqlbot._CS_CACHE[index] = configstring
+    if plugin_bridge.connected:
+        plugin_bridge.publish("gamestate", index, configstring)
     event_handlers["gamestate"].trigger(index, configstring)
     
     if index == 3:
@@ -89,6 +153,8 @@ connected = False
 
 def handle_connection_status(status):
     global connected
+    if plugin_bridge.connected:
+        plugin_bridge.publish("status", status)
     if status < 6 and connected:
         connected = False
         with minqlbot._CS_CACHE_LOCK:
@@ -120,10 +186,20 @@ def handle_connection_status(status):
     setattr(minqlbot, "CONNECTION", status)
     
 def handle_console_print(cmd):
+    if plugin_bridge.connected:
+        plugin_bridge.publish("print", cmd)
     event_handlers["console"].trigger(cmd.rstrip("\n"))
 
 def handle_console_command(cmd):
-    commands.handle_input(minqlbot.DummyPlayer(minqlbot.NAME), cmd, minqlbot.CONSOLE_CHANNEL, prefix=False)
+    trace = Trace()
+    trace.parse()
+    context = minqlbot.COMMAND_QUEUE.context
+    outer = getattr(context, "trace", None)
+    context.trace = trace
+    try:
+        commands.handle_input(minqlbot.DummyPlayer(minqlbot.NAME), cmd, minqlbot.CONSOLE_CHANNEL, prefix=False)
+    finally:
+        context.trace = outer
 
 unloaded = False
     
@@ -131,9 +207,22 @@ def handle_unload():
     global unloaded
     if not unloaded:
         unloaded = True
+    setattr(minqlbot, "_SNAPSHOT", take_snapshot())
     for plugin in minqlbot.Plugin._Plugin__loaded_plugins.copy():
         unload_plugin(plugin)
 
+    # Hand whatever's left to the native queue and stop the scheduler's thread.
+    reply_packer.flush()
+    minqlbot.METRICS.stop_exporter()
+    memory_tracker.stop()
+    minqlbot.COMMAND_QUEUE.stop()
+    plugin_bridge.stop()
+    minqlbot.DatabaseWriter.stop_writers()
+    minqlbot.ConnectionPool.close_pools()
+    minqlbot.STATE_CLIENT.stop()
+    # Last, since everything above logs.
+    minqlbot.LOG.stop()
+
 # ====================================================================
 #                         EVENTS & COMMANDS
 # ====================================================================
@@ -225,22 +314,142 @@ class AbstractChannel:
 # Export the abstract.
 setattr(minqlbot, "AbstractChannel", AbstractChannel)
 
+class ReplyPacker:
+    """Buffers chat replies for a short window and packs them into as few commands as possible.
+
+    The native queue only sends a command every 600 ms, so sending every line of a
+    reply as its own "say" adds up quickly. For the channels named in 'channels', replies
+    to the same channel from the same plugin within 'window' seconds are instead joined
+    with a separator and sent with as few commands of at most 'limit' characters as
+    possible. Lines that had their color changed are followed by the channel's default
+    color, so that the next line starts out the same way it would have as a separate
+    command. No channel is packed unless the PackReplies option names it.
+
+    Any other command a plugin sends flushes its buffered replies first, so that they
+    still go out before it. The buffers are flushed on timer threads otherwise.
+
+    """
+    def __init__(self, window=0.1, limit=100, separator=" ^7| "):
+        self.window = window
+        self.limit = limit
+        self.separator = separator
+        self.channels = set() # Names of the channels whose replies are packed.
+        self.lines = 0 # Commands that would've been sent without packing.
+        self.sent = 0
+        self.__buffers = {}
+        self.__lock = threading.Lock()
+
+    @property
+    def saved(self):
+        return self.lines - self.sent
+
+    def add(self, channel, msg):
+        context = minqlbot.COMMAND_QUEUE.context
+        key = (channel.command, getattr(context, "plugin", None) or "core")
+        with self.__lock:
+            if key in self.__buffers:
+                self.__buffers[key][1].append(msg)
+                return
+
+            timer = threading.Timer(self.window, self.flush, args=(key,))
+            timer.daemon = True
+            self.__buffers[key] = (channel, [msg], timer, getattr(context, "trace", None))
+            timer.start()
+
+    def flush(self, key=None):
+        """Send the buffered replies of a channel right away, or every channel's if no key is passed."""
+        with self.__lock:
+            if key is None:
+                buffers = list(self.__buffers.items())
+                self.__buffers.clear()
+            elif key in self.__buffers:
+                buffers = [(key, self.__buffers.pop(key))]
+            else:
+                return
+
+        for (command, plugin), (channel, msgs, timer, trace) in buffers:
+            timer.cancel()
+            packed = self.pack(channel, msgs)
+            with self.__lock:
+                self.sent += len(packed)
+            for msg in packed:
+                minqlbot.COMMAND_QUEUE.send('{} "{}"'.format(command, msg), plugin, trace=trace)
+
+    def flush_plugin(self, plugin):
+        """Send the buffered replies of a plugin right away."""
+        with self.__lock:
+            keys = [key for key in self.__buffers if key[1] == plugin]
+        for key in keys:
+            self.flush(key)
+
+    def split(self, channel, msg):
+        """Split a message into lines of at most 'limit' characters, each starting with
+        the color the previous one ended with."""
+        out = []
+        last_color = ""
+        # Leave room for the color tag.
+        for s in channel.split_long_msg(msg, limit=self.limit - 2):
+            out.append(last_color + s)
+            find = re_color_tag.findall(s)
+            if find:
+                last_color = find[-1]
+        return out
+
+    def pack(self, channel, msgs):
+        segments = []
+        for msg in msgs:
+            segments.extend(self.split(channel, msg))
+        # Timers flush on threads of their own, so the counters need the lock.
+        with self.__lock:
+            self.lines += len(segments)
+
+        out = []
+        current = ""
+        for seg in segments:
+            if not current:
+                current = seg
+                continue
+
+            joined = current + self.separator
+            if not seg.startswith("^"):
+                joined += channel.color
+            joined += seg
+            if len(joined) <= self.limit:
+                current = joined
+            else:
+                out.append(current)
+                current = seg
+        if current:
+            out.append(current)
+
+        return out
+
+reply_packer = ReplyPacker()
+minqlbot.COMMAND_QUEUE.flushers.append(reply_packer.flush_plugin)
+setattr(minqlbot, "REPLY_PACKER", reply_packer)
+
 class ChatChannel(AbstractChannel):
     """A channel for in-game chat, excluding team chat.
 
+    Replies are sent right away, unless minqlbot.REPLY_PACKER is set to pack the channel,
+    in which case they go out after a short delay.
+
     """
+    # The color the game uses for the message itself.
+    color = "^2"
+
     def __init__(self):
         super().__init__("chat")
         self.command = "say"
         
 
     def reply(self, msg):
-        last_color = ""
-        for s in self.split_long_msg(msg, limit=100):
-            minqlbot.send_command('{} "{}{}"'.format(self.command, last_color, s))
-            find = re_color_tag.findall(s)
-            if find:
-                last_color = find[-1]
+        if self.name in reply_packer.channels:
+            reply_packer.add(self, msg)
+            return
+
+        for s in reply_packer.split(self, msg):
+            minqlbot.COMMAND_QUEUE.send('{} "{}"'.format(self.command, s))
 
 # Static chat channel.
 chat_channel = ChatChannel()
@@ -250,6 +459,8 @@ class TeamChatChannel(ChatChannel):
     """A channel for in-game team chat.
 
     """
+    color = "^5"
+
     def __init__(self):
         super(ChatChannel, self).__init__("team_chat")
         self.command = "say_team"
@@ -265,6 +476,8 @@ class TellChannel(ChatChannel):
     """A channel for in-game tells (private messages).
 
     """
+    color = "^6"
+
     def __init__(self, player):
         super(ChatChannel, self).__init__("tell")
         if not isinstance(player, minqlbot.Player):
@@ -322,9 +535,25 @@ class Command:
         self.exclude_channels = exclude_channels
         self.usage = usage
 
+        # Precompute the channels as sets of names so that we don't go through
+        # AbstractChannel.__eq__ for every single channel on every single check.
+        if channels == minqlbot.CMD_ALL_CHANNELS:
+            self.__channel_names = None
+        else:
+            self.__channel_names = frozenset(channel_name(c) for c in channels)
+        self.__exclude_names = frozenset(channel_name(c) for c in exclude_channels)
+
     def execute(self, player, msg, channel):
-        debug("[EXECUTE] {} @ {} -> {}".format(self.name[0], self.plugin.name, channel), only_debug=True)
-        return self.handler(player, msg.split(), channel)
+        debug("[EXECUTE] {} @ {} -> {}", self.name[0], self.plugin.name, channel, only_debug=True)
+        context = minqlbot.COMMAND_QUEUE.context
+        previous = getattr(context, "plugin", None)
+        context.plugin = self.plugin.name
+        try:
+            if profiler.active:
+                return profiler.call(self.plugin.name, self.name[0], self.handler, player, msg.split(), channel)
+            return self.handler(player, msg.split(), channel)
+        finally:
+            context.plugin = previous
 
     def is_eligible_name(self, name):
         return name.lower() in self.name
@@ -334,9 +563,9 @@ class Command:
 
         Exclude takes precedence.
         """
-        if channel in self.exclude_channels:
+        if self.__exclude_names and repr(channel) in self.__exclude_names:
             return False
-        elif self.channels == minqlbot.CMD_ALL_CHANNELS or channel.name in self.channels:
+        elif self.__channel_names is None or channel.name in self.__channel_names:
             return True
         else:
             return False
@@ -353,12 +582,145 @@ class Command:
 # Export.
 setattr(minqlbot, "Command", Command)
 
+def channel_name(channel):
+    """Get the name a channel compares equal to, be it a string or an AbstractChannel."""
+    if isinstance(channel, str):
+        return channel
+    else:
+        return repr(channel)
+
+class TokenBucket:
+    """A token bucket holding up to 'burst' tokens and refilling at 'rate' tokens per second.
+
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def consume(self, now):
+        """Take a token if there's one. Returns False if the bucket's empty."""
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+class FloodControl:
+    """Limits how often players can execute commands with token buckets.
+
+    Every player gets a bucket shared by all commands, and one bucket per command name.
+    A command is only executed if both have a token to spare. A rate or burst of 0
+    disables the respective bucket. Players with a permission level of at least
+    'exempt_level' are never throttled, unless it's 0.
+
+    By default, only the shared bucket is used, and it lets a player run a command a
+    second with bursts of five, which normal use doesn't come close to.
+
+    """
+    # Idle buckets are pruned when there are more than this many of them.
+    MAX_BUCKETS = 256
+
+    def __init__(self, rate=1, burst=5, command_rate=0, command_burst=3, exempt_level=5):
+        self.rate = rate
+        self.burst = burst
+        self.command_rate = command_rate
+        self.command_burst = command_burst
+        self.exempt_level = exempt_level
+        self.throttled = 0
+        self.throttled_players = {}
+        self.throttled_commands = {}
+        self.__player_buckets = {}
+        self.__command_buckets = {}
+        self.__lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool((self.rate and self.burst) or (self.command_rate and self.command_burst))
+
+    @staticmethod
+    def key(player):
+        if isinstance(player, minqlbot.Player):
+            return player.clean_name.lower()
+        else:
+            return str(player)
+
+    def allow(self, player, name):
+        """Check if a player is allowed to execute a command right now and consume
+        tokens if so. Doesn't take permission levels into account, so the caller should
+        check those first, or players could use up tokens with commands they can't use.
+
+        """
+        key = self.key(player)
+        now = time.monotonic()
+        with self.__lock:
+            if self.rate and self.burst:
+                pb = self.__bucket(self.__player_buckets, key, self.rate, self.burst)
+                pb.refill(now)
+                if pb.tokens < 1:
+                    return False
+            else:
+                pb = None
+
+            if self.command_rate and self.command_burst:
+                cb = self.__bucket(self.__command_buckets, (key, name), self.command_rate, self.command_burst)
+                if not cb.consume(now):
+                    return False
+
+            if pb:
+                pb.consume(now)
+
+        return True
+
+    def reset(self):
+        with self.__lock:
+            self.__player_buckets.clear()
+            self.__command_buckets.clear()
+
+    def throttle(self, player, name):
+        """Count a dropped command."""
+        key = self.key(player)
+        with self.__lock:
+            self.throttled += 1
+            self.throttled_players[key] = self.throttled_players.get(key, 0) + 1
+            self.throttled_commands[name] = self.throttled_commands.get(name, 0) + 1
+
+    def __bucket(self, buckets, key, rate, burst):
+        if key not in buckets:
+            if len(buckets) >= self.MAX_BUCKETS:
+                self.__prune(buckets)
+            buckets[key] = TokenBucket(rate, burst)
+        return buckets[key]
+
+    def __prune(self, buckets):
+        """Drop buckets that would be full by now, since they're as good as new ones."""
+        now = time.monotonic()
+        for key in list(buckets):
+            b = buckets[key]
+            if b.tokens + (now - b.last) * b.rate >= b.burst:
+                del buckets[key]
+
+# Export the class.
+setattr(minqlbot, "FloodControl", FloodControl)
+
 class CommandManager:
     """Holds all commands and executes them whenever we get input and should execute.
 
     """
     def __init__(self):
+        self.flood_control = FloodControl()
         self.__commands = ([], [], [], [], [])
+        # Name/alias -> tuple of commands with that name, in priority order.
+        self.__index = {}
+        # (names, handler) -> command, for quick duplicate checks.
+        self.__registered = {}
+        # Name/alias -> LazyPlugins to activate before a command with that name runs.
+        self.lazy = {}
 
     @property
     def commands(self):
@@ -374,6 +736,8 @@ class CommandManager:
         
         #debug("Adding command: {}".format(command.name), only_debug=True)
         self.__commands[priority].append(command)
+        self.__registered[(tuple(command.name), command.handler)] = command
+        self.__reindex(command.name)
 
     def remove_command(self, command):
         if not self.is_registered(command):
@@ -384,6 +748,8 @@ class CommandManager:
                     if cmd == command:
                         #debug("Removing command: {}".format(command.name), only_debug=True)
                         priority_level.remove(cmd)
+                        del self.__registered[(tuple(cmd.name), cmd.handler)]
+                        self.__reindex(cmd.name)
                         return
 
         debug("Weird behavior when removing: ".format(command.name), only_debug=True)
@@ -394,12 +760,25 @@ class CommandManager:
         Commands are unique by (command.name, command.handler).
 
         """
-        for priority_level in self.__commands:
-            for cmd in priority_level:
-                if command.name == cmd.name and command.handler == cmd.handler:
-                    return True
+        return (tuple(command.name), command.handler) in self.__registered
 
-        return False
+    def lookup(self, name):
+        """Get the commands with a particular name or alias, in priority order.
+
+        """
+        return self.__index.get(name, ())
+
+    def __reindex(self, names):
+        """Rebuild the index entries of the given names. Only done when adding or
+        removing commands, so it doesn't matter that it goes through every command.
+
+        """
+        for name in names:
+            cmds = tuple(cmd for priority_level in self.__commands for cmd in priority_level if name in cmd.name)
+            if cmds:
+                self.__index[name] = cmds
+            elif name in self.__index:
+                del self.__index[name]
 
     def handle_input(self, player, msg, channel, prefix=True):
         # Check if it's just a couple of spaces and return if so.
@@ -412,17 +791,47 @@ class CommandManager:
         else:
             name = ms[0].lower()
 
-        for priority_level in self.__commands:
-            for cmd in priority_level:
-                if cmd.is_eligible_name(name) and cmd.is_eligible_channel(channel) and cmd.is_eligible_player(player):
-                    res = cmd.execute(player, msg, channel)
-                    if res == minqlbot.RET_STOP:
-                        return
-                    elif res == minqlbot.RET_USAGE:
-                        channel.reply("^7Usage: ^6{}{} {}".format(minqlbot.COMMAND_PREFIX, name, cmd.usage))
-                    elif res != None and res != minqlbot.RET_NONE:
-                        debug("[Warning] Command '{}' with handler '{}' returned an unknown return value: {}"
-                            .format(cmd.name, cmd.handler.__name__, res))
+        if name in self.lazy:
+            # Activate them first, so that their commands go through the usual path.
+            for lazy in list(self.lazy[name]):
+                lazy.activate()
+        cmds = self.lookup(name)
+        if not cmds:
+            return
+
+        trace = getattr(minqlbot.COMMAND_QUEUE.context, "trace", None)
+        if trace:
+            trace.name = name
+
+        cmds = [cmd for cmd in cmds if cmd.is_eligible_channel(channel) and cmd.is_eligible_player(player)]
+        if not cmds:
+            return
+
+        # Throttle spammers before calling any handlers. Commands they can't use don't cost
+        # them anything, and the console is the bot's owner, so it's never throttled.
+        flood = self.flood_control
+        if not isinstance(channel, ConsoleChannel) and flood.enabled:
+            exempt = flood.exempt_level
+            if (not exempt or not cmds[0].plugin.has_permission(player, exempt)) and not flood.allow(player, name):
+                flood.throttle(player, name)
+                command_throttled.inc()
+                debug("[FLOOD] {} throttled: {}", player, name, only_debug=True)
+                return
+
+        for cmd in cmds:
+            if trace:
+                trace.dispatch()
+            command_count.inc(name)
+            res = cmd.execute(player, msg, channel)
+            if trace:
+                trace.handle()
+            if res == minqlbot.RET_STOP:
+                return
+            elif res == minqlbot.RET_USAGE:
+                channel.reply("^7Usage: ^6{}{} {}".format(minqlbot.COMMAND_PREFIX, name, cmd.usage))
+            elif res != None and res != minqlbot.RET_NONE:
+                debug("[Warning] Command '{}' with handler '{}' returned an unknown return value: {}"
+                    .format(cmd.name, cmd.handler.__name__, res))
 
 # Export the class.
 setattr(minqlbot, "CommandManager", CommandManager)
@@ -434,6 +843,121 @@ commands = CommandManager()
 setattr(minqlbot, "COMMANDS", commands)
 
 
+class CoalescedHandler:
+    """Wraps a hook so that bursts of an event result in fewer calls to it.
+
+    Events like "scores", "gamestate", "team_switch" and "raw" can arrive in bursts,
+    and a lot of handlers only care about the latest state (e.g. a balance checker
+    during a shuffle). Instead of calling the handler for every payload, the payload
+    is stored and the handler is called once with the latest one, dropping the rest.
+
+    COALESCE_LATEST: The first payload of a burst starts a window of N milliseconds.
+        When the window ends, the handler is called with the latest payload.
+    COALESCE_BURST: Every payload restarts the window, so the handler is called once
+        with the latest payload after the event has been quiet for N milliseconds.
+
+    The handler is called from a timer thread, not the thread that dispatched the event,
+    so it needs to be thread-safe with regard to the plugin's other handlers. Since the
+    event has already been dispatched by then, its return value cannot stop the remaining
+    hooks.
+
+    """
+    def __init__(self, plugin, handler, policy, window):
+        if policy not in (minqlbot.COALESCE_LATEST, minqlbot.COALESCE_BURST):
+            raise EventHandlerError("Invalid coalescing policy: {}".format(policy))
+        elif window <= 0:
+            raise EventHandlerError("The coalescing window needs to be a positive number of milliseconds.")
+
+        self.plugin = plugin
+        self.handler = handler
+        self.policy = policy
+        self.window = window
+        self.__name__ = handler.__name__
+        self.received = 0
+        self.invoked = 0
+        self.__lock = threading.Lock()
+        self.__timer = None
+        self.__payload = None
+
+    def __eq__(self, other):
+        if isinstance(other, CoalescedHandler):
+            return self.handler == other.handler
+        else:
+            return self.handler == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.handler)
+
+    def __call__(self, *args, **kwargs):
+        with self.__lock:
+            self.received += 1
+            self.__payload = (args, kwargs)
+            if self.__timer and self.policy == minqlbot.COALESCE_BURST:
+                self.__timer.cancel()
+            elif self.__timer:
+                return
+
+            self.__timer = threading.Timer(self.window / 1000, self.flush)
+            self.__timer.daemon = True
+            self.__timer.start()
+
+    @property
+    def saved(self):
+        """The number of handler calls that were dropped because of a newer payload."""
+        return self.stats()[2]
+
+    def stats(self):
+        """Get the received, invoked and saved counts at once."""
+        with self.__lock:
+            pending = 1 if self.__payload is not None else 0
+            return (self.received, self.invoked, self.received - self.invoked - pending)
+
+    @property
+    def pending(self):
+        with self.__lock:
+            return self.__payload is not None
+
+    def flush(self):
+        """Call the handler right away with the latest payload, if any."""
+        with self.__lock:
+            if self.__timer:
+                self.__timer.cancel()
+                self.__timer = None
+            if self.__payload is None:
+                return
+            args, kwargs = self.__payload
+            self.__payload = None
+            self.invoked += 1
+
+        # Flushing can happen on any thread, like when unloading, so restore whatever was there.
+        context = minqlbot.COMMAND_QUEUE.context
+        previous = getattr(context, "plugin", None)
+        context.plugin = self.plugin
+        try:
+            self.handler(*args, **kwargs)
+        except:
+            log_handler_exception(self.handler, self.plugin)
+        finally:
+            context.plugin = previous
+
+    def cancel(self):
+        """Drop the pending payload without calling the handler."""
+        with self.__lock:
+            if self.__timer:
+                self.__timer.cancel()
+                self.__timer = None
+            self.__payload = None
+
+# Export the class.
+setattr(minqlbot, "CoalescedHandler", CoalescedHandler)
+
+def log_handler_exception(handler, plugin):
+    handler_errors.inc(plugin)
+    minqlbot.LOG.exception("========== ERROR: {}@{} ==========", handler.__name__, plugin)
+
 class EventHandler:
     """An event handler, allowing functions to "hook" any events.
 
@@ -446,37 +970,62 @@ class EventHandler:
     def __init__(self, name):
         self.name = name
         self.plugins = {}
+        self.lazy = {} # Plugin name -> LazyPlugin waiting for this event.
     
     def trigger(self, *args, **kwargs):
         """Registered hooks for this event are called from highest to lowest priority.
         
         """
 
-        if minqlbot.IS_DEBUG and self.name not in EventHandler.no_debug:
-            minqlbot.debug("{}{}".format(self.name, args))
+        if self.name not in EventHandler.no_debug:
+            debug("{}{}", self.name, args, only_debug=True)
+        event_count.inc(self.name)
+
+        # Lazy plugins get to hook the event before it's dispatched, so that their hooks
+        # are called at their own priorities like everyone else's.
+        if self.lazy:
+            for lazy in list(self.lazy.values()):
+                lazy.activate()
+
+        return self.dispatch(self.plugins.copy(), *args, **kwargs)
+
+    def dispatch(self, plugins, *args, **kwargs):
+        """Call the hooks of the given plugins, from highest to lowest priority. Returns
+        RET_STOP if a hook stopped the event.
 
-        plugins = self.plugins.copy()
+        """
+        # Let the command scheduler know which plugin is sending commands.
+        context = minqlbot.COMMAND_QUEUE.context
+        previous = getattr(context, "plugin", None)
         for i in range(5):
             for plugin in plugins:
                 for handler in plugins[plugin][i]:
                     try:
-                        retval = handler(*args, **kwargs)
-                        if retval == minqlbot.RET_NONE or retval == None:
-                            continue
-                        elif retval == minqlbot.RET_STOP:
-                            return
+                        context.plugin = plugin
+                        if profiler.active:
+                            retval = profiler.call(plugin, self.name, handler, *args, **kwargs)
                         else:
-                            debug("{}: unexpected return value '{}'".format(self.name, retval))
+                            retval = handler(*args, **kwargs)
                     except:
-                        e = traceback.format_exc().rstrip("\n")
-                        debug("========== ERROR: {}@{} ==========".format(handler.__name__, plugin))
-                        for line in e.split("\n"):
-                            debug(line)
+                        log_handler_exception(handler, plugin)
+                        continue
+                    finally:
+                        context.plugin = previous
+
+                    if retval == minqlbot.RET_NONE or retval == None:
                         continue
+                    elif retval == minqlbot.RET_STOP:
+                        return minqlbot.RET_STOP
+                    else:
+                        debug("{}: unexpected return value '{}'".format(self.name, retval))
                     
     
-    def add_hook(self, plugin, handler, priority=minqlbot.PRI_NORMAL):
+    def add_hook(self, plugin, handler, priority=minqlbot.PRI_NORMAL, coalesce=minqlbot.COALESCE_NONE, window=100):
         """Add a single hook.
+
+        If 'coalesce' is COALESCE_LATEST or COALESCE_BURST, the handler is wrapped in a
+        CoalescedHandler with a window of 'window' milliseconds, and is called from a
+        timer thread.
         
         """
         if not (priority >= minqlbot.PRI_HIGHEST and priority <= minqlbot.PRI_LOWEST):
@@ -490,9 +1039,12 @@ class EventHandler:
             # Check if we've already registered this handler.
             for i in range(len(self.plugins[plugin])):
                 for hook in self.plugins[plugin][i]:
-                    if handler == hook:
+                    if hook == handler:
                         raise EventHandlerError("Plugin '{}' attempted to hook an already hooked event, '{}'."
                             .format(plugin, self.name))
+
+        if coalesce != minqlbot.COALESCE_NONE:
+            handler = CoalescedHandler(plugin, handler, coalesce, window)
         
         self.plugins[plugin][priority].append(handler)
         
@@ -501,13 +1053,32 @@ class EventHandler:
         
         """
         for hook in self.plugins[plugin][priority]:
-            if handler == hook:
-                self.plugins[plugin][priority].remove(handler)
+            if hook == handler:
+                if isinstance(hook, CoalescedHandler):
+                    hook.cancel()
+                self.plugins[plugin][priority].remove(hook)
                 return
         
         raise EventHandlerError("Plugin '{}' attempted to remove a hook from '{}', an unhooked event."
                             .format(plugin, self.name))
 
+    def coalesce_stats(self):
+        """Get the number of received payloads and actual calls of coalesced hooks.
+
+        Returns:
+            A dictionary with (plugin, handler name) as keys and (received, invoked, saved)
+            tuples as values.
+
+        """
+        res = {}
+        for plugin in self.plugins.copy():
+            for priority_level in self.plugins[plugin]:
+                for hook in priority_level:
+                    if isinstance(hook, CoalescedHandler):
+                        res[(plugin, hook.__name__)] = hook.stats()
+
+        return res
+
 # Export the class.
 setattr(minqlbot, "EventHandler", EventHandler)
 
@@ -560,6 +1131,9 @@ class ChatEventHandler(EventHandler):
         super().__init__("chat")
     
     def trigger(self, player, msg, channel):
+        trace = getattr(minqlbot.COMMAND_QUEUE.context, "trace", None)
+        if trace:
+            trace.parse()
         super().trigger(player, msg, channel)
         commands.handle_input(player, msg, channel)
 
@@ -658,8 +1232,12 @@ class VoteEndedEventHandler(EventHandler):
             return
 
         res = re_vote.match(cs)
-        vote = res.group("vote")
-        args = res.group("args")
+        if res:
+            vote = res.group("vote")
+            args = res.group("args")
+        else: # Votes without arguments, like "shuffle".
+            vote = cs
+            args = None
         votes = (int(minqlbot.get_configstring(10)), int(minqlbot.get_configstring(11)))
         # Return None if the vote's cancelled (like if the round starts before vote's over).
         super().trigger(votes, vote, args, None)
@@ -773,37 +1351,543 @@ event_handlers.add_handler("abort",             AbortEventHandler())
 # Export event handler dictionary.
 setattr(minqlbot, "EVENT_HANDLERS", event_handlers)
 
+# ====================================================================
+#                              TRACING
+# ====================================================================
+
+class LatencyHistogram:
+    """A histogram of latencies with fixed buckets in milliseconds.
+
+    """
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1) # Last one is for anything above.
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        i = 0
+        for bound in self.BUCKETS:
+            if ms <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """Get the upper bound of the bucket the p-th percentile falls in."""
+        if not self.count:
+            return 0.0
+        target = self.count * p / 100
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target:
+                return self.BUCKETS[i] if i < len(self.BUCKETS) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count, "mean": self.mean, "max": self.max,
+            "p50": self.percentile(50), "p95": self.percentile(95),
+            "buckets": list(zip(list(self.BUCKETS) + ["inf"], self.counts))}
+
+class LatencyTracer:
+    """Keeps latency histograms per command, broken down into stages:
+        - parse: From receiving the server command until the chat event triggers.
+        - dispatch: Chat hooks, command lookup and checks until the command's handler is called.
+        - handler: The command's handler itself.
+        - queue: From a reply being queued until it's passed on to the native queue.
+        - total: From receiving the server command until the first reply is passed on.
+
+    Replies are held by the reply packer for a short while before they're queued, which
+    shows up in the total, but not in the queue stage. Also note that the native queue can
+    still hold a reply for up to 600 ms after it's been passed on.
+
+    """
+    STAGES = ("parse", "dispatch", "handler", "queue", "total")
+
+    def __init__(self):
+        self.histograms = {}
+        self.__lock = threading.Lock()
+
+    def record(self, name, stage, seconds):
+        with self.__lock:
+            if name not in self.histograms:
+                self.histograms[name] = dict((s, LatencyHistogram()) for s in self.STAGES)
+            self.histograms[name][stage].add(seconds * 1000)
+
+    def reset(self):
+        with self.__lock:
+            self.histograms.clear()
+
+    def to_dict(self):
+        with self.__lock:
+            return dict((name, dict((stage, h.to_dict()) for stage, h in stages.items()))
+                for name, stages in self.histograms.items())
+
+    def report(self):
+        """Get a list of lines with the mean/p95 of every stage in milliseconds per command."""
+        lines = ["{:<12} {:>5} {:>13} {:>13} {:>13} {:>13} {:>13}".format("command", "count", *self.STAGES)]
+        with self.__lock:
+            for name in sorted(self.histograms):
+                stages = self.histograms[name]
+                cols = ["{:.1f}/{:.0f}".format(stages[s].mean, stages[s].percentile(95)) for s in self.STAGES]
+                lines.append("{:<12} {:>5} {:>13} {:>13} {:>13} {:>13} {:>13}"
+                    .format(name, stages["handler"].count, *cols))
+        return lines
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+tracer = LatencyTracer()
+setattr(minqlbot, "LATENCY_TRACER", tracer)
+
+class Trace:
+    """Timestamps of a single server command on its way to a reply. An instance is
+    created for every server command and is carried along through the dispatch context
+    of minqlbot.COMMAND_QUEUE, so that replies sent because of it can be traced back.
+
+    """
+    def __init__(self):
+        self.received = time.perf_counter()
+        self.name = None
+        self.parsed = None
+        self.dispatched = None
+        self.replied = False
+
+    def parse(self):
+        self.parsed = time.perf_counter()
+
+    def dispatch(self):
+        first = self.dispatched is None
+        self.dispatched = time.perf_counter()
+        if first and self.parsed is not None:
+            tracer.record(self.name, "parse", self.parsed - self.received)
+            tracer.record(self.name, "dispatch", self.dispatched - self.parsed)
+
+    def handle(self):
+        if self.dispatched is not None:
+            tracer.record(self.name, "handler", time.perf_counter() - self.dispatched)
+
+    def sent(self, qcmd):
+        """Called by the command scheduler when a command is passed on to the native queue."""
+        if self.name is None:
+            return
+        tracer.record(self.name, "queue", qcmd.dequeued - qcmd.queued)
+        if not self.replied:
+            self.replied = True
+            tracer.record(self.name, "total", qcmd.dequeued - self.received)
+
+# Export the class.
+setattr(minqlbot, "Trace", Trace)
+
+# ====================================================================
+#                              PROFILING
+# ====================================================================
+
+class DispatchProfiler:
+    """Runs cProfile on the dispatch path for a limited time window.
+
+    Without a target, every message is profiled from handle_message down to the hooks.
+    With an event, command or plugin name as target, only the handlers that match are.
+    Either way, the wall time of every handler is added up per plugin.
+
+    The profiler is only ever enabled and disabled on the thread doing the dispatching,
+    since cProfile only profiles the thread that enabled it. A lock keeps the report from
+    being written halfway through a message. Dispatching can nest, like when a handler
+    triggers another event, so the lock is reentrant and the depth is kept per thread,
+    with only the outermost call enabling and disabling the profile.
+
+    """
+    def __init__(self):
+        self.active = False
+        self.target = None
+        self.profile = None
+        self.plugin_times = {}
+        self.callbacks = []
+        self.__lock = threading.RLock()
+        self.__local = threading.local()
+
+    def start(self, seconds, target=None, callback=None):
+        """Profile for 'seconds' seconds. When done, the report is written and 'callback',
+        if given, is called with the path of the report.
+
+        Returns:
+            False if a profile is already running, True otherwise.
+
+        """
+        with self.__lock:
+            if self.active:
+                return False
+            self.target = target
+            self.profile = cProfile.Profile()
+            self.plugin_times = {}
+            self.callbacks = [callback] if callback else []
+            self.active = True
+
+        timer = threading.Timer(seconds, self.stop)
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def stop(self):
+        with self.__lock:
+            if not self.active:
+                return
+            self.active = False
+            path = self.write_report()
+
+        for callback in self.callbacks:
+            callback(path)
+
+    def enable(self):
+        """Called at the start of a message. Only profiles if there's no target.
+
+        Returns:
+            True if it did, in which case disable() has to be called at the end.
+
+        """
+        return self.target is None and self.__enter()
+
+    def disable(self):
+        self.__exit()
+
+    def __enter(self):
+        self.__lock.acquire()
+        depth = getattr(self.__local, "depth", 0)
+        # Nested calls hold the lock already, so stop() can't have happened in between.
+        if not depth and not self.active:
+            self.__lock.release()
+            return False
+        self.__local.depth = depth + 1
+        if not depth:
+            self.profile.enable()
+        return True
+
+    def __exit(self):
+        self.__local.depth -= 1
+        if not self.__local.depth:
+            self.profile.disable()
+        self.__lock.release()
+
+    def call(self, plugin, name, handler, *args, **kwargs):
+        """Call a handler while timing it, and profile it too if it matches the target."""
+        targeted = self.target is not None and self.target in (plugin, name)
+        if targeted and not self.__enter():
+            return handler(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            if targeted:
+                self.__exit()
+            key = (plugin, name)
+            calls, total = self.plugin_times.get(key, (0, 0.0))
+            self.plugin_times[key] = (calls + 1, total + elapsed)
+
+    def report(self, limit=40):
+        """Get the report as a string, with the time per plugin followed by the cProfile stats."""
+        out = io.StringIO()
+        out.write("Target: {}\n\n".format(self.target or "everything"))
+        plugins = {}
+        for (plugin, name), (calls, total) in self.plugin_times.items():
+            plugins.setdefault(plugin, []).append((total, calls, name))
+        out.write("{:<24} {:<24} {:>8} {:>12}\n".format("plugin", "event/command", "calls", "total ms"))
+        for plugin in sorted(plugins, key=lambda p: sum(t[0] for t in plugins[p]), reverse=True):
+            for total, calls, name in sorted(plugins[plugin], reverse=True):
+                out.write("{:<24} {:<24} {:>8} {:>12.2f}\n".format(plugin, name, calls, total * 1000))
+
+        out.write("\n")
+        try:
+            stats = pstats.Stats(self.profile, stream=out)
+            stats.sort_stats("cumulative").print_stats(limit)
+        except TypeError: # Nothing was profiled.
+            out.write("No calls were profiled.\n")
+        return out.getvalue()
+
+    def write_report(self):
+        """Write the report and the raw pstats file next to the database.
+
+        Returns:
+            The path of the report.
+
+        """
+        base = core_file_path("profile-{}".format(time.strftime("%Y%m%d-%H%M%S")))
+        with open(base + ".txt", "w") as f:
+            f.write(self.report())
+        try:
+            self.profile.dump_stats(base + ".pstats")
+        except TypeError:
+            pass
+        return base + ".txt"
+
+profiler = DispatchProfiler()
+setattr(minqlbot, "DispatchProfiler", DispatchProfiler)
+setattr(minqlbot, "PROFILER", profiler)
+
+class MemoryTracker:
+    """Attributes memory to plugins with tracemalloc, and checks that unloaded plugins
+    actually get collected.
+
+    While started, a snapshot is taken every 'interval' seconds and an allocation counts
+    towards a plugin if any frame of its traceback is in the plugin's module file. Growth is
+    reported both since the first snapshot and since the one before the latest.
+
+    Only the sizes per plugin and per line of the plugins' files are kept from a snapshot,
+    not the snapshot itself, since a full one can take up as much memory as the bot.
+
+    Leak checks don't need tracemalloc. unload_plugin() hands the instance over, and a few
+    seconds later it's reported if a weak reference to it is still alive after collecting.
+    Stopping doesn't cancel pending checks, so the plugins of a restart get checked too.
+
+    """
+    FRAMES = 10
+    LEAK_CHECK_DELAY = 5
+
+    def __init__(self):
+        self.interval = 300
+        self.baseline = None
+        self.previous = None
+        self.latest = None
+        self.leaks = []
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__pending = [] # (name, weakref) of unloaded plugins waiting for a check.
+        self.__timer = None
+
+    @property
+    def active(self):
+        return self.__thread is not None
+
+    def start(self, interval=None):
+        if self.active:
+            return False
+        if interval:
+            self.interval = interval
+        tracemalloc.start(self.FRAMES)
+        self.baseline = self.previous = self.latest = None
+        self.snapshot()
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, name="minqlbot memory tracker")
+        self.__thread.daemon = True
+        self.__thread.start()
+        return True
+
+    def stop(self):
+        """Stop taking snapshots and tracing allocations."""
+        if not self.active:
+            return False
+        self.__stop.set()
+        self.__thread.join()
+        self.__thread = None
+        tracemalloc.stop()
+        return True
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            try:
+                self.snapshot()
+            except:
+                minqlbot.LOG.exception("MemoryTracker: Failed to take a snapshot.")
+
+    @staticmethod
+    def plugin_files():
+        """Get a dictionary with the module files of the loaded plugins as keys and their names as values."""
+        files = {}
+        for name in minqlbot.Plugin._Plugin__loaded_plugins:
+            module = sys.modules.get("plugins." + name)
+            if getattr(module, "__file__", None):
+                files[os.path.normcase(os.path.abspath(module.__file__))] = name
+        return files
+
+    def snapshot(self):
+        """Take a snapshot and return the bytes per plugin."""
+        files = self.plugin_files()
+        sizes = dict((name, 0) for name in files.values())
+        lines = dict((name, {}) for name in files.values()) # Bytes per line of the plugin's file.
+        # Identical tracebacks are grouped, so this goes through far fewer than every trace.
+        for stat in tracemalloc.take_snapshot().statistics("traceback"):
+            for frame in stat.traceback:
+                name = files.get(os.path.normcase(os.path.abspath(frame.filename)))
+                if name:
+                    sizes[name] += stat.size
+                    key = (os.path.basename(frame.filename), frame.lineno)
+                    lines[name][key] = lines[name].get(key, 0) + stat.size
+                    break
+
+        with self.__lock:
+            self.previous = self.latest
+            self.latest = (time.time(), sizes, lines)
+            if self.baseline is None:
+                self.baseline = (self.latest[0], sizes)
+        return sizes
+
+    def report(self, lines_per_plugin=3):
+        """Get a list of lines with the size and growth of every plugin, biggest growth first,
+        along with the lines that grew the most since the previous snapshot."""
+        with self.__lock:
+            if not self.latest:
+                return []
+            now, sizes, lines = self.latest
+            base = self.baseline[1]
+            prev = self.previous
+
+        res = []
+        growth = lambda name: sizes[name] - base.get(name, 0)
+        for name in sorted(sizes, key=growth, reverse=True):
+            line = "{}: {:.1f} KiB, {:+.1f} KiB since {:.0f} min ago".format(name, sizes[name] / 1024,
+                growth(name) / 1024, (now - self.baseline[0]) / 60)
+            if prev:
+                line += ", {:+.1f} KiB since the last snapshot".format((sizes[name] - prev[1].get(name, 0)) / 1024)
+            res.append(line)
+
+            if prev and lines_per_plugin:
+                now_lines, prev_lines = lines.get(name, {}), prev[2].get(name, {})
+                diff = [(size - prev_lines.get(key, 0), key) for key, size in now_lines.items()]
+                for size_diff, (filename, lineno) in sorted([d for d in diff if d[0] > 0], reverse=True)[:lines_per_plugin]:
+                    res.append("    {}:{}: {:+.1f} KiB".format(filename, lineno, size_diff / 1024))
+
+        return res
+
+    def check_collected(self, name, instance):
+        """Report the instance of an unloaded plugin if it's still around after a while."""
+        try:
+            ref = weakref.ref(instance)
+        except TypeError:
+            return
+        with self.__lock:
+            self.__pending.append((name, ref))
+            if not self.__timer:
+                self.__timer = threading.Timer(self.LEAK_CHECK_DELAY, self.__check_leaks)
+                self.__timer.daemon = True
+                self.__timer.start()
+
+    def __check_leaks(self):
+        with self.__lock:
+            pending = self.__pending
+            self.__pending = []
+            self.__timer = None
+        if not pending:
+            return
+
+        gc.collect()
+        for name, ref in pending:
+            instance = ref()
+            if instance is None:
+                continue
+            referrers = set(type(r).__name__ for r in gc.get_referrers(instance))
+            self.leaks.append(name)
+            debug("[MEMORY] Plugin '{}' was unloaded, but its instance is still referenced by: {}",
+                name, ", ".join(sorted(referrers)))
+            del instance
+
+memory_tracker = MemoryTracker()
+setattr(minqlbot, "MemoryTracker", MemoryTracker)
+setattr(minqlbot, "MEMORY_TRACKER", memory_tracker)
+
 # ====================================================================
 #                              PARSER    
 # ====================================================================
 
-re_chat = re.compile(r'"(?P<id>..) (?:(?P<clan>[^ \x19]+?) )?(?P<name>[^\x19]+?)..\x19: ..(?P<msg>.+)"')
-re_tchat = re.compile(r'"(?P<id>..) \x19\((?:(?P<clan>[^ ]+?) )?(?P<name>.+?)..\x19\)(?: \(.+?\))?\x19: ..(?P<msg>.+)"')
-re_tell = re.compile(r'"(?P<id>..) \x19\[(?:(?P<clan>[^ ]+?) )?(?P<name>.+?)\^7\x19\](?: \(.+?\))?\x19: ..(?P<msg>.+)"')
-re_connect = re.compile(r'^print "(?P<name>.+) connected')
-re_disconnect = re.compile(r'^print "(?P<name>.+) disconnected')
-re_round_start = re.compile(r'^cs 661 "(?P<cvars>.+)"')
-re_round_end = re.compile(r'^cs (?P<team>6|7) "(?P<score>.+)"')
-re_game_change = re.compile(r'^cs 0 "(?P<cvars>.*)"')
-re_game_end = re.compile(r'^cs 14 "(?P<value>.+)"')
-re_abort = re.compile(r'^pcp "(?:(?P<clan>[^ ]+?) )?(?P<name>.+?) has aborted the match"')
-re_kick = re.compile(r'^print "(?P<name>.+) was kicked')
-re_ragequit = re.compile(r'^print "(?P<name>.+) \^1rage\^7quits')
-re_timeout = re.compile(r'^print "(?P<name>.+) timed out')
-re_vote_called = re.compile(r'^print "(?P<name>.+) called a vote.')
-re_vote_called_ex = re.compile(r'^cs 9 "(?P<vote>.+) "*(?P<args>.*?)"*"')
-re_voted = re.compile(r'^cs (?P<code>10|11) "(?P<count>.*)"')
-re_vote_ended = re.compile(r'^print "Vote (?P<result>passed|failed).')
-re_player_change = re.compile(r'^cs 5(?P<id>[2-5][0-9]) "(?P<cvars>.*)"')
-re_scores_ca = re.compile(r'^scores_ca (?P<total_players>.+?) (?P<red_score>.+?) (?P<blue_score>.+?) (?P<scores>.+)')
-re_castats = re.compile(r'^castats (?P<stats>.+)')
-re_scores_race = re.compile(r'^scores_race (?P<total_players>.+?) (?P<scores>.+)')
+# The chat patterns aren't used by the parser anymore, since parse_chat() does the same in
+# one pass, but tests/test_parse_chat.py checks that the two still agree.
+re_chat = LazyPattern(r'"(?P<id>..) (?:(?P<clan>[^ \x19]+?) )?(?P<name>[^\x19]+?)..\x19: ..(?P<msg>.+)"')
+re_tchat = LazyPattern(r'"(?P<id>..) \x19\((?:(?P<clan>[^ ]+?) )?(?P<name>.+?)..\x19\)(?: \(.+?\))?\x19: ..(?P<msg>.+)"')
+re_tell = LazyPattern(r'"(?P<id>..) \x19\[(?:(?P<clan>[^ ]+?) )?(?P<name>.+?)\^7\x19\](?: \(.+?\))?\x19: ..(?P<msg>.+)"')
+re_connect = LazyPattern(r'^print "(?P<name>.+) connected')
+re_disconnect = LazyPattern(r'^print "(?P<name>.+) disconnected')
+re_round_start = LazyPattern(r'^cs 661 "(?P<cvars>.+)"')
+re_round_end = LazyPattern(r'^cs (?P<team>6|7) "(?P<score>.+)"')
+re_game_change = LazyPattern(r'^cs 0 "(?P<cvars>.*)"')
+re_game_end = LazyPattern(r'^cs 14 "(?P<value>.+)"')
+re_abort = LazyPattern(r'^pcp "(?:(?P<clan>[^ ]+?) )?(?P<name>.+?) has aborted the match"')
+re_kick = LazyPattern(r'^print "(?P<name>.+) was kicked')
+re_ragequit = LazyPattern(r'^print "(?P<name>.+) \^1rage\^7quits')
+re_timeout = LazyPattern(r'^print "(?P<name>.+) timed out')
+re_vote_called = LazyPattern(r'^print "(?P<name>.+) called a vote.')
+re_vote_called_ex = LazyPattern(r'^cs 9 "(?P<vote>.+) "*(?P<args>.*?)"*"')
+re_voted = LazyPattern(r'^cs (?P<code>10|11) "(?P<count>.*)"')
+re_vote_ended = LazyPattern(r'^print "Vote (?P<result>passed|failed).')
+re_player_change = LazyPattern(r'^cs 5(?P<id>[2-5][0-9]) "(?P<cvars>.*)"')
+re_scores_ca = LazyPattern(r'^scores_ca (?P<total_players>.+?) (?P<red_score>.+?) (?P<blue_score>.+?) (?P<scores>.+)')
+re_castats = LazyPattern(r'^castats (?P<stats>.+)')
+re_scores_race = LazyPattern(r'^scores_race (?P<total_players>.+?) (?P<scores>.+)')
+
+def parse_chat(cmd, payload):
+    """Split the payload of a chat or tchat command into its parts, in a single pass.
+
+    Names can't contain \\x19, so the first "\\x19: " always ends the header, no matter
+    what the name or message look like. Unlike re_chat, re_tchat and re_tell, this never
+    backtracks, so crafted names and messages can't make it slow or misattribute lines.
+
+    Returns:
+        An (id, clan, name, msg, mode) tuple, where mode is the name of the channel the
+        line came from: "chat", "team_chat" or "tell". None if it's not a chat line.
+
+    """
+    end = payload.rfind('"')
+    if end < 5 or payload[0] != '"' or payload[3] != " ":
+        return None
+    sep = payload.find("\x19: ", 4, end)
+    # The color of the message and at least one character of it.
+    if sep == -1 or sep + 5 >= end:
+        return None
+    header = payload[4:sep]
+
+    if cmd == "tchat":
+        mode, opening, closing = "team_chat", "\x19(", "\x19)"
+    elif cmd == "chat" and header.startswith("\x19["):
+        mode, opening, closing = "tell", "\x19[", "\x19]"
+    elif cmd == "chat":
+        mode = "chat"
+    else:
+        return None
+
+    if mode == "chat":
+        # The name is followed by its color reset, which we leave out.
+        names = header[:-2]
+        if not names or "\x19" in names:
+            return None
+    else:
+        if not header.startswith(opening):
+            return None
+        close = header.find("\x19", 2)
+        if close == -1 or not header.startswith(closing, close):
+            return None
+        names = header[2:close]
+        if len(names) < 3 or (mode == "tell" and not names.endswith("^7")):
+            return None
+        names = names[:-2]
+        # The location, which the server only adds for team chat and tells.
+        location = header[close + 2:]
+        if location and (len(location) < 4 or not location.startswith(" (") or not location.endswith(")")):
+            return None
+
+    space = names.find(" ")
+    if space > 0 and space < len(names) - 1:
+        clan, name = names[:space], names[space + 1:]
+    else:
+        clan, name = None, names
+
+    return payload[1:3], clan, name, payload[sep + 5:end], mode
 
 # bcs0 is a special case, as it's a configstring that's too big, so it's split into several parts.
 # bcs0 indicates we start an incomplete configstring, bcs1 means we add it to the
 # previous bcs0 or bcs1 string, bcs2 means the complete string has been sent.
 # In our case, we'll wait until bcs2 has arrived and resend the whole cs to the handler as a normal cs.
-re_bcs = re.compile(r'bcs(?P<mode>.) (?P<index>.*) "(?P<cvars>.*)"')
+re_bcs = LazyPattern(r'bcs(?P<mode>.) (?P<index>.*) "(?P<cvars>.*)"')
 bcs_buffer = {} # Dict because we could possibly receive several bcs' simultaneously.
 
 # Post-game stats are sent as separate commands, as opposed to regular scores, so we use a buffer
@@ -815,34 +1899,21 @@ castats_order = []
 
 def parse(cmdstr):
     """Parses server commands or gamestates"""
+    global castats_buffer
     cmd = cmdstr.split(" ", 1)
-    if cmd[0] == "chat":
-        rm = re_chat.match(cmd[1])
-        if rm:
+    if cmd[0] == "chat" or cmd[0] == "tchat":
+        line = parse_chat(cmd[0], cmd[1]) if len(cmd) > 1 else None
+        if line:
             # I tested the client ID passed through this command several times, and sooner
             # or later, it starts sending incorrect data. This applies for chat, tchat and tell.
-            #cid = int(rm.group(1))
-            player = get_player(rm.group("name"))
-            msg = rm.group("msg")
-            channel = minqlbot.CHAT_CHANNEL # Use static channel
-            event_handlers["chat"].trigger(player, msg, channel)
-            return
-        else: # Check if it's \tell
-            rm = re_tell.match(cmd[1])
-            if rm:
-                #cid = int(rm.group(1))
-                player = get_player(rm.group("name"))
-                msg = rm.group("msg")
+            cid, clan, name, msg, mode = line
+            player = get_player(name)
+            if mode == "tell":
                 channel = TellChannel(player)
-                event_handlers["chat"].trigger(player, msg, channel) 
-                return
-    elif cmd[0] == "tchat": # Team chat.
-        rm = re_tchat.match(cmd[1])
-        if rm:
-            #cid = int(rm.group(1))
-            player = get_player(rm.group("name"))
-            msg = rm.group("msg")
-            channel = minqlbot.TEAM_CHAT_CHANNEL # Use static channel
+            elif mode == "team_chat":
+                channel = minqlbot.TEAM_CHAT_CHANNEL # Use static channel
+            else:
+                channel = minqlbot.CHAT_CHANNEL # Use static channel
             event_handlers["chat"].trigger(player, msg, channel)
             return
     
@@ -859,7 +1930,8 @@ def parse(cmdstr):
         elif channel == 2:
             full_cs = bcs_buffer[index] + cvars
             del bcs_buffer[index]
-            handle_message('cs {} "{}"'.format(index, full_cs))
+            # The plugin host puts it together itself, so it doesn't need to get it.
+            handle_message('cs {} "{}"'.format(index, full_cs), forward=False)
         return
 
     # player_connect
@@ -1041,7 +2113,6 @@ def parse(cmdstr):
     # scores_ca
     res = re_scores_ca.match(cmdstr)
     if res:
-        global castats_order
         total_players = int(res.group("total_players"))
         raw_scores = [int(i) for i in res.group("scores").split()]
         scores = []
@@ -1055,7 +2126,6 @@ def parse(cmdstr):
     # castats
     res = re_castats.match(cmdstr)
     if res:
-        global castats_buffer, castats_order
         raw_stats = [int(i) for i in res.group("stats").split()]
         cid = castats_order[0]
         del castats_order[0]
@@ -1093,19 +2163,67 @@ class PluginError(Exception):
 
 config = configparser.ConfigParser()
 
-def load_config():
-    config_file = "python\\config.cfg"
+def load_config(config_file="python\\config.cfg"):
     if os.path.isfile(config_file):
         config.read(config_file)
         config["DEFAULT"] = { 
-                                "PluginsFolder" : "python\\plugins",
-                                "DatabasePath"  : "python\\minqlbot.db",
-                                "CommandPrefix" : "!"
+                                "PluginsFolder"       : "python\\plugins",
+                                "DatabasePath"        : "python\\minqlbot.db",
+                                "CommandPrefix"       : "!",
+                                "PermissionCacheTTL"  : "300",
+                                "PermissionCacheSize" : "512",
+                                "FloodRate"           : "1",
+                                "FloodBurst"          : "5",
+                                "FloodCommandRate"    : "0",
+                                "FloodCommandBurst"   : "3",
+                                "FloodExemptLevel"    : "5",
+                                "PluginImportThreads" : "4",
+                                "MetricsInterval"     : "60",
+                                "LogLevel"            : "debug" if minqlbot.IS_DEBUG else "info",
+                                "LogFile"             : "",
+                                "PackReplies"         : "",
+                                "MatchHistory"        : "off",
+                                "PluginHost"          : "",
+                                "StateService"        : ""
                             }
 
         sys.path.append(os.path.dirname(config["Core"]["PluginsFolder"]))
         setattr(minqlbot, "NAME", config["Core"]["Nickname"].strip())
         setattr(minqlbot, "COMMAND_PREFIX", config["Core"]["CommandPrefix"].strip())
+        minqlbot.PERMISSION_CACHE.ttl = config["Core"].getfloat("PermissionCacheTTL")
+        minqlbot.PERMISSION_CACHE.size = config["Core"].getint("PermissionCacheSize")
+        minqlbot.PERMISSION_CACHE.invalidate()
+        flood = commands.flood_control
+        flood.rate = config["Core"].getfloat("FloodRate")
+        flood.burst = config["Core"].getint("FloodBurst")
+        flood.command_rate = config["Core"].getfloat("FloodCommandRate")
+        flood.command_burst = config["Core"].getint("FloodCommandBurst")
+        flood.exempt_level = config["Core"].getint("FloodExemptLevel")
+        flood.reset()
+        match_history.enable(config["Core"].getboolean("MatchHistory"))
+        reply_packer.channels = set(c.strip() for c in config["Core"]["PackReplies"].split(",") if c.strip())
+        level = config["Core"]["LogLevel"].strip().upper()
+        log_levels = dict((v, k) for k, v in minqlbot.LOG.LEVEL_NAMES.items())
+        if level in log_levels:
+            minqlbot.LOG.level = log_levels[level]
+        else:
+            debug("Unknown LogLevel '{}'. Valid levels are: {}", level, ", ".join(sorted(log_levels)))
+        log_file = config["Core"]["LogFile"].strip()
+        minqlbot.LOG.path = core_file_path(log_file) if log_file else None
+        interval = config["Core"].getfloat("MetricsInterval")
+        if interval > 0:
+            minqlbot.METRICS.start_exporter(core_file_path("metrics"), interval)
+        else:
+            minqlbot.METRICS.stop_exporter()
+        try:
+            plugin_bridge.configure(config["Core"]["PluginHost"].strip())
+        except (OSError, ValueError) as e:
+            debug("ERROR: Couldn't listen for a plugin host on '{}': {}", config["Core"]["PluginHost"], e)
+        try:
+            minqlbot.STATE_CLIENT.configure(config["Core"]["StateService"].strip(),
+                config["Core"]["DatabasePath"])
+        except ValueError as e:
+            debug("ERROR: Couldn't use the state service at '{}': {}", config["Core"]["StateService"], e)
     else:
         raise(PluginError("Config file '{}' not found.".format(config_file)))
 
@@ -1115,36 +2233,103 @@ def reload_config():
 def get_config():
     return config
 
+# Plugin name -> dictionary with the time in seconds it took to import and instantiate
+# the plugin, and whether or not it's waiting for lazy activation.
+plugin_times = {}
+# Plugin name -> hash of its source file when it was loaded. See reload_changed_plugins().
+plugin_hashes = {}
+
 def load_preset_plugins():
     if os.path.isdir(config["Core"]["PluginsFolder"]):
-        for plugin in config["Core"]["Plugins"].split(","):
-            load_plugin(plugin.strip())
+        start = time.perf_counter()
+        names = [p.strip() for p in config["Core"]["Plugins"].split(",") if p.strip()]
+        import_plugins(names, config["Core"].getint("PluginImportThreads"))
+        # Instantiate in the configured order, since it decides the order of hooks and commands.
+        for plugin in names:
+            load_plugin(plugin)
+        ensure_core_indexes()
+        debug("Loaded {} plugins in {:.0f} ms.".format(len(names), (time.perf_counter() - start) * 1000))
     else:
         raise(PluginError("Cannot find the plugins folder."))
 
+# Plugin name -> exception raised when import_plugins imported it, for load_plugin to raise.
+import_errors = {}
+
+def import_plugins(names, threads=4):
+    """Import plugin modules in parallel, but leave instantiating them to load_plugin.
+
+    Python holds a lock per module while importing it, so importing different plugins at
+    the same time is safe, but a plugin's module-level code runs on a worker thread. When
+    an import fails, the exception is kept for load_plugin to raise instead of running the
+    module a second time.
+
+    """
+    if threads < 2 or len(names) < 2:
+        return
+
+    importlib.import_module("plugins") # Make sure the threads don't race for the package.
+    def run(plugin):
+        start = time.perf_counter()
+        try:
+            importlib.import_module("plugins." + plugin)
+        except Exception as e:
+            import_errors[plugin] = e
+            return
+        plugin_times[plugin] = {"import": time.perf_counter() - start, "init": 0.0, "lazy": False}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(threads, len(names))) as executor:
+        for plugin in names:
+            if "plugins." + plugin not in sys.modules:
+                executor.submit(run, plugin)
+
 def load_plugin(plugin):
     debug("Loading plugin '{}'...".format(plugin))
     plugins = minqlbot.Plugin._Plugin__loaded_plugins
     if plugin in plugins:
         return reload_plugin(plugin)
     try:
-        module = importlib.import_module("plugins." + plugin)
+        if plugin in import_errors:
+            raise import_errors.pop(plugin)
+        times = plugin_times.get(plugin)
+        if not times or "plugins." + plugin not in sys.modules:
+            start = time.perf_counter()
+            module = importlib.import_module("plugins." + plugin)
+            times = {"import": time.perf_counter() - start, "init": 0.0, "lazy": False}
+            plugin_times[plugin] = times
+        else:
+            module = sys.modules["plugins." + plugin]
         plugin_class = getattr(module, plugin)
+        plugin_hashes[plugin] = plugin_source_hash(plugin)
         if issubclass(plugin_class, minqlbot.Plugin):
-            plugins[plugin] = plugin_class()
+            plugin_class.db_migrate(plugin)
+            if plugin_class.lazy_commands or plugin_class.lazy_events:
+                plugins[plugin] = LazyPlugin(plugin_class)
+                times["lazy"] = True
+            else:
+                start = time.perf_counter()
+                plugins[plugin] = plugin_class()
+                times["init"] = time.perf_counter() - start
         else:
             raise(PluginError("Attempted to load a plugin that is not a subclass of 'minqlbot.Plugin'."))
     except:
-        del sys.modules["plugins." + plugin]
+        plugin_times.pop(plugin, None)
+        plugin_hashes.pop(plugin, None)
+        sys.modules.pop("plugins." + plugin, None)
         raise
 
+# Seconds unload_plugin() waits for a plugin's queued writes.
+UNLOAD_FLUSH_TIMEOUT = 5
+
 def unload_plugin(plugin):
     debug("Unloading plugin '{}'...".format(plugin))
     plugins = minqlbot.Plugin._Plugin__loaded_plugins
     if plugin in plugins:
         event_handlers["unload"].trigger(plugin)
 
-        # Close DB connection if any.
+        # Make sure its queued writes are done, then close DB connection if any. A stuck
+        # database doesn't get to hang the unload, though.
+        if not plugins[plugin].db_flush(UNLOAD_FLUSH_TIMEOUT):
+            debug("WARNING: Queued writes of '{}' weren't done after {} seconds.", plugin, UNLOAD_FLUSH_TIMEOUT)
         plugins[plugin].db_close()
 
         # Unhook its hooks.
@@ -1154,9 +2339,15 @@ def unload_plugin(plugin):
         # Unregister commands.
         for cmd in plugins[plugin].commands:
             plugins[plugin].remove_command(cmd.name, cmd.handler)
+
+        if isinstance(plugins[plugin], LazyPlugin):
+            plugins[plugin].unregister()
             
+        memory_tracker.check_collected(plugin, plugins[plugin])
         del plugins[plugin]
         del sys.modules["plugins." + plugin]
+        plugin_times.pop(plugin, None)
+        plugin_hashes.pop(plugin, None)
     else:
         raise(PluginError("Attempted to unload a plugin that is not loaded."))
 
@@ -1164,46 +2355,647 @@ def reload_plugin(plugin):
     unload_plugin(plugin)
     load_plugin(plugin)
 
+def plugin_source_hash(plugin):
+    """Get the SHA-1 of a plugin's source file, or None if it can't be read.
+
+    """
+    module = sys.modules.get("plugins." + plugin)
+    path = getattr(module, "__file__", None) or os.path.join(config["Core"]["PluginsFolder"], plugin + ".py")
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return None
+
+def plugin_dependencies(plugin):
+    """Get the names of the loaded plugins a plugin's module imports, or imports
+    something from.
+
+    """
+    module = sys.modules.get("plugins." + plugin)
+    try:
+        with open(module.__file__, "rb") as f:
+            tree = ast.parse(f.read())
+    except (AttributeError, OSError, SyntaxError):
+        return set()
+
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            base = "plugins." + (node.module or "") if node.level else (node.module or "")
+            names.add(base)
+            # "from plugins import foo" imports the plugin foo.
+            names.update(base.rstrip(".") + "." + alias.name for alias in node.names)
+
+    loaded = minqlbot.Plugin._Plugin__loaded_plugins
+    return set(n[8:] for n in names if n.startswith("plugins.") and n[8:] in loaded and n[8:] != plugin)
+
+def reload_changed_plugins():
+    """Reload only the plugins whose source files changed since they were loaded, along
+    with the plugins that depend on them. Unlike a full restart, the configstring cache,
+    the database pools and everything else in the core are left alone.
+
+    Plugins are unloaded dependents first and loaded dependencies first.
+
+    Returns:
+        A tuple with a list of the reloaded plugins in the order they were loaded, a
+        dictionary with the plugins that failed to load as keys and the exceptions as values,
+        and the time it took in seconds.
+
+    """
+    start = time.perf_counter()
+    loaded = minqlbot.Plugin._Plugin__loaded_plugins
+    preset = [p.strip() for p in config["Core"]["Plugins"].split(",")]
+    names = sorted(loaded, key=lambda p: (preset.index(p) if p in preset else len(preset), p))
+    deps = dict((p, plugin_dependencies(p)) for p in names)
+
+    todo = set(p for p in names if plugin_source_hash(p) != plugin_hashes.get(p))
+    grown = True
+    while grown:
+        dependents = set(p for p in names if p not in todo and deps[p] & todo)
+        grown = bool(dependents)
+        todo |= dependents
+
+    order = []
+    def visit(plugin, seen):
+        if plugin in order or plugin in seen:
+            return
+        seen.add(plugin)
+        for dep in sorted(deps[plugin] & todo, key=names.index):
+            visit(dep, seen)
+        order.append(plugin)
+    for plugin in names:
+        if plugin in todo:
+            visit(plugin, set())
+
+    for plugin in reversed(order):
+        unload_plugin(plugin)
+    errors = {}
+    for plugin in order:
+        try:
+            load_plugin(plugin)
+        except Exception as e:
+            errors[plugin] = e
+            log_handler_exception(load_plugin, plugin)
+
+    return [p for p in order if p not in errors], errors, time.perf_counter() - start
+
+class LazyPlugin(minqlbot.Plugin):
+    """Stands in for a plugin that declared lazy_commands or lazy_events until one of them
+    fires, at which point the real plugin is instantiated and takes its place.
+
+    Nothing is hooked or registered for the stand-in. The event handlers and the command
+    manager keep track of it instead and activate it right before dispatching, so the real
+    plugin's hooks and commands get called at their own priorities, with flood control,
+    tracing and usage replies like any other. Other plugins that need the real instance
+    can call activate(), which is a no-op if it's already been activated.
+
+    """
+    def __init__(self, plugin_class):
+        super().__init__()
+        self.plugin_class = plugin_class
+        self.instance = None
+        for name in plugin_class.lazy_commands:
+            commands.lazy.setdefault(name.lower(), set()).add(self)
+        for event in plugin_class.lazy_events:
+            event_handlers[event].lazy[self.name] = self
+
+    @property
+    def name(self):
+        return self.plugin_class.__name__ + " (lazy)"
+
+    def unregister(self):
+        """Stop waiting for the plugin's commands and events."""
+        for name in self.plugin_class.lazy_commands:
+            lazies = commands.lazy.get(name.lower())
+            if lazies:
+                lazies.discard(self)
+                if not lazies:
+                    del commands.lazy[name.lower()]
+        for event in self.plugin_class.lazy_events:
+            event_handlers[event].lazy.pop(self.name, None)
+
+    def activate(self):
+        if self.instance:
+            return self.instance
+
+        name = self.plugin_class.__name__
+        debug("Activating lazy plugin '{}'...".format(name))
+        self.unregister()
+        start = time.perf_counter()
+        self.instance = self.plugin_class()
+        times = plugin_times.setdefault(name, {"import": 0.0})
+        times["init"] = time.perf_counter() - start
+        times["lazy"] = False
+        minqlbot.Plugin._Plugin__loaded_plugins[name] = self.instance
+        return self.instance
+
 # Add these as part of the minqlbot module.
 setattr(minqlbot, "reload_config", reload_config)
 setattr(minqlbot, "get_config", get_config)
 setattr(minqlbot, "load_plugin", load_plugin)
 setattr(minqlbot, "unload_plugin", unload_plugin)
 setattr(minqlbot, "reload_plugin", reload_plugin)
+setattr(minqlbot, "reload_changed_plugins", reload_changed_plugins)
+setattr(minqlbot, "LazyPlugin", LazyPlugin)
 
 # ====================================================================
 #                               HELPERS
 # ====================================================================
 
-def parse_variables(varstr):
+class ConfigstringError(ValueError):
+    """Raised by the configstring functions in strict mode when a string can't be
+    parsed or a variable can't be serialized without corrupting the string."""
+    pass
+
+setattr(minqlbot, "ConfigstringError", ConfigstringError)
+
+def _split_variables(varstr, strict):
+    """Split a string into a list of alternating keys and values."""
+    if not varstr:
+        return []
+
+    vars = varstr.lstrip("\\").split("\\")
+    if len(vars) % 2:
+        if strict:
+            raise ConfigstringError("Key '{}' has no value in: {}".format(vars[-1], varstr))
+        minqlbot.LOG.log(minqlbot.LOG_WARNING, "Key '{}' has no value in configstring: {}", vars[-1], varstr)
+        vars.append("")
+    return vars
+
+def _check_variable(key, value, strict):
+    """Make sure a variable can be put in a string as is."""
+    key, value = str(key), str(value)
+    if "\\" in key or "\\" in value:
+        if strict:
+            raise ConfigstringError("Backslash in variable '{}'.".format(key))
+        minqlbot.LOG.log(minqlbot.LOG_WARNING, "Left backslashes out of configstring variable '{}'.", key)
+        key, value = key.replace("\\", ""), value.replace("\\", "")
+    return key, value
+
+def parse_variables(varstr, strict=False, ordered=False):
     """Parses strings passed to and from the server with variables.
 
+    If the string has a key without a value, strict mode raises ConfigstringError, while
+    lenient mode logs a warning and gives the key an empty value.
+
+    Args:
+        varstr: The string, like "\\g_gametype\\4\\mapname\\campgrounds".
+        strict: Whether or not to raise instead of warning.
+        ordered: Whether or not to return an OrderedDict in the string's order.
+
     Returns:
         A dictionary with the variables as keys and values as values.
     """
-    res = {}
-    vars = varstr.lstrip("\\").split("\\")
+    vars = _split_variables(varstr, strict)
+    pairs = zip(vars[0::2], vars[1::2])
+    return collections.OrderedDict(pairs) if ordered else dict(pairs)
+
+def make_variables(variables, strict=False):
+    """The opposite of parse_variables(). Variables are written in the mapping's order,
+    so an OrderedDict from parse_variables() gives back the same string.
+
+    Keys and values can't contain backslashes. Strict mode raises ConfigstringError
+    if one does, while lenient mode logs a warning and leaves the backslashes out.
+
+    Returns:
+        The variables as a string, like "\\g_gametype\\4\\mapname\\campgrounds".
+    """
+    parts = []
+    for key, value in variables.items():
+        parts.extend(_check_variable(key, value, strict))
+    return "\\" + "\\".join(parts) if parts else ""
+
+def set_variable(varstr, key, value, strict=False):
+    """Patch a single variable of a string without building a dictionary of the rest.
+    The variable keeps its place if it's already there and is appended if not. If value
+    is None, the variable is removed instead. Errors are handled like in make_variables().
+
+    Returns:
+        The new string.
+    """
+    vars = _split_variables(varstr, strict)
+    key, new_value = _check_variable(key, "" if value is None else value, strict)
+    for i in range(0, len(vars), 2):
+        if vars[i] == key:
+            if value is None:
+                del vars[i:i + 2]
+            else:
+                vars[i + 1] = new_value
+            break
+    else:
+        if value is not None:
+            vars.extend((key, new_value))
+
+    return "\\" + "\\".join(vars) if vars else ""
+
+# Add the configstring functions as part of the minqlbot module.
+setattr(minqlbot, "parse_variables", parse_variables)
+setattr(minqlbot, "make_variables", make_variables)
+setattr(minqlbot, "set_variable", set_variable)
+
+def debug(dbgstr, *args, only_debug=False):
+    """Log a line through minqlbot.LOG. If args are given, it's formatted with
+    dbgstr.format(*args), but only if it's actually going to be logged.
+
+    """
+    minqlbot.LOG.log(minqlbot.LOG_DEBUG if only_debug else minqlbot.LOG_INFO, dbgstr, *args)
+
+# ====================================================================
+#                           CORE COMMANDS
+# ====================================================================
+
+class Core(minqlbot.Plugin):
+    """The bot's own console commands. Also used by the core for database access.
+
+    Not loaded like a regular plugin, so its commands stay registered until restart.
+
+    """
+    def __init__(self):
+        super().__init__()
+        self.add_command("latency", self.cmd_latency, channels=("console",), usage="[reset|dump]")
+        self.add_command("dbpool", self.cmd_dbpool, channels=("console",))
+        self.add_command("dbmaintain", self.cmd_dbmaintain, channels=("console",), usage="[vacuum]")
+        self.add_command("startup", self.cmd_startup, channels=("console",))
+        self.add_command("refresh", self.cmd_refresh, channels=("console",))
+        self.add_command("metrics", self.cmd_metrics, channels=("console",), usage="[export]")
+        self.add_command("memory", self.cmd_memory, channels=("console",), usage="[start [interval]|stop|snapshot]")
+        self.add_command("profile", self.cmd_profile, channels=("console",), usage="<seconds> [event|command|plugin]")
+        self.add_command("pluginhost", self.cmd_pluginhost, channels=("console",))
+        self.add_hook("game_end", self.handle_game_end)
+        # Cache the permission levels of everyone on the server with a single query, so that
+        # commands don't need to hit the database on the network thread. Coalesced, so that
+        # it's done on a timer thread, and once for all the players a gamestate brings.
+        self.add_hook("bot_connect", self.handle_bot_connect, coalesce=minqlbot.COALESCE_BURST, window=250)
+        self.add_hook("player_connect", self.handle_player_connect, coalesce=minqlbot.COALESCE_BURST, window=250)
+        self.pending_maintenance = None
+
+    def cmd_latency(self, player, msg, channel):
+        """Print latency histograms per command, reset them or dump them to a JSON file
+        next to the database."""
+        if len(msg) > 1 and msg[1].lower() == "reset":
+            tracer.reset()
+            channel.reply("^7Latency histograms have been reset.")
+        elif len(msg) > 1 and msg[1].lower() == "dump":
+            path = core_file_path("latency.json")
+            tracer.dump(path)
+            channel.reply("^7Latency histograms written to ^6{}^7.".format(path))
+        elif len(msg) > 1:
+            return minqlbot.RET_USAGE
+        else:
+            channel.reply("^7Latency per command in ms (mean/p95):")
+            for line in tracer.report():
+                channel.reply(line)
+
+    def cmd_dbpool(self, player, msg, channel):
+        """Print stats of the database connection pools and writers."""
+        pools = minqlbot.ConnectionPool.pools()
+        state = minqlbot.STATE_CLIENT
+        if state.active:
+            stats = state.pool.stats()
+            channel.reply("^6{}^7: state service, {}, {} sessions open, {} created, {} closed"
+                .format(state.address, "connected" if state.connected else "not connected",
+                stats["open"], stats["created"], stats["closed"]))
+        elif not pools:
+            channel.reply("^7No database connections have been made.")
+        for path in pools:
+            stats = pools[path].stats()
+            channel.reply("^6{path}^7: {open}/{size} open, {created} created, {closed} closed, {reused} reused"
+                .format(**stats))
+        writers = minqlbot.DatabaseWriter.writers()
+        for path in writers:
+            stats = writers[path].stats()
+            channel.reply("^6{path}^7: {queued} queued, {written} written in {batches} batches, {errors} errors"
+                .format(**stats))
+
+    def cmd_dbmaintain(self, player, msg, channel):
+        """Run ANALYZE, and optionally VACUUM, on the database. If a game's in progress,
+        it's put off until the game ends so that it doesn't get in the way."""
+        vacuum = len(msg) > 1 and msg[1].lower() == "vacuum"
+        if len(msg) > 1 and not vacuum:
+            return minqlbot.RET_USAGE
+
+        cs = minqlbot.get_configstring(0)
+        if cs and parse_variables(cs).get("g_gameState") == "IN_PROGRESS":
+            self.pending_maintenance = vacuum
+            channel.reply("^7A game is in progress. Database maintenance will run when it ends.")
+        else:
+            self.maintain_database(vacuum)
+            channel.reply("^7Database maintenance started.")
+
+    def cmd_startup(self, player, msg, channel):
+        """Print how long the core scripts took to load and run, and how long each plugin
+        took to import and instantiate, slowest first."""
+        core_times = getattr(minqlbot, "STARTUP_TIMES", {})
+        for name in sorted(core_times):
+            times = core_times[name]
+            channel.reply("^6{}^7: load {:.1f} ms ({}), exec {:.1f} ms".format(name,
+                times["load"] * 1000, times["origin"], times["exec"] * 1000))
+
+        if not plugin_times:
+            channel.reply("^7No plugins have been loaded.")
+            return
+
+        total = lambda t: t["import"] + t["init"]
+        for name, times in sorted(plugin_times.items(), key=lambda i: total(i[1]), reverse=True):
+            channel.reply("^6{}^7: import {:.1f} ms, init {:.1f} ms{}".format(name,
+                times["import"] * 1000, times["init"] * 1000, " (not yet activated)" if times["lazy"] else ""))
+
+    def cmd_refresh(self, player, msg, channel):
+        """Reload the plugins that changed on disk and the ones depending on them, without
+        restarting the rest of the bot."""
+        reloaded, errors, elapsed = reload_changed_plugins()
+        if not reloaded and not errors:
+            channel.reply("^7No plugins have changed.")
+            return
+
+        if reloaded:
+            channel.reply("^7Reloaded ^6{}^7 in {:.0f} ms.".format(", ".join(reloaded), elapsed * 1000))
+        for plugin in errors:
+            channel.reply("^1Failed to load ^6{}^1: {}".format(plugin, errors[plugin]))
+
+    def cmd_metrics(self, player, msg, channel):
+        """Print the counters and gauges, or write every metric to metrics.prom and
+        metrics.json next to the database right away."""
+        if len(msg) > 1 and msg[1].lower() == "export":
+            path = core_file_path("metrics")
+            minqlbot.METRICS.export(path)
+            channel.reply("^7Metrics written to ^6{}.prom^7 and ^6{}.json^7.".format(path, path))
+            return
+        elif len(msg) > 1:
+            return minqlbot.RET_USAGE
+
+        for metric in minqlbot.METRICS.metrics():
+            if metric.kind == "histogram":
+                continue
+            for suffix, labels, value in sorted(metric.samples(), key=lambda s: sorted(s[1].items())):
+                label_str = ",".join(str(v) for k, v in sorted(labels.items()))
+                channel.reply("^6{}^7{} {}".format(metric.name, "{" + label_str + "}" if label_str else "", value))
+
+    def cmd_memory(self, player, msg, channel):
+        """Start or stop tracking memory per plugin, take a snapshot right away, or print
+        the size and growth of every plugin."""
+        action = msg[1].lower() if len(msg) > 1 else None
+        if action == "start":
+            try:
+                interval = float(msg[2]) if len(msg) > 2 else None
+            except ValueError:
+                return minqlbot.RET_USAGE
+            if memory_tracker.start(interval):
+                channel.reply("^7Tracking memory with a snapshot every {:.0f} seconds.".format(memory_tracker.interval))
+            else:
+                channel.reply("^7Memory is already being tracked.")
+        elif action == "stop":
+            if memory_tracker.stop():
+                channel.reply("^7Stopped tracking memory.")
+            else:
+                channel.reply("^7Memory isn't being tracked.")
+        elif action == "snapshot" and memory_tracker.active:
+            memory_tracker.snapshot()
+            for line in memory_tracker.report():
+                channel.reply(line)
+        elif action == "snapshot":
+            channel.reply("^7Memory isn't being tracked.")
+        elif action:
+            return minqlbot.RET_USAGE
+        else:
+            lines = memory_tracker.report()
+            if not lines:
+                channel.reply("^7No snapshots have been taken. Use ^6memory start^7 first.")
+            for line in lines:
+                channel.reply(line)
+            if memory_tracker.leaks:
+                channel.reply("^1Plugins not collected after unloading: ^6{}".format(", ".join(memory_tracker.leaks)))
+
+    def cmd_profile(self, player, msg, channel):
+        """Profile the dispatch path, or just the handlers of an event, command or plugin,
+        for a number of seconds. The report goes next to the database."""
+        if len(msg) < 2 or len(msg) > 3:
+            return minqlbot.RET_USAGE
+        try:
+            seconds = float(msg[1])
+        except ValueError:
+            return minqlbot.RET_USAGE
+
+        target = msg[2] if len(msg) > 2 else None
+        done = lambda path: minqlbot.console_print("^7Profile written to ^6{}^7.\n".format(path))
+        if profiler.start(seconds, target, done):
+            channel.reply("^7Profiling {} for {} seconds...".format(target or "everything", msg[1]))
+        else:
+            channel.reply("^7A profile is already running.")
+
+    def cmd_pluginhost(self, player, msg, channel):
+        """Print the state of the connection to the plugin host."""
+        if not plugin_bridge.address:
+            channel.reply("^7No PluginHost address is configured.")
+            return
+        channel.reply("^7Listening on ^6{}^7, host {}, {} frames pending, {} received, {} dropped for lagging."
+            .format(plugin_bridge.address, "connected" if plugin_bridge.connected else "not connected",
+            plugin_bridge.pending, plugin_bridge.received, int(plugin_host_dropped.value())))
+
+    def handle_bot_connect(self):
+        self.warm_permissions()
+
+    def handle_player_connect(self, player):
+        self.warm_permissions()
+
+    def handle_game_end(self, game, score, winner):
+        if self.pending_maintenance is not None:
+            self.maintain_database(self.pending_maintenance)
+            self.pending_maintenance = None
+
+    def maintain_database(self, vacuum=False):
+        """Run ANALYZE and optionally VACUUM on a thread of its own."""
+        def run():
+            conn = self.db_connect()
+            isolation_level = conn.isolation_level
+            conn.isolation_level = None # VACUUM can't run in a transaction.
+            try:
+                start = time.perf_counter()
+                conn.execute("ANALYZE")
+                if vacuum:
+                    conn.execute("VACUUM")
+                debug("Database maintenance done in {:.2f}s.".format(time.perf_counter() - start))
+            except:
+                debug("ERROR: Database maintenance failed.")
+                debug(traceback.format_exc().rstrip("\n"))
+            finally:
+                conn.isolation_level = isolation_level
+                self.db_close()
+
+        t = threading.Thread(target=run, name="minqlbot database maintenance")
+        t.daemon = True
+        t.start()
+
+def ensure_core_indexes():
+    """Make sure the tables the core queries have the indexes it needs. The tables
+    themselves belong to plugins, so we don't create them, but we need the permission
+    lookups to be indexed.
+
+    """
     try:
-        for i in range(0, len(vars), 2):
-            res[vars[i]] = vars[i + 1]
+        cursor = core_plugin.db_connect().cursor()
+        if not cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='Players'").fetchone():
+            return
+
+        # Look for an index, automatic or not, with "name" as its first column.
+        for index in cursor.execute("PRAGMA index_list(Players)").fetchall():
+            columns = cursor.execute("PRAGMA index_info({})".format(index[1])).fetchall()
+            if columns and columns[0][2] == "name":
+                return
+
+        debug("Creating missing index on Players(name)...")
+        cursor.execute("CREATE INDEX IF NOT EXISTS Players_name ON Players(name)")
+        core_plugin.db_commit()
     except:
-        debug("ERROR: parse_variables uneven number of variables.")
-        debug(varstr)
-        return res # Return incomplete dict.
-    
-    return res
+        debug("ERROR: Failed to check the core indexes.")
+        debug(traceback.format_exc().rstrip("\n"))
 
-# Add parse_variables as part of the minqlbot module.
-setattr(minqlbot, "parse_variables", parse_variables)
+def core_file_path(name):
+    """Get the path of a file the core writes, which go in the same folder as the database."""
+    return os.path.join(os.path.dirname(config["Core"]["DatabasePath"]), name)
+
+core_plugin = Core()
+
+# ====================================================================
+#                           MATCH HISTORY
+# ====================================================================
+
+class MatchHistory(minqlbot.Plugin):
+    """Stores the end-of-game stats of every player in Clan Arena games.
+
+    Off unless the MatchHistory option is on, in which case the tables are created and the
+    events hooked. Every game is written as a row in Matches and a row per player in
+    MatchStats through db_write_async(). The accuracy and kills of every weapon are packed
+    into a single BLOB of 32-bit integers, in the order of CaEndStats.weapons.
 
-def debug(dbgstr, only_debug=False):
-    """A wrapper for minqlbot.debug ensuring the passed argument is a string.
+    Like Core, it's not loaded like a regular plugin.
+
+    Queries return columns rather than rows. See history().
 
     """
-    if only_debug and not minqlbot.IS_DEBUG:
-        return
+    db_migrations = [
+        "CREATE TABLE IF NOT EXISTS Matches (id INTEGER PRIMARY KEY, time INTEGER NOT NULL, "
+            "map TEXT, gametype TEXT, red_score INTEGER, blue_score INTEGER)",
+        "CREATE TABLE IF NOT EXISTS MatchStats (match INTEGER NOT NULL REFERENCES Matches(id) ON DELETE CASCADE, "
+            "name TEXT NOT NULL, team TEXT, score INTEGER, kills INTEGER, deaths INTEGER, "
+            "damage_done INTEGER, damage_received INTEGER, weapons BLOB)",
+        "CREATE INDEX IF NOT EXISTS MatchStats_name_match ON MatchStats(name, match)"
+        ]
+    WEAPONS = ("gauntlet", "mg", "sg", "gl", "rl", "lg", "rg", "pg",
+        "wpn9", "wpn10", "wpn11", "wpn12", "wpn13", "hmg", "wpn15")
+    COLUMNS = ("match", "time", "map", "gametype", "team", "score", "kills", "deaths",
+        "damage_done", "damage_received")
+    # Columns with integers are put in arrays, the rest in lists.
+    INT_COLUMNS = ("match", "time", "score", "kills", "deaths", "damage_done", "damage_received")
+
+    def __init__(self):
+        super().__init__()
+        self.enabled = False
+        self.recorded = 0
+        self.__scores = {}
+
+    def enable(self, enabled=True):
+        """Start or stop recording games. Creates the tables the first time it's enabled."""
+        if enabled == self.enabled:
+            return
+        if enabled:
+            self.db_migrate()
+            self.add_hook("scores", self.handle_scores)
+            self.add_hook("stats", self.handle_stats)
+        else:
+            self.remove_hook("scores", self.handle_scores)
+            self.remove_hook("stats", self.handle_stats)
+            self.__scores = {}
+        self.enabled = enabled
+
+    def handle_scores(self, scores):
+        # castats doesn't include score, kills and deaths, so we keep the last scores around.
+        self.__scores = dict((s.player.id, s) for s in scores if isinstance(s, minqlbot.CaScores))
+
+    def handle_stats(self, stats):
+        try:
+            game = self.game()
+            match = (int(time.time()), game.short_map, game.short_type, game.red_score, game.blue_score)
+        except Exception:
+            match = (int(time.time()), None, None, None, None)
+
+        rows = []
+        for s in stats:
+            try:
+                name = s.player.clean_name.lower()
+            except minqlbot.NonexistentPlayerError:
+                continue
+            sc = self.__scores.get(s.player.id)
+            rows.append((name, sc.team if sc else None, sc.score if sc else None,
+                sc.kills if sc else None, sc.deaths if sc else None, s.damage_done,
+                s.damage_received, array.array("i", s.weapons).tobytes()))
+
+        if rows:
+            self.record(match, rows)
+
+    def record(self, match, rows):
+        """Queue a game and its players' stats with db_write_async().
+
+        The writes of a game can end up in different batches, so the stats find their
+        game by its time and map rather than with last_insert_rowid(). If the game fails
+        to be written, so do the stats, since the match column can't be NULL.
+
+        """
+        def done(error):
+            if error is None:
+                self.recorded += 1
+
+        self.db_write_async("INSERT INTO Matches (time, map, gametype, red_score, blue_score) "
+            "VALUES (?, ?, ?, ?, ?)", *match, callback=done)
+        for row in rows:
+            self.db_write_async("INSERT INTO MatchStats VALUES ((SELECT MAX(id) FROM Matches "
+                "WHERE time=? AND map IS ?), ?, ?, ?, ?, ?, ?, ?, ?)", match[0], match[1], *row)
 
-    minqlbot.debug(str(dbgstr))
+    def history(self, player, n=10):
+        """Get the stats of a player's last games, most recent first.
+
+        Returns:
+            A dictionary with every name in COLUMNS as keys and the column's values as values,
+            along with "weapons", which is an array with the accuracy and kills of every weapon
+            of every game one after the other. Use weapon_column() to get a single weapon's.
+
+        """
+        if isinstance(player, minqlbot.Player):
+            name = player.clean_name.lower()
+        else:
+            name = self.clean_name(player).lower()
+
+        res = dict((c, array.array("q") if c in self.INT_COLUMNS else []) for c in self.COLUMNS)
+        res["weapons"] = array.array("i")
+        cursor = self.db_connect().cursor()
+        cursor.row_factory = None # Plain tuples. No need for sqlite3.Row here.
+        cursor.execute("SELECT m.id, m.time, m.map, m.gametype, s.team, s.score, s.kills, s.deaths, "
+            "s.damage_done, s.damage_received, s.weapons FROM MatchStats s JOIN Matches m ON m.id = s.match "
+            "WHERE s.name=? ORDER BY s.match DESC LIMIT ?", (name, n))
+        columns = [res[c] for c in self.COLUMNS]
+        weapons = res["weapons"]
+        for row in cursor:
+            for col, value in zip(columns, row):
+                if value is None and isinstance(col, array.array):
+                    value = -1
+                col.append(value)
+            weapons.frombytes(row[-1])
+
+        return res
+
+    @classmethod
+    def weapon_column(cls, history, weapon, kills=False):
+        """Get a single weapon's accuracy or kills out of the weapons column returned by history().
+
+        """
+        i = cls.WEAPONS.index(weapon) * 2 + (1 if kills else 0)
+        return history["weapons"][i::len(cls.WEAPONS) * 2]
+
+match_history = MatchHistory()
+setattr(minqlbot, "MATCH_HISTORY", match_history)
 
 def get_player(name):
     for i in range(24):
@@ -1215,6 +3007,355 @@ def get_player(name):
 
     return None
 
+# ====================================================================
+#                              SNAPSHOTS
+#   Keeps the core's runtime state across restarts, which re-run this
+#   script but keep the minqlbot module around.
+# ====================================================================
+
+SNAPSHOT_VERSION = 1
+# Snapshots older than this many seconds are thrown away, since we've most likely
+# missed configstring changes in the meantime.
+SNAPSHOT_MAX_AGE = 60
+
+def take_snapshot():
+    """Get a snapshot of the configstring cache, the buffers of the parser and the
+    vote caller.
+
+    """
+    with minqlbot._CS_CACHE_LOCK:
+        cs_cache = minqlbot._CS_CACHE.copy()
+
+    return {"version": SNAPSHOT_VERSION,
+            "time": time.time(),
+            "connection": minqlbot.connection_status(),
+            "cs_cache": cs_cache,
+            "bcs_buffer": bcs_buffer.copy(),
+            "castats_order": list(castats_order),
+            "castats_buffer": list(castats_buffer),
+            "vote_caller": event_handlers["vote_called"]._VoteCalledEventHandler__caller}
+
+def restore_snapshot(snapshot):
+    """Restore a snapshot taken by take_snapshot() if it's recent, of the same version
+    and we're still in the same connection state it was taken in. The serverinfo
+    configstring is compared to the native one as a sanity check.
+
+    Whether or not we're connected isn't restored. The native main loop passes the
+    connection status again after a restart, so that plugins get bot_connect as usual.
+
+    Returns:
+        True if it was restored, False otherwise.
+
+    """
+    if (not snapshot or snapshot.get("version") != SNAPSHOT_VERSION or
+        time.time() - snapshot["time"] > SNAPSHOT_MAX_AGE or
+        snapshot["connection"] != minqlbot.connection_status()):
+        return False
+
+    cs_cache = snapshot["cs_cache"]
+    if 0 in cs_cache and cs_cache[0] != minqlbot._configstring(0):
+        return False
+
+    with minqlbot._CS_CACHE_LOCK:
+        minqlbot._CS_CACHE.update(cs_cache)
+    bcs_buffer.update(snapshot["bcs_buffer"])
+    castats_order.extend(snapshot["castats_order"])
+    castats_buffer.extend(snapshot["castats_buffer"])
+    event_handlers["vote_called"].caller(snapshot["vote_caller"])
+    setattr(minqlbot, "CONNECTION", snapshot["connection"])
+    debug("Restored a snapshot from {:.1f} seconds ago with {} configstrings."
+        .format(time.time() - snapshot["time"], len(cs_cache)))
+    return True
+
+setattr(minqlbot, "take_snapshot", take_snapshot)
+setattr(minqlbot, "restore_snapshot", restore_snapshot)
+
+# ====================================================================
+#                             PLUGIN HOST
+#   Streams what the native module passes to us to a plugin host in
+#   another process (see plugin_host.py) and passes on its commands.
+# ====================================================================
+
+# A frame is a 4-byte big-endian length followed by that many bytes of UTF-8 encoded JSON.
+# Bytes, which JSON doesn't have, are sent as {"$b": "<base64>"}. The size limit leaves
+# room for the results of big queries sent by the state service.
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 1 << 24
+
+def _encode_bytes(obj):
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return {"$b": base64.b64encode(bytes(obj)).decode()}
+    raise TypeError("{} can't be sent in a frame.".format(type(obj).__name__))
+
+def _decode_bytes(obj):
+    if len(obj) == 1 and "$b" in obj:
+        return base64.b64decode(obj["$b"])
+    return obj
+
+def encode_frame(obj):
+    data = json.dumps(obj, separators=(",", ":"), default=_encode_bytes).encode()
+    return FRAME_HEADER.pack(len(data)) + data
+
+class FrameReader:
+    """Turns the bytes read from a stream into frames."""
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Add data read from the stream.
+
+        Returns:
+            A list of the frames it completed, decoded.
+
+        Raises:
+            ValueError: If a frame is too big or not valid JSON.
+
+        """
+        self.buffer += data
+        frames = []
+        while len(self.buffer) >= FRAME_HEADER.size:
+            size = FRAME_HEADER.unpack_from(self.buffer)[0]
+            if size > MAX_FRAME_SIZE:
+                raise ValueError("Frame of {} bytes is too big.".format(size))
+            end = FRAME_HEADER.size + size
+            if len(self.buffer) < end:
+                break
+            frames.append(json.loads(self.buffer[FRAME_HEADER.size:end].decode(), object_hook=_decode_bytes))
+            del self.buffer[:end]
+        return frames
+
+def parse_address(address):
+    """Get the socket family and address of an address like "unix:/tmp/minqlbot.sock"
+    or "127.0.0.1:27961". The host defaults to the loopback address.
+
+    Unix sockets should be preferred. Whoever can connect gets to send commands and
+    queries as the bot without any authentication, so other TCP hosts than the loopback
+    address are refused.
+
+    """
+    if address.startswith("unix:"):
+        if not hasattr(socket, "AF_UNIX"):
+            raise ValueError("Unix sockets aren't supported here. Use a loopback address instead.")
+        return socket.AF_UNIX, address[5:]
+    host, _, port = address.rpartition(":")
+    host = host or "127.0.0.1"
+    if host != "localhost":
+        try:
+            ip = ipaddress.ip_address(host)
+        except ValueError:
+            ip = None
+        if ip is None or ip.version != 4 or not ip.is_loopback:
+            raise ValueError("Only loopback addresses like 127.0.0.1 can be used, not '{}'.".format(host))
+    return socket.AF_INET, (host, int(port))
+
+plugin_host_dropped = minqlbot.METRICS.counter("minqlbot_plugin_host_dropped_total",
+    "Times the plugin host was disconnected for falling behind.")
+
+class PluginBridge:
+    """Listens for a plugin host on the PluginHost address and streams it server commands,
+    gamestates, connection status changes and console prints, in the order we get them.
+    It starts with a snapshot of the configstrings. The host sends back commands, which go
+    through minqlbot.COMMAND_QUEUE like any plugin's, and console prints.
+
+    The game thread never waits on the host. Frames are queued and sent by another thread,
+    and if the host falls MAX_PENDING frames behind, it's disconnected so that it can
+    reconnect and start over from a fresh snapshot. The other way around, we stop reading
+    from the host while MAX_QUEUED of its commands are waiting to be sent, which leaves
+    it blocking on its end.
+
+    The host sends the name of the plugin behind a command along with it, so that its
+    plugins are queued as "plugin host:<name>" and fair queuing still tells them apart.
+
+    """
+    MAX_PENDING = 10000
+    MAX_QUEUED = 50
+    PLUGIN = "plugin host"
+
+    def __init__(self):
+        self.address = None
+        self.connected = False
+        self.received = 0
+        self.__lock = threading.Condition()
+        self.__server = None
+        self.__conn = None
+        self.__pending = collections.deque()
+        self.__queued = set() # The host's commands that are still pending.
+
+    @property
+    def pending(self):
+        return len(self.__pending)
+
+    def configure(self, address):
+        """Listen on 'address', or stop listening if it's empty."""
+        if address == self.address:
+            return
+        self.stop()
+        if address:
+            self.start(address)
+
+    def start(self, address):
+        family, addr = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.remove(addr) # Left behind by an earlier run.
+        server = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(addr)
+        server.listen(1)
+        with self.__lock:
+            self.address = address
+            self.__server = server
+        thread = threading.Thread(target=self.__accept, args=(server,), name="minqlbot plugin bridge")
+        thread.daemon = True
+        thread.start()
+        debug("Listening for a plugin host on {}.", address)
+
+    def stop(self):
+        with self.__lock:
+            server, self.__server = self.__server, None
+            address, self.address = self.address, None
+        if server:
+            server.close()
+        self.__disconnect()
+        if address and address.startswith("unix:"):
+            try:
+                os.remove(address[5:])
+            except OSError:
+                pass
+
+    def publish(self, *frame):
+        """Queue a frame for the host, if there is one."""
+        with self.__lock:
+            if not self.connected:
+                return
+            if len(self.__pending) < self.MAX_PENDING:
+                self.__pending.append(frame)
+                self.__lock.notify_all()
+                return
+        plugin_host_dropped.inc()
+        minqlbot.LOG.log(minqlbot.LOG_WARNING, "The plugin host fell {} frames behind. Disconnecting it.",
+            self.MAX_PENDING)
+        self.__disconnect()
+
+    def __hello(self):
+        """The first frame a host gets. Needs the lock."""
+        configstrings = minqlbot._configstring_range(0, 1023)
+        # The cache is ahead of the native table while a configstring's being handled.
+        with minqlbot._CS_CACHE_LOCK:
+            configstrings.update(minqlbot._CS_CACHE)
+        return ("hello", {"version": minqlbot.__version__, "debug": minqlbot.IS_DEBUG,
+            "status": minqlbot.connection_status(), "name": getattr(minqlbot, "NAME", ""),
+            "configstrings": configstrings})
+
+    def __accept(self, server):
+        while True:
+            try:
+                conn, addr = server.accept()
+            except OSError:
+                return # Closed by stop().
+
+            self.__disconnect()
+            with self.__lock:
+                if self.__server is not server:
+                    conn.close()
+                    return
+                self.__conn = conn
+                self.connected = True
+                self.__pending.append(self.__hello())
+            for target, name in ((self.__write, "writer"), (self.__read, "reader")):
+                thread = threading.Thread(target=target, args=(conn,), name="minqlbot plugin bridge " + name)
+                thread.daemon = True
+                thread.start()
+            debug("A plugin host connected.")
+
+    def __disconnect(self, conn=None):
+        """Drop the current host, or only 'conn' if it's given and still the current one."""
+        with self.__lock:
+            if self.__conn is None or (conn is not None and self.__conn is not conn):
+                return
+            conn, self.__conn = self.__conn, None
+            self.connected = False
+            self.__pending.clear()
+            self.__queued.clear()
+            self.__lock.notify_all()
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        conn.close()
+        debug("The plugin host disconnected.")
+
+    def __write(self, conn):
+        while True:
+            with self.__lock:
+                while self.__conn is conn and not self.__pending:
+                    self.__lock.wait()
+                if self.__conn is not conn:
+                    return
+                frames = list(self.__pending)
+                self.__pending.clear()
+            try:
+                conn.sendall(b"".join(encode_frame(frame) for frame in frames))
+            except OSError:
+                self.__disconnect(conn)
+                return
+
+    def __read(self, conn):
+        reader = FrameReader()
+        while True:
+            # Let the host wait if its commands are piling up.
+            with self.__lock:
+                while self.__conn is conn and len(self.__queued) >= self.MAX_QUEUED:
+                    self.__lock.wait()
+                if self.__conn is not conn:
+                    break
+
+            try:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                for frame in reader.feed(data):
+                    self.__handle(frame)
+            except Exception as e:
+                # Anything that goes wrong here would otherwise leave a host that's
+                # connected as far as the writer knows, but never read from again.
+                with self.__lock:
+                    current = self.__conn is conn
+                if current:
+                    debug("Plugin host connection error: {}", e)
+                break
+
+        self.__disconnect(conn)
+
+    def __handle(self, frame):
+        if not (isinstance(frame, list) and len(frame) in (2, 3) and all(isinstance(f, str) for f in frame)):
+            raise ValueError("Malformed frame from the plugin host: {:.100}".format(repr(frame)))
+        self.received += 1
+        if frame[0] == "send":
+            plugin = "{}:{}".format(self.PLUGIN, frame[2]) if len(frame) == 3 else self.PLUGIN
+            qcmd = minqlbot.COMMAND_QUEUE.send(frame[1], plugin=plugin)
+            with self.__lock:
+                self.__queued.add(qcmd)
+            qcmd.add_done_callback(self.__command_done)
+        elif frame[0] == "print":
+            minqlbot.console_print(frame[1])
+        else:
+            debug("Unknown frame from the plugin host: {}", frame[0])
+
+    def __command_done(self, qcmd):
+        with self.__lock:
+            if qcmd in self.__queued:
+                self.__queued.discard(qcmd)
+                self.__lock.notify_all()
+
+plugin_bridge = PluginBridge()
+minqlbot.METRICS.gauge("minqlbot_plugin_host_pending", "Frames waiting to be sent to the plugin host.",
+    function=lambda: plugin_bridge.pending)
+setattr(minqlbot, "PLUGIN_BRIDGE", plugin_bridge)
+setattr(minqlbot, "encode_frame", encode_frame)
+setattr(minqlbot, "FrameReader", FrameReader)
+setattr(minqlbot, "parse_address", parse_address)
+
 # ====================================================================
 #                                 MAIN
 # ====================================================================
@@ -1227,4 +3368,7 @@ if __name__ == "__main__":
 
     sys.path.append(os.getcwd() + "\\python")
     load_config()
+    Core.db_migrate()
+    restore_snapshot(getattr(minqlbot, "_SNAPSHOT", None))
+    setattr(minqlbot, "_SNAPSHOT", None)
     load_preset_plugins()
@@ -20,7 +20,14 @@ import minqlbot
 import sqlite3
 import threading
 import datetime
+import time
 import re
+import collections
+import weakref
+import json
+import os
+import traceback
+import socket
 
 # Export hook priority levels.
 setattr(minqlbot, "PRI_HIGHEST", 0)
@@ -29,6 +36,359 @@ setattr(minqlbot, "PRI_NORMAL",  2)
 setattr(minqlbot, "PRI_LOW",     3)
 setattr(minqlbot, "PRI_LOWEST",  4)
 
+# Export coalescing policies for hooks of high-frequency events. See minqlbot.CoalescedHandler.
+setattr(minqlbot, "COALESCE_NONE",   0)
+setattr(minqlbot, "COALESCE_LATEST", 1)
+setattr(minqlbot, "COALESCE_BURST",  2)
+
+class Metric():
+    """Base class of the metrics in a MetricsRegistry.
+
+    Values are kept per label values, which are given positionally in the same order
+    as the metric's label names, e.g. counter.inc("chat") for a counter labeled by type.
+
+    """
+    kind = None
+
+    def __init__(self, name, help="", labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def samples(self):
+        """Get a list of (suffix, label dictionary, value) tuples."""
+        with self._lock:
+            return [("", dict(zip(self.labels, k)), v) for k, v in self._values.items()]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    """A value that can go up and down. If 'function' is given, it's called on collection
+    and should return the value, or a dictionary with label value tuples as keys.
+
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help="", labels=(), function=None):
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def samples(self):
+        if self.function:
+            try:
+                value = self.function()
+            except Exception:
+                return []
+            with self._lock:
+                self._values = value if isinstance(value, dict) else {(): value}
+        return super().samples()
+
+class Histogram(Metric):
+    kind = "histogram"
+    # In seconds, since that's what we mostly time.
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help="", labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        with self._lock:
+            h = self._values.get(labels)
+            if h is None:
+                # Counts per bucket, then the sum and count of all observations.
+                h = self._values[labels] = [0] * len(self.buckets) + [0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    h[i] += 1
+                    break
+            h[-2] += value
+            h[-1] += 1
+
+    def value(self, *labels):
+        """Get the (sum, count) of the observations."""
+        with self._lock:
+            h = self._values.get(labels)
+            return (h[-2], h[-1]) if h else (0, 0)
+
+    def samples(self):
+        res = []
+        with self._lock:
+            for k, h in self._values.items():
+                labels = dict(zip(self.labels, k))
+                cumulative = 0
+                for bound, n in zip(self.buckets, h):
+                    cumulative += n
+                    res.append(("_bucket", dict(labels, le=repr(bound)), cumulative))
+                res.append(("_bucket", dict(labels, le="+Inf"), h[-1]))
+                res.append(("_sum", labels, h[-2]))
+                res.append(("_count", labels, h[-1]))
+        return res
+
+class MetricsRegistry():
+    """Holds the bot's metrics and exports them in the Prometheus text format and as JSON.
+
+    counter(), gauge() and histogram() return the existing metric if one with the same
+    name was already registered, so plugins can call them every time they're loaded.
+
+    """
+    def __init__(self):
+        self.__metrics = collections.OrderedDict()
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.__stop = threading.Event()
+        self.started = time.time()
+
+    def __register(self, cls, name, *args, **kwargs):
+        with self.__lock:
+            metric = self.__metrics.get(name)
+            if metric is None:
+                metric = self.__metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError("A metric named '{}' of another kind already exists.".format(name))
+            return metric
+
+    def counter(self, name, help="", labels=()):
+        return self.__register(Counter, name, help, labels)
+
+    def gauge(self, name, help="", labels=(), function=None):
+        return self.__register(Gauge, name, help, labels, function)
+
+    def histogram(self, name, help="", labels=(), buckets=Histogram.BUCKETS):
+        return self.__register(Histogram, name, help, labels, buckets)
+
+    def get(self, name):
+        return self.__metrics.get(name)
+
+    def metrics(self):
+        with self.__lock:
+            return list(self.__metrics.values())
+
+    def to_prometheus(self):
+        lines = []
+        for metric in self.metrics():
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for suffix, labels, value in metric.samples():
+                if labels:
+                    label_str = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                        for k, v in sorted(labels.items()))
+                    lines.append("{}{}{{{}}} {}".format(metric.name, suffix, label_str, value))
+                else:
+                    lines.append("{}{} {}".format(metric.name, suffix, value))
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        res = {"time": time.time(), "started": self.started, "metrics": {}}
+        for metric in self.metrics():
+            res["metrics"][metric.name] = {"type": metric.kind, "help": metric.help,
+                "samples": [{"name": metric.name + suffix, "labels": labels, "value": value}
+                    for suffix, labels, value in metric.samples()]}
+        return res
+
+    def export(self, path):
+        """Write '<path>.prom' and '<path>.json'. Files are replaced atomically so that
+        whatever scrapes them never sees half a file.
+
+        """
+        for ext, data in ((".prom", self.to_prometheus()), (".json", json.dumps(self.to_dict()))):
+            tmp = path + ext + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(data)
+            os.replace(tmp, path + ext)
+
+    def start_exporter(self, path, interval):
+        """Export every 'interval' seconds on a thread of its own until stop_exporter()."""
+        self.stop_exporter()
+        self.__stop.clear()
+        def run():
+            while not self.__stop.wait(interval):
+                try:
+                    self.export(path)
+                except Exception as e:
+                    logger.error("MetricsRegistry: Failed to export metrics: {}", e)
+        self.__thread = threading.Thread(target=run, name="minqlbot metrics exporter")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop_exporter(self):
+        if self.__thread:
+            self.__stop.set()
+            self.__thread.join()
+            self.__thread = None
+
+metrics = MetricsRegistry()
+setattr(minqlbot, "METRICS", metrics)
+
+# Export log levels.
+setattr(minqlbot, "LOG_DEBUG",   10)
+setattr(minqlbot, "LOG_INFO",    20)
+setattr(minqlbot, "LOG_WARNING", 30)
+setattr(minqlbot, "LOG_ERROR",   40)
+
+class LogPipeline():
+    """Buffered logging to the debug output and a rotating file.
+
+    Logging a line that passes the level check only appends the unformatted message and its
+    arguments to a bounded deque, which is thread-safe without a lock. A thread of its own
+    drains it every so often, formats the lines and passes them to minqlbot.debug one
+    record at a time. If the buffer fills up, the oldest lines are dropped. Once stopped,
+    lines are written right away on the thread logging them.
+
+    """
+    LEVEL_NAMES = {10: "DEBUG", 20: "INFO", 30: "WARNING", 40: "ERROR"}
+
+    def __init__(self, size=4096, interval=0.1):
+        self.level = minqlbot.LOG_DEBUG if minqlbot.IS_DEBUG else minqlbot.LOG_INFO
+        self.interval = interval
+        self.path = None
+        self.max_bytes = 1024 * 1024
+        self.backups = 3
+        self.logged = 0
+        self.dropped = 0
+        self.__buffer = collections.deque(maxlen=size)
+        self.__lock = threading.Lock() # Only for writing, never for logging.
+        self.__start_lock = threading.Lock() # Only taken until the writer is running.
+        self.__thread = None
+        self.__stop = threading.Event()
+        self.__stopped = False
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, msg, *args):
+        """Log a line. If there are args, the line is formatted with msg.format(*args),
+        but only if it passes the level check and only on the writer thread.
+
+        """
+        if level < self.level:
+            return
+        buffer = self.__buffer
+        if len(buffer) == buffer.maxlen:
+            self.dropped += 1
+        buffer.append((level, time.time(), msg, args))
+        if self.__stopped:
+            self.flush()
+        elif self.__thread is None:
+            self.__start()
+
+    def debug(self, msg, *args):
+        self.log(minqlbot.LOG_DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(minqlbot.LOG_INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(minqlbot.LOG_WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        self.log(minqlbot.LOG_ERROR, msg, *args)
+
+    def exception(self, msg, *args):
+        """Log an error along with the traceback of the exception being handled as one entry."""
+        self.log(minqlbot.LOG_ERROR, "{}\n{}", LazyFormat(msg, args), traceback.format_exc().rstrip("\n"))
+
+    def flush(self):
+        """Write everything in the buffer right away."""
+        buffer = self.__buffer
+        lines = []
+        while True:
+            try:
+                level, when, msg, args = buffer.popleft()
+            except IndexError:
+                break
+            try:
+                line = msg.format(*args) if args else str(msg)
+            except Exception as e:
+                line = "{!r} {!r} (formatting failed: {})".format(msg, args, e)
+            lines.append((level, when, line))
+
+        if not lines:
+            return
+        with self.__lock:
+            self.logged += len(lines)
+            for level, when, line in lines:
+                minqlbot.debug(line)
+            if self.path:
+                self.__write_file(lines)
+
+    def stop(self):
+        with self.__start_lock:
+            self.__stopped = True
+        if self.__thread:
+            self.__stop.set()
+            self.__thread.join()
+            self.__thread = None
+        self.flush()
+
+    def __start(self):
+        with self.__start_lock:
+            if self.__thread is not None or self.__stopped:
+                return
+            self.__stop.clear()
+            thread = threading.Thread(target=self.__run, name="minqlbot log writer")
+            thread.daemon = True
+            thread.start()
+            self.__thread = thread
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            self.flush()
+
+    def __write_file(self, lines):
+        try:
+            if os.path.isfile(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                for i in range(self.backups - 1, 0, -1):
+                    if os.path.isfile("{}.{}".format(self.path, i)):
+                        os.replace("{}.{}".format(self.path, i), "{}.{}".format(self.path, i + 1))
+                os.replace(self.path, self.path + ".1")
+            with open(self.path, "a", encoding="utf-8") as f:
+                for level, when, line in lines:
+                    f.write("{} {:<7} {}\n".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(when)),
+                        self.LEVEL_NAMES.get(level, level), line))
+        except OSError as e:
+            self.path = None
+            minqlbot.debug("LogPipeline: Failed to write to the log file, disabling it: {}".format(e))
+
+class LazyFormat():
+    """Formats a message with its arguments when converted to a string."""
+    __slots__ = ("msg", "args")
+
+    def __init__(self, msg, args):
+        self.msg = msg
+        self.args = args
+
+    def __str__(self):
+        return self.msg.format(*self.args) if self.args else str(self.msg)
+
+logger = LogPipeline()
+setattr(minqlbot, "LOG", logger)
+
+cs_cache_lookups = metrics.counter("minqlbot_configstring_cache_total",
+    "Configstring lookups by whether or not they were cached.", ("result",))
+
 # Configstring cache. See get_configstring() for details.
 cs_cache = {}
 cache_lock = threading.Lock()
@@ -50,19 +410,1253 @@ def get_configstring(index, cached=True):
     global cs_cache
     with cache_lock:
         if cached and index not in cs_cache:
+            cs_cache_lookups.inc("miss")
             cs = minqlbot._configstring(index)
             cs_cache[index] = cs
             return cs
         elif not cached:
+            cs_cache_lookups.inc("uncached")
             return minqlbot._configstring(index)
         else:
+            cs_cache_lookups.inc("hit")
             return cs_cache[index]
 
 setattr(minqlbot, "get_configstring", get_configstring)
 
+class PermissionCache():
+    """An in-memory cache of player permission levels, keyed by clean, lowercase names.
+
+    Commands check permissions for every candidate command on every chat command, and
+    doing that with a query each time means hitting the disk on the network thread.
+    Entries expire after 'ttl' seconds, and the least recently used ones are dropped
+    if there are more than 'size' of them. Players without an entry in the database
+    are cached as well, with None as the level.
+
+    Plugins that change permissions need to call Plugin.invalidate_permission()
+    afterwards, or the old level might be used until the entry expires.
+
+    """
+    MISSING = object()
+
+    def __init__(self, ttl=300, size=512):
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, name):
+        """Get the cached level of a player, or PermissionCache.MISSING if not cached.
+
+        """
+        with self.__lock:
+            entry = self.__entries.get(name)
+            if entry is None or entry[1] < time.monotonic():
+                self.misses += 1
+                return self.MISSING
+
+            self.hits += 1
+            self.__entries.move_to_end(name)
+            return entry[0]
+
+    def put(self, name, level):
+        with self.__lock:
+            self.__entries[name] = (level, time.monotonic() + self.ttl)
+            self.__entries.move_to_end(name)
+            while len(self.__entries) > self.size:
+                self.__entries.popitem(last=False)
+
+    def invalidate(self, name=None):
+        """Invalidate a single player's level, or the whole cache if no name is passed.
+
+        """
+        with self.__lock:
+            if name is None:
+                self.__entries.clear()
+            elif name in self.__entries:
+                del self.__entries[name]
+
+    def missing(self, names):
+        """Get which of the names have no fresh entry in the cache.
+
+        """
+        now = time.monotonic()
+        with self.__lock:
+            return [n for n in names if n not in self.__entries or self.__entries[n][1] < now]
+
+permission_cache = PermissionCache()
+setattr(minqlbot, "PERMISSION_CACHE", permission_cache)
+
 # Export special channel for commands that will trigger on all channels.
 setattr(minqlbot, "CMD_ALL_CHANNELS",  0)
 
+# Outgoing command priority classes. See CommandScheduler.
+setattr(minqlbot, "SEND_PRI_MODERATION", 0)
+setattr(minqlbot, "SEND_PRI_VOTE",       1)
+setattr(minqlbot, "SEND_PRI_DEFAULT",    2)
+setattr(minqlbot, "SEND_PRI_CHAT",       3)
+
+class QueuedCommand():
+    """A command waiting in the CommandScheduler to be passed on to the native queue.
+
+    """
+    def __init__(self, cmd, plugin, priority):
+        self.cmd = cmd
+        self.plugin = plugin
+        self.priority = priority
+        self.queued = time.perf_counter()
+        self.dequeued = None
+        self.cancelled = False
+        self.trace = None
+        self.__callbacks = []
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return "{}({}@{}:'{}')".format(self.__class__.__name__, self.priority, self.plugin, self.cmd)
+
+    @property
+    def pending(self):
+        return self.dequeued is None and not self.cancelled
+
+    def cancel(self):
+        """Drop the command if it hasn't been sent yet. Returns True if it was dropped."""
+        return command_scheduler.cancel(self)
+
+    def add_done_callback(self, callback):
+        """Call 'callback' with the command once it's been passed on to the native queue or
+        dropped, or right away if it already has. It's called from whichever thread did
+        that, without any of the scheduler's locks held.
+
+        """
+        with self.__lock:
+            if self.__callbacks is not None:
+                self.__callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self):
+        """Called by the scheduler once the command's no longer pending."""
+        with self.__lock:
+            callbacks, self.__callbacks = self.__callbacks, None
+        for callback in callbacks or ():
+            try:
+                callback(self)
+            except:
+                logger.exception("QueuedCommand: Exception in a callback of '{}'.", self.cmd)
+
+class CommandScheduler():
+    """Sits in front of minqlbot.send_command and decides which command goes out next.
+
+    The native queue sends a single command every 600 ms in the order they were added,
+    so a kick could end up waiting behind a plugin's ten-line chat reply. Commands are
+    instead kept here and only passed on to the native queue at the rate it sends them.
+    The command that gets passed on is picked as follows:
+        - Higher priority classes first (moderation > votes > default > chat).
+        - Within a class, plugins are served by weighted fair queuing, so a chatty
+          plugin can't starve the others. Plugins have a weight of 1 by default.
+        - Commands of the same plugin are sent in the order they were added. When a
+          plugin queues a command in a higher class than some of its pending ones, those
+          are moved up into the same class, right before it. A plugin's "say" followed
+          by a "kick" is thus still sent first, while other plugins' chat can't hold up
+          the kick.
+
+    An idempotent command, like a kick, right behind an identical pending one from the
+    same plugin is merged into it. Chat and votes are never merged, since a repeated line
+    is usually meant to be repeated. Commands like "lock red" replace a pending "unlock
+    red" if it's the last command the same plugin queued, since only the latest one
+    matters then.
+
+    """
+    # Native send interval in seconds. See DELAY_SEND_COMMAND in quake.h.
+    DELAY = 0.6
+    # Commands whose first word is here are put in the respective class by default.
+    CLASSES = dict(
+        [(c, minqlbot.SEND_PRI_MODERATION) for c in ("kick", "kickban", "mute", "unmute", "put",
+            "lock", "unlock", "op", "deop", "abort", "pause", "unpause", "timeout", "timein",
+            "allready", "stopserver", "opsay")] +
+        [(c, minqlbot.SEND_PRI_VOTE) for c in ("callvote", "cv", "vote")] +
+        [(c, minqlbot.SEND_PRI_CHAT) for c in ("say", "say_team", "tell")])
+    # Commands where only the latest pending one matters. Maps to the superseded command.
+    SUPERSEDES = {"lock": "unlock", "unlock": "lock", "score": "score"}
+    # Commands that can be merged with an identical one right before them.
+    IDEMPOTENT = frozenset(("kick", "kickban", "mute", "unmute", "put", "lock", "unlock", "op", "deop",
+        "pause", "unpause", "allready", "score"))
+    # How many wait times we keep around for the metrics.
+    WAIT_SAMPLES = 100
+
+    def __init__(self):
+        self.context = threading.local()
+        # Called with the plugin's name before a command of it other than chat is queued,
+        # so that chat held back for it elsewhere can be queued first.
+        self.flushers = []
+        self.sent = 0
+        self.merged = 0
+        self.superseded = 0
+        self.cancelled = 0
+        self.__queues = tuple(collections.OrderedDict() for i in range(4))
+        self.__vtime = tuple({} for i in range(4)) # Virtual finish time per plugin.
+        self.__vclock = [0] * 4 # Virtual time of the last command sent.
+        self.__weights = {}
+        self.__waits = tuple(collections.deque(maxlen=self.WAIT_SAMPLES) for i in range(4))
+        self.__last_send = 0
+        self.__cond = threading.Condition()
+        self.__thread = None
+        self.__running = False
+
+    def send(self, cmd, plugin=None, priority=None, trace=None):
+        """Queue a command.
+
+        Args:
+            cmd (str): The command.
+            plugin (str, optional): The plugin sending it. Defaults to the plugin whose
+                handler is currently being called on this thread, if any.
+            priority (int, optional): One of the minqlbot.SEND_PRI_* classes. Defaults to
+                the class of the command's first word.
+            trace (minqlbot.Trace, optional): The trace of the server command that led to
+                this command being sent. Defaults to the one of this thread, if any.
+
+        Returns:
+            The QueuedCommand instance, which can be used to cancel it.
+
+        """
+        if plugin is None:
+            plugin = getattr(self.context, "plugin", None) or "core"
+        if trace is None:
+            trace = getattr(self.context, "trace", None)
+        words = cmd.split(None, 2)
+        first = words[0].lower() if words else ""
+        if priority is None:
+            priority = self.CLASSES.get(first, minqlbot.SEND_PRI_DEFAULT)
+        if priority != minqlbot.SEND_PRI_CHAT:
+            for flusher in self.flushers:
+                flusher(plugin)
+
+        superseded = None
+        with self.__cond:
+            queues = self.__queues[priority]
+            self.__promote(plugin, priority)
+            queue = queues.get(plugin)
+
+            # Merge with an identical command right before this one, if sending it twice
+            # does nothing more than sending it once.
+            if queue and queue[-1].cmd == cmd and first in self.IDEMPOTENT:
+                self.merged += 1
+                return queue[-1]
+
+            # Replace the plugin's last pending command if this one supersedes it. Anything
+            # queued in between might depend on it, like a "put" between "unlock" and "lock".
+            if first in self.SUPERSEDES and queue:
+                key = (self.SUPERSEDES[first], " ".join(words[1:2]).lower())
+                last = queue[-1]
+                qwords = last.cmd.split(None, 2)
+                if (qwords[0].lower(), " ".join(qwords[1:2]).lower()) == key:
+                    superseded = queue.pop()
+                    superseded.cancelled = True
+                    self.superseded += 1
+
+            qcmd = QueuedCommand(cmd, plugin, priority)
+            qcmd.trace = trace
+            if not queue:
+                queue = self.__new_queue(plugin, priority)
+            queue.append(qcmd)
+
+            if not self.__running:
+                self.__start()
+            self.__cond.notify()
+
+        if superseded:
+            superseded.done()
+        return qcmd
+
+    def cancel(self, qcmd):
+        with self.__cond:
+            queue = self.__queues[qcmd.priority].get(qcmd.plugin)
+            if not qcmd.pending or not queue or qcmd not in queue:
+                return False
+            queue.remove(qcmd)
+            qcmd.cancelled = True
+            self.cancelled += 1
+        qcmd.done()
+        return True
+
+    def cancel_plugin(self, plugin):
+        """Drop every pending command of a plugin. Returns how many were dropped."""
+        dropped = []
+        with self.__cond:
+            for queues in self.__queues:
+                for qcmd in queues.pop(plugin, ()):
+                    qcmd.cancelled = True
+                    dropped.append(qcmd)
+            self.cancelled += len(dropped)
+        for qcmd in dropped:
+            qcmd.done()
+        return len(dropped)
+
+    def set_weight(self, plugin, weight):
+        if weight <= 0:
+            raise ValueError("The weight needs to be a positive number.")
+        with self.__cond:
+            self.__weights[plugin] = weight
+
+    def stats(self):
+        """Get the queue depth and wait times of each priority class, along with counters.
+
+        Wait times are in seconds and based on the last few commands sent in each class.
+
+        """
+        with self.__cond:
+            res = {"sent": self.sent, "merged": self.merged, "superseded": self.superseded,
+                "cancelled": self.cancelled, "classes": []}
+            for queues, waits in zip(self.__queues, self.__waits):
+                res["classes"].append({
+                    "depth": sum(len(q) for q in queues.values()),
+                    "wait_avg": sum(waits) / len(waits) if waits else 0,
+                    "wait_max": max(waits) if waits else 0
+                    })
+            return res
+
+    def stop(self, flush=True):
+        """Stop the scheduler thread and pass every pending command to the native queue
+        right away, unless told not to.
+
+        """
+        with self.__cond:
+            self.__running = False
+            self.__cond.notify()
+            thread = self.__thread
+        if thread and thread is not threading.current_thread():
+            thread.join()
+
+        while flush:
+            with self.__cond:
+                qcmd = self.__next()
+            if not qcmd:
+                break
+            qcmd.done()
+            self.pass_on(qcmd)
+
+    def pass_on(self, qcmd):
+        """Hand a command over to the native queue. The plugin host replaces this so that
+        the bot knows which plugin sent it."""
+        minqlbot.send_command(qcmd.cmd)
+
+    def __start(self):
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, name="minqlbot command scheduler")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __new_queue(self, plugin, priority):
+        """Add an empty queue for a plugin to a class. Needs the lock."""
+        queue = self.__queues[priority][plugin] = collections.deque()
+        # A plugin that's been idle doesn't get to save up turns.
+        vtime = self.__vtime[priority]
+        vtime[plugin] = max(vtime.get(plugin, 0), self.__vclock[priority])
+        return queue
+
+    def __promote(self, plugin, priority):
+        """Move a plugin's pending commands of lower classes to the end of its queue in
+        'priority', so that they're still sent before what it queues next. Needs the lock."""
+        moved = []
+        for lower in range(priority + 1, len(self.__queues)):
+            moved.extend(self.__queues[lower].pop(plugin, ()))
+        if not moved:
+            return
+
+        moved.sort(key=lambda qcmd: qcmd.queued)
+        queue = self.__queues[priority].get(plugin)
+        if queue is None:
+            queue = self.__new_queue(plugin, priority)
+        for qcmd in moved:
+            qcmd.priority = priority
+            queue.append(qcmd)
+
+    def __next(self):
+        """Pop the next command to be sent, if any. Needs the lock."""
+        for priority, queues in enumerate(self.__queues):
+            if not queues:
+                continue
+            vtime = self.__vtime[priority]
+            plugin = min(queues, key=lambda p: vtime[p])
+            queue = queues[plugin]
+            qcmd = queue.popleft()
+            if not queue:
+                del queues[plugin]
+            self.__vclock[priority] = vtime[plugin]
+            vtime[plugin] += 1 / self.__weights.get(plugin, 1)
+            qcmd.dequeued = time.perf_counter()
+            self.__waits[priority].append(qcmd.dequeued - qcmd.queued)
+            self.sent += 1
+            send_wait.observe(qcmd.dequeued - qcmd.queued, str(priority))
+            if qcmd.trace:
+                qcmd.trace.sent(qcmd)
+            return qcmd
+
+        return None
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                while self.__running and not any(self.__queues):
+                    self.__cond.wait()
+                if not self.__running:
+                    return
+
+                # Don't pass it on before the native queue has had time to send the last one.
+                delay = self.__last_send + self.DELAY - time.perf_counter()
+                if delay > 0:
+                    self.__cond.wait(delay)
+                    continue
+
+                qcmd = self.__next()
+                if not qcmd:
+                    continue
+                self.__last_send = qcmd.dequeued
+
+            qcmd.done()
+            self.pass_on(qcmd)
+
+command_scheduler = CommandScheduler()
+send_wait = metrics.histogram("minqlbot_send_wait_seconds",
+    "Time commands spent in the outgoing queue, by priority class.", ("priority",))
+metrics.gauge("minqlbot_send_queue_depth", "Commands waiting in the outgoing queue, by priority class.",
+    ("priority",), lambda: dict(((str(i),), c["depth"]) for i, c in enumerate(command_scheduler.stats()["classes"])))
+setattr(minqlbot, "COMMAND_QUEUE", command_scheduler)
+
+class ConnectionPool():
+    """A pool of SQLite connections to a database, with a connection per thread.
+
+    Every plugin using the same database shares the same pool, so a thread only ever
+    has a single connection to a database. This also means plugins on the same thread
+    share transactions: a commit or rollback by one of them also commits or rolls back
+    whatever another left uncommitted. Plugins should commit their changes before their
+    handler returns instead of keeping a transaction open across calls. Connections are
+    closed automatically when their thread exits. Connections use WAL so that readers don't block writers, and
+    have a bigger statement cache than the default, since plugins tend to run the
+    same few queries over and over again.
+
+    The pool holds at most 'size' connections. If a thread needs a new connection and
+    the pool is full, it waits for up to 'timeout' seconds for another thread to exit.
+
+    """
+    __pools = {}
+    __pools_lock = threading.Lock()
+
+    def __init__(self, path, size=32, cached_statements=256, timeout=5):
+        self.path = path
+        self.size = size
+        self.cached_statements = cached_statements
+        self.timeout = timeout
+        self.created = 0
+        self.closed = 0
+        self.reused = 0
+        self.__local = threading.local()
+        self.__holders = weakref.WeakSet()
+        self.__cond = threading.Condition()
+
+    def __repr__(self):
+        return "{}('{}', {}/{})".format(self.__class__.__name__, self.path, len(self.__holders), self.size)
+
+    @classmethod
+    def get(cls, path):
+        """Get the pool of a database, creating it if needed.
+
+        """
+        if state_client.active and state_client.serves(path):
+            return state_client.pool
+
+        with cls.__pools_lock:
+            if path not in cls.__pools:
+                cls.__pools[path] = cls(path)
+            return cls.__pools[path]
+
+    @classmethod
+    def pools(cls):
+        with cls.__pools_lock:
+            return cls.__pools.copy()
+
+    @classmethod
+    def close_pools(cls):
+        """Close every connection of every pool.
+
+        """
+        with cls.__pools_lock:
+            pools = list(cls.__pools.values())
+            cls.__pools.clear()
+        for pool in pools:
+            pool.close_all()
+
+    def connect(self):
+        """Get the current thread's connection, opening one if needed.
+
+        """
+        holder = getattr(self.__local, "holder", None)
+        if holder is not None:
+            with self.__cond:
+                self.reused += 1
+            return holder.conn
+
+        with self.__cond:
+            if not self.__cond.wait_for(lambda: len(self.__holders) < self.size, self.timeout):
+                raise sqlite3.OperationalError("The connection pool of '{}' is full.".format(self.path))
+
+            conn = sqlite3.connect(self.path, cached_statements=self.cached_statements)
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute("PRAGMA foreign_keys = ON") # Enforce foreign keys.
+            cursor.execute("PRAGMA busy_timeout = 5000") # Wait 5s if it gets locked.
+            cursor.execute("PRAGMA journal_mode = WAL") # Readers don't block writers.
+            cursor.execute("PRAGMA synchronous = NORMAL") # Safe with WAL, and no fsync per commit.
+
+            holder = ConnectionHolder(conn)
+            # The thread-local is the only strong reference to the holder, so it gets
+            # collected when the thread exits, which in turn closes the connection.
+            holder.finalizer = weakref.finalize(holder, self.__release, conn)
+            self.__holders.add(holder)
+            self.__local.holder = holder
+            self.created += 1
+            return conn
+
+    def is_connected(self, thread=None):
+        """Check if a thread has a connection open. Defaults to the current thread.
+
+        """
+        if thread is None:
+            return getattr(self.__local, "holder", None) is not None
+
+        return any(h.thread == thread.ident for h in list(self.__holders))
+
+    def close(self):
+        """Close the current thread's connection, if any.
+
+        """
+        holder = getattr(self.__local, "holder", None)
+        if holder is not None:
+            del self.__local.holder
+            holder.finalizer()
+
+    def close_all(self):
+        for holder in list(self.__holders):
+            holder.finalizer()
+
+    def stats(self):
+        return {"path": self.path, "size": self.size, "open": len(self.__holders),
+            "created": self.created, "closed": self.closed, "reused": self.reused}
+
+    def __release(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            # Closed by close_all() from another thread. It's closed once the last
+            # reference to it is gone instead.
+            pass
+
+        with self.__cond:
+            self.closed += 1
+            self.__cond.notify()
+
+db_writes = metrics.counter("minqlbot_db_writes_total", "Queued database writes by result.", ("result",))
+db_queries = metrics.histogram("minqlbot_db_query_seconds", "Time spent executing queries, by plugin.", ("plugin",))
+
+class DatabaseWriter():
+    """Writes to a database in batches on a thread of its own.
+
+    Plugins that write something for every event would otherwise need a transaction,
+    and therefore a sync to disk, per event on the network thread. Writes queued here
+    are instead executed in a single transaction whenever 'batch_size' of them have
+    been queued, or 'interval' seconds after the first one of a batch was queued.
+
+    """
+    __writers = {}
+    __writers_lock = threading.Lock()
+    __stopped = False
+
+    def __init__(self, path, interval=0.5, batch_size=100):
+        self.path = path
+        self.interval = interval
+        self.batch_size = batch_size
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+        self.__queue = collections.deque()
+        self.__queued_seq = 0
+        self.__done_seq = 0
+        self.__flushing = False
+        self.__running = True
+        self.__cond = threading.Condition()
+        self.__thread = threading.Thread(target=self.__run, name="minqlbot database writer")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    @classmethod
+    def get(cls, path):
+        """Get the writer of a database, creating it if needed.
+
+        Raises:
+            sqlite3.ProgrammingError: If stop_writers() has been called.
+
+        """
+        with cls.__writers_lock:
+            if cls.__stopped:
+                raise sqlite3.ProgrammingError("Attempted to write after the database writers were stopped.")
+            if path not in cls.__writers:
+                cls.__writers[path] = cls(path)
+            return cls.__writers[path]
+
+    @classmethod
+    def writers(cls):
+        with cls.__writers_lock:
+            return cls.__writers.copy()
+
+    @classmethod
+    def stop_writers(cls):
+        """Write everything that's queued and stop every writer. Writes after this raise
+        instead of starting a new writer.
+
+        """
+        with cls.__writers_lock:
+            cls.__stopped = True
+            writers = list(cls.__writers.values())
+            cls.__writers.clear()
+        for writer in writers:
+            writer.stop()
+
+    def write(self, query, params=(), callback=None):
+        """Queue a write.
+
+        Args:
+            query (str): The query.
+            params (tuple, optional): The query's parameters.
+            callback (callable, optional): Called from the writer's thread once the
+                write's been committed, with None as the argument if it succeeded or
+                the exception if it failed.
+
+        """
+        with self.__cond:
+            if not self.__running:
+                raise sqlite3.ProgrammingError("Attempted to write to a stopped writer.")
+            self.__queue.append((query, params, callback))
+            self.__queued_seq += 1
+            if len(self.__queue) == 1 or len(self.__queue) >= self.batch_size:
+                self.__cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Block until every write queued so far has been committed.
+
+        Returns:
+            False if it timed out, True otherwise.
+
+        """
+        if threading.current_thread() is self.__thread:
+            return False
+
+        with self.__cond:
+            target = self.__queued_seq
+            self.__flushing = True
+            self.__cond.notify_all()
+            return self.__cond.wait_for(lambda: self.__done_seq >= target, timeout)
+
+    def stop(self):
+        with self.__cond:
+            self.__running = False
+            self.__cond.notify_all()
+        if threading.current_thread() is not self.__thread:
+            self.__thread.join()
+
+    def stats(self):
+        with self.__cond:
+            return {"path": self.path, "queued": len(self.__queue), "written": self.written,
+                "batches": self.batches, "errors": self.errors}
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                while self.__running and not self.__queue:
+                    self.__cond.wait()
+                if not self.__queue:
+                    return # Stopped and nothing left to write.
+
+                # Give the batch some time to fill up.
+                deadline = time.monotonic() + self.interval
+                while (self.__running and not self.__flushing and len(self.__queue) < self.batch_size and
+                    time.monotonic() < deadline):
+                    self.__cond.wait(deadline - time.monotonic())
+
+                batch = [self.__queue.popleft() for i in range(min(self.batch_size, len(self.__queue)))]
+                if not self.__queue:
+                    self.__flushing = False
+
+            results = self.__write_batch(batch)
+
+            with self.__cond:
+                self.__done_seq += len(batch)
+                self.__cond.notify_all()
+
+            for (query, params, callback), error in zip(batch, results):
+                if callback:
+                    try:
+                        callback(error)
+                    except:
+                        logger.exception("DatabaseWriter: Exception in a callback of '{}'.", query)
+
+    def __write_batch(self, batch):
+        """Execute a batch in a single transaction and return a list with None or the
+        exception for each write.
+
+        """
+        results = []
+        conn = None
+        try:
+            conn = ConnectionPool.get(self.path).connect()
+            if isinstance(conn, StateConnection):
+                # The service runs the whole batch in a transaction in one round trip.
+                results = conn.execute_batch([(query, params) for query, params, callback in batch])
+                for (query, params, callback), error in zip(batch, results):
+                    db_writes.inc("error" if error else "ok")
+                    if error:
+                        logger.error("DatabaseWriter: '{}' failed: {}", query, error)
+                self.errors += len(results) - results.count(None)
+                self.written += results.count(None)
+                self.batches += 1
+                return results
+
+            cursor = conn.cursor()
+            for query, params, callback in batch:
+                try:
+                    cursor.execute(query, params)
+                    results.append(None)
+                    db_writes.inc("ok")
+                except sqlite3.Error as e:
+                    db_writes.inc("error")
+                    # A failed statement only rolls back itself, so the rest of the batch is fine.
+                    logger.error("DatabaseWriter: '{}' failed: {}", query, e)
+                    self.errors += 1
+                    results.append(e)
+            conn.commit()
+            self.written += results.count(None)
+            self.batches += 1
+        except sqlite3.Error as e:
+            logger.error("DatabaseWriter: Batch of {} writes failed: {}", len(batch), e)
+            # Or the pooled connection stays in the transaction, and the next batch's commit
+            # would save the writes we're about to report as failed.
+            if conn is not None:
+                try:
+                    conn.rollback()
+                except sqlite3.Error as e2:
+                    logger.error("DatabaseWriter: Rollback failed: {}", e2)
+            self.errors += len(batch) - len(results)
+            results.extend([e] * (len(batch) - len(results)))
+            results = [r if r else e for r in results]
+
+        return results
+
+class ConnectionHolder():
+    """Holds a thread's pooled connection. See ConnectionPool.
+
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.thread = threading.get_ident()
+        self.finalizer = None
+
+class StateRequest():
+    """A request sent to the state service. See StateClient.
+
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def complete(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error:
+            raise self.error
+        return self.result
+
+class StateRow(tuple):
+    """A row of a result from the state service. Like sqlite3.Row, it can be indexed by
+    position or by case-insensitive column name.
+
+    """
+    def __new__(cls, values, columns):
+        row = super().__new__(cls, values)
+        row.__columns = columns
+        return row
+
+    def keys(self):
+        return list(self.__columns)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = key.lower()
+            for i, name in enumerate(self.__columns):
+                if name.lower() == key:
+                    return super().__getitem__(i)
+            raise IndexError("No item with that key.")
+        return super().__getitem__(key)
+
+class StateCursor():
+    """Works like a sqlite3.Cursor, but the statements are executed by the state service.
+
+    Executing an INSERT, UPDATE, DELETE or REPLACE doesn't wait for it to finish. Only
+    reading the result does, so writes whose results aren't needed are pipelined. Their
+    errors are raised by the next commit, or whatever else next waits on the service on
+    the same connection. Other statements wait, so that they raise right away like they
+    would with sqlite3, which transactions like the ones of Plugin.db_migrate rely on.
+
+    """
+    arraysize = 1
+    PIPELINED = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.__request = None
+        self.__result = None
+        self.__position = 0
+
+    def execute(self, query, params=()):
+        self.__set_request(self.connection._request("exec", query, list(params)), query)
+        return self
+
+    def executemany(self, query, seq_of_params):
+        self.__set_request(self.connection._request("many", query, [list(p) for p in seq_of_params]), query)
+        return self
+
+    def __set_request(self, request, query):
+        self.__request = request
+        self.__result = None
+        self.__position = 0
+        words = query.split(None, 1)
+        if not words or words[0].upper() not in self.PIPELINED:
+            self.__wait()
+
+    def __wait(self):
+        if self.__result is None:
+            if self.__request is None:
+                return {"rows": [], "columns": None, "lastrowid": None, "rowcount": -1}
+            self.__result = self.connection._wait(self.__request)
+            columns = self.__result.get("columns")
+            if columns:
+                self.__result["rows"] = [StateRow(row, columns) for row in self.__result["rows"]]
+        return self.__result
+
+    @property
+    def lastrowid(self):
+        return self.__wait()["lastrowid"]
+
+    @property
+    def rowcount(self):
+        return self.__wait()["rowcount"]
+
+    @property
+    def description(self):
+        columns = self.__wait()["columns"]
+        return tuple((c, None, None, None, None, None, None) for c in columns) if columns else None
+
+    def fetchone(self):
+        rows = self.__wait()["rows"]
+        if self.__position >= len(rows):
+            return None
+        self.__position += 1
+        return rows[self.__position - 1]
+
+    def fetchmany(self, size=None):
+        rows = self.__wait()["rows"]
+        size = self.arraysize if size is None else size
+        res = rows[self.__position:self.__position + size]
+        self.__position += len(res)
+        return res
+
+    def fetchall(self):
+        rows = self.__wait()["rows"]
+        res = rows[self.__position:]
+        self.__position = len(rows)
+        return res
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def close(self):
+        pass
+
+class StateConnection():
+    """Works like a sqlite3.Connection with sqlite3.Row as the row factory, but has a
+    session of the state service behind it. See StateCursor.
+
+    """
+    def __init__(self, client):
+        self.client = client
+        self.session = client.new_session()
+        self.row_factory = sqlite3.Row
+        self.__isolation_level = ""
+        self.__unchecked = collections.deque()
+
+    def _request(self, op, *args):
+        request = self.client.request(self.session, op, *args)
+        self.__unchecked.append(request)
+        # Drop the ones that finished fine so that a long pipeline doesn't keep them around.
+        while self.__unchecked and self.__unchecked[0].done.is_set() and not self.__unchecked[0].error:
+            self.__unchecked.popleft()
+        return request
+
+    def _wait(self, request):
+        """Wait for a request, raising its error or that of an earlier one nobody waited for."""
+        try:
+            return request.wait()
+        finally:
+            unchecked, self.__unchecked = self.__unchecked, collections.deque()
+            for r in unchecked:
+                if r is not request and r.done.is_set() and r.error:
+                    raise r.error
+
+    def cursor(self):
+        return StateCursor(self)
+
+    def execute(self, query, params=()):
+        return self.cursor().execute(query, params)
+
+    def executemany(self, query, seq_of_params):
+        return self.cursor().executemany(query, seq_of_params)
+
+    def execute_batch(self, statements):
+        """Execute (query, params) pairs in a single transaction with a single round trip.
+
+        Returns:
+            A list with None or the exception of each statement.
+
+        """
+        errors = self._wait(self._request("batch", [[q, list(p)] for q, p in statements]))
+        return [self.client.error(*e) if e else None for e in errors]
+
+    def commit(self):
+        self._wait(self._request("commit"))
+
+    def rollback(self):
+        self._wait(self._request("rollback"))
+
+    def close(self):
+        self.client.close_session(self.session)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # Like sqlite3, commit or roll back, but don't close.
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    @property
+    def in_transaction(self):
+        return self._wait(self._request("state"))["in_transaction"]
+
+    @property
+    def isolation_level(self):
+        return self.__isolation_level
+
+    @isolation_level.setter
+    def isolation_level(self, level):
+        self.__isolation_level = level
+        self._request("isolation", level)
+
+class StatePool():
+    """Stands in for ConnectionPool when the database is owned by the state service, with
+    a session per thread instead of a connection per thread.
+
+    """
+    def __init__(self, client):
+        self.client = client
+        self.created = 0
+        self.closed = 0
+        self.reused = 0
+        self.__local = threading.local()
+        self.__holders = weakref.WeakSet()
+        self.__lock = threading.Lock()
+
+    @property
+    def path(self):
+        return self.client.address
+
+    def connect(self):
+        holder = getattr(self.__local, "holder", None)
+        if holder is not None:
+            with self.__lock:
+                self.reused += 1
+            return holder.conn
+
+        conn = StateConnection(self.client)
+        holder = ConnectionHolder(conn)
+        holder.finalizer = weakref.finalize(holder, self.__release, conn)
+        self.__holders.add(holder)
+        self.__local.holder = holder
+        with self.__lock:
+            self.created += 1
+        return conn
+
+    def is_connected(self, thread=None):
+        if thread is None:
+            return getattr(self.__local, "holder", None) is not None
+        return any(h.thread == thread.ident for h in list(self.__holders))
+
+    def close(self):
+        holder = getattr(self.__local, "holder", None)
+        if holder is not None:
+            del self.__local.holder
+            holder.finalizer()
+
+    def close_all(self):
+        for holder in list(self.__holders):
+            holder.finalizer()
+
+    def stats(self):
+        return {"path": self.path, "size": 0, "open": len(self.__holders),
+            "created": self.created, "closed": self.closed, "reused": self.reused}
+
+    def __release(self, conn):
+        conn.close()
+        with self.__lock:
+            self.closed += 1
+
+state_requests = metrics.counter("minqlbot_state_requests_total", "Requests sent to the state service.")
+state_invalidations = metrics.counter("minqlbot_state_invalidations_total",
+    "Cache invalidations pushed by the state service, by table.", ("table",))
+
+class StateClient():
+    """The connection to a state service (see state_service.py) that owns the database
+    on behalf of several bots. When the StateService option is set, Plugin.db_pool()
+    and DatabaseWriter use it instead of opening the DatabasePath file, so db_query and
+    friends work the same, but every bot on the host sees the same data. Any other
+    database is still opened locally.
+
+    Requests are pipelined and sent in batches by a thread of their own. The service
+    pushes the names of watched tables, like Players and Bans, whenever a bot changes
+    them, and the hooks added for them are called from the client's thread. Players
+    invalidates minqlbot.PERMISSION_CACHE. Plugins with caches of their own can add hooks.
+    After a reconnect, every hook is called, since pushes could have been missed.
+
+    If the service can't be reached, requests wait up to TIMEOUT seconds for the
+    connection to come back and then raise sqlite3.OperationalError.
+
+    """
+    TIMEOUT = 5
+    RETRY_MIN = 0.5
+    RETRY_MAX = 10
+
+    def __init__(self):
+        self.address = None
+        self.database = None
+        self.connected = False
+        self.pool = StatePool(self)
+        self.__cond = threading.Condition()
+        self.__sock = None
+        self.__frames = collections.deque()
+        self.__waiting = {}
+        self.__next_id = 0
+        self.__next_session = 0
+        self.__hooks = {"Players": [permission_cache.invalidate]}
+        self.__running = False
+
+    @property
+    def active(self):
+        return self.address is not None
+
+    def configure(self, address, database):
+        """Use the service at 'address' in place of the database file at 'database', or go
+        back to the file if 'address' is empty. Other databases are always opened locally."""
+        self.database = database
+        if address == (self.address or ""):
+            return
+        self.stop()
+        if address:
+            self.start(address)
+
+    def serves(self, path):
+        """Whether the service stands in for the database at 'path'."""
+        return self.database is not None and os.path.abspath(path) == os.path.abspath(self.database)
+
+    def start(self, address):
+        """Connect in the background. This is called by load_config on the game thread,
+        so it doesn't wait for the connection. The first requests do, up to TIMEOUT."""
+        family, addr = minqlbot.parse_address(address)
+        with self.__cond:
+            self.address = address
+            self.__running = True
+        for target, name in ((self.__connect, "connector"), (self.__write, "writer")):
+            thread = threading.Thread(target=target, args=(family, addr), name="minqlbot state client " + name)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self.pool.close_all()
+        with self.__cond:
+            self.__running = False
+            self.address = None
+            sock = self.__sock
+            self.__cond.notify_all()
+        if sock:
+            self.__lost(sock)
+
+    def add_invalidation_hook(self, table, hook):
+        """Call 'hook' without arguments whenever another bot, or this one, changes 'table'."""
+        with self.__cond:
+            self.__hooks.setdefault(table, []).append(hook)
+
+    def remove_invalidation_hook(self, table, hook):
+        with self.__cond:
+            if hook in self.__hooks.get(table, ()):
+                self.__hooks[table].remove(hook)
+
+    def new_session(self):
+        with self.__cond:
+            self.__next_session += 1
+            return self.__next_session
+
+    def close_session(self, session):
+        with self.__cond:
+            if self.connected:
+                self.__frames.append(["close", session])
+                self.__cond.notify_all()
+
+    def request(self, session, op, *args):
+        request = StateRequest()
+        with self.__cond:
+            if not self.__cond.wait_for(lambda: self.connected or not self.__running, self.TIMEOUT) or not self.connected:
+                raise sqlite3.OperationalError("Not connected to the state service at {}.".format(self.address))
+            self.__next_id += 1
+            self.__waiting[self.__next_id] = request
+            self.__frames.append(["req", self.__next_id, session, op] + list(args))
+            self.__cond.notify_all()
+        state_requests.inc()
+        return request
+
+    @staticmethod
+    def error(name, msg):
+        """Turn an error sent by the service back into an exception."""
+        cls = getattr(sqlite3, name, None)
+        if not isinstance(cls, type) or not issubclass(cls, sqlite3.Error):
+            cls = sqlite3.Error
+        return cls(msg)
+
+    def __connect(self, family, addr):
+        delay = self.RETRY_MIN
+        while True:
+            with self.__cond:
+                self.__cond.wait_for(lambda: not self.connected or not self.__running)
+                if not self.__running:
+                    return
+
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.connect(addr)
+            except OSError as e:
+                sock.close()
+                logger.error("Couldn't connect to the state service at {}: {}", self.address, e)
+                time.sleep(delay)
+                delay = min(delay * 2, self.RETRY_MAX)
+                continue
+
+            delay = self.RETRY_MIN
+            with self.__cond:
+                if not self.__running:
+                    sock.close()
+                    return
+                self.__sock = sock
+                self.connected = True
+                self.__cond.notify_all()
+            thread = threading.Thread(target=self.__read, args=(sock,), name="minqlbot state client reader")
+            thread.daemon = True
+            thread.start()
+            logger.info("Connected to the state service at {}.", self.address)
+            # We don't know what we missed while we were gone.
+            self.__invalidate(None)
+
+    def __lost(self, sock):
+        with self.__cond:
+            if self.__sock is not sock:
+                return
+            self.__sock = None
+            self.connected = False
+            self.__frames.clear()
+            waiting, self.__waiting = self.__waiting, {}
+            self.__cond.notify_all()
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+        for request in waiting.values():
+            request.complete(error=sqlite3.OperationalError("Lost the connection to the state service."))
+        if self.__running:
+            logger.warning("Lost the connection to the state service at {}.", self.address)
+
+    def __write(self, family, addr):
+        while True:
+            with self.__cond:
+                self.__cond.wait_for(lambda: (self.connected and self.__frames) or not self.__running)
+                if not self.__running:
+                    return
+                sock = self.__sock
+                frames = list(self.__frames)
+                self.__frames.clear()
+            try:
+                sock.sendall(b"".join(minqlbot.encode_frame(frame) for frame in frames))
+            except OSError:
+                self.__lost(sock)
+
+    def __read(self, sock):
+        reader = minqlbot.FrameReader()
+        while True:
+            try:
+                data = sock.recv(65536)
+                frames = reader.feed(data)
+            except (OSError, ValueError):
+                data = None
+            if not data:
+                self.__lost(sock)
+                return
+
+            for frame in frames:
+                if frame[0] == "invalidate":
+                    self.__invalidate(frame[1])
+                    continue
+                with self.__cond:
+                    request = self.__waiting.pop(frame[1], None)
+                if request is None:
+                    continue
+                elif frame[0] == "ok":
+                    request.complete(frame[2])
+                else:
+                    request.complete(error=self.error(frame[2], frame[3]))
+
+    def __invalidate(self, tables):
+        """Call the hooks of the tables, or of every table if None."""
+        with self.__cond:
+            if tables is None:
+                tables = list(self.__hooks)
+            hooks = [(t, h) for t in tables for h in self.__hooks.get(t, ())]
+        for table in tables:
+            state_invalidations.inc(table)
+        for table, hook in hooks:
+            try:
+                hook()
+            except:
+                logger.exception("StateClient: Exception in an invalidation hook of '{}'.", table)
+
+state_client = StateClient()
+setattr(minqlbot, "STATE_CLIENT", state_client)
+
 class NonexistentPlayerError(Exception):
     pass
 
@@ -468,6 +2062,8 @@ class CaEndStats(Stats):
         self.hmg_kills = scores[30]
         self._wpn15_accuracy = scores[31]
         self._wpn15_kills = scores[32]
+        # Accuracy and kills of every weapon, in pairs, in the same order as above.
+        self.weapons = scores[3:33]
 
 class RaceScores(Scores):
     def __init__(self, scores):
@@ -507,11 +2103,17 @@ class Plugin():
     # Static dictionary of plugins currently loaded for the purpose of inter-plugin communication.
     __loaded_plugins = {}
 
+    # Schema migrations of the plugin's tables. See db_migrate().
+    db_migrations = []
+
+    # Commands and events that activate the plugin. If any are declared, loading the plugin
+    # only imports it, and it's instantiated the first time one of them fires.
+    lazy_commands = ()
+    lazy_events = ()
+
     def __init__(self):
         self.__hooks = []
         self.__commands = []
-        self.db_connections = {}
-        self.db_lock = threading.Lock()
 
     @property
     def name(self):
@@ -550,12 +2152,21 @@ class Plugin():
         """
         return DummyPlayer(name)
 
-    def add_hook(self, event, handler, priority=minqlbot.PRI_NORMAL):
+    def add_hook(self, event, handler, priority=minqlbot.PRI_NORMAL, coalesce=minqlbot.COALESCE_NONE, window=100):
+        """Hook an event.
+
+        Args:
+            coalesce (int, optional): minqlbot.COALESCE_LATEST or minqlbot.COALESCE_BURST
+                to have bursts of the event call the handler only once with the latest
+                payload, from a timer thread. See minqlbot.CoalescedHandler for details.
+            window (int, optional): The coalescing window in milliseconds.
+
+        """
         if not hasattr(self, "_Plugin__hooks"):
             self.__hooks = []
             
+        minqlbot.EVENT_HANDLERS[event].add_hook(self.name, handler, priority, coalesce, window)
         self.__hooks.append((event, handler, priority))
-        minqlbot.EVENT_HANDLERS[event].add_hook(self.name, handler, priority)
 
     def remove_hook(self, event, handler, priority=minqlbot.PRI_NORMAL):
         if not hasattr(self, "_Plugin__hooks"):
@@ -636,27 +2247,56 @@ class Plugin():
             return None
         
     @classmethod
-    def debug(cls, msg, only_debug=False):
+    def debug(cls, msg, *args, only_debug=False):
         """Send a debug string that can be picked up by DebugView or similar applications.
         
         Args:
-            msg (str): The string to be passed.
-            only_debug (bool, optional): If true, only send if this is a debug build.
-                Send otherwise.
+            msg (str): The string to be passed. If args are given, it's formatted with
+                msg.format(*args) only if it's actually going to be logged.
+            only_debug (bool, optional): If true, only send if the log level is
+                minqlbot.LOG_DEBUG, which is the default in debug builds. Send otherwise.
         
         """
-        if only_debug and not minqlbot.IS_DEBUG:
-            return
+        logger.log(minqlbot.LOG_DEBUG if only_debug else minqlbot.LOG_INFO,
+            "[{}] {}", cls.__name__, LazyFormat(msg, args))
+
+    @classmethod
+    def send_command(cls, cmd, priority=None):
+        """Queue a command in minqlbot.COMMAND_QUEUE, which passes it on to minqlbot.send_command.
+
+        Args:
+            cmd (str): The command.
+            priority (int, optional): One of the minqlbot.SEND_PRI_* classes. Defaults to
+                the class the command belongs to.
+
+        Returns:
+            A QueuedCommand instance that can be used to cancel the command while it's pending.
+
+        """
+        if cls is Plugin:
+            return command_scheduler.send(cmd, priority=priority)
         else:
-            minqlbot.debug("[{}] {}".format(cls.__name__, str(msg)))
+            return command_scheduler.send(cmd, cls.__name__, priority)
 
     @classmethod
-    def send_command(cls, cmd):
-        """minqlbot.send_command is a C++ function, so we wrap it for Python debugging purposes.
+    def cancel_commands(cls):
+        """Cancel every pending command sent by this plugin.
 
         """
-        minqlbot.send_command(cmd)
-    
+        return command_scheduler.cancel_plugin(cls.__name__)
+
+    @classmethod
+    def profile(cls, seconds, target=None, callback=None):
+        """Profile the dispatch path for 'seconds' seconds. If 'target' is an event, command
+        or plugin name, only the matching handlers are profiled. 'callback' is called with
+        the path of the report once it's written.
+
+        Returns:
+            False if a profile is already running, True otherwise.
+
+        """
+        return minqlbot.PROFILER.start(seconds, target, callback)
+
     @classmethod
     def msg(cls, msg, chat_channel="chat"):
         """Send a message to the chat, private message, or the console.
@@ -1095,54 +2735,153 @@ class Plugin():
 
         """
         c = self.db_connect().cursor()
-        return c.execute(query, params)
+        if minqlbot.IS_DEBUG:
+            self.db_check_query_plan(c, query, params)
+        start = time.perf_counter()
+        try:
+            return c.execute(query, params)
+        finally:
+            db_queries.observe(time.perf_counter() - start, self.name)
+
+    # Queries whose plan has already been checked by db_check_query_plan().
+    __checked_queries = set()
+
+    @classmethod
+    def db_check_query_plan(cls, cursor, query, params=()):
+        """Report queries that do a full table scan. Only called in debug builds by
+        db_query, and only once per query.
+
+        """
+        if query in cls.__checked_queries:
+            return
+        cls.__checked_queries.add(query)
+        if not query.lstrip()[:6].upper() in ("SELECT", "UPDATE", "DELETE"):
+            return
+
+        try:
+            for row in cursor.execute("EXPLAIN QUERY PLAN " + query, params).fetchall():
+                detail = row[-1]
+                if detail.startswith("SCAN") and "INDEX" not in detail:
+                    cls.debug("Full table scan ({}): {}".format(detail, query))
+        except sqlite3.Error:
+            pass
+
+    @classmethod
+    def db_migrate(cls, name=None):
+        """Bring the plugin's tables up to date by running the migrations in 'db_migrations'.
+
+        'db_migrations' is a list where each migration is either a single SQL statement or a
+        function taking a cursor. Every migration that's been run gets a row in the Migrations
+        table, keyed by the plugin's name and the migration's version (its position in the list,
+        starting at 1), so adding a migration at the end of the list will make it run next time
+        the plugin's loaded. Migrations should never be removed or changed once released.
+
+        Called with the plugin's name when it's loaded, before it's instantiated. Pending
+        migrations are run in a single transaction, so either they all succeed or nothing changes.
+
+        """
+        if not cls.db_migrations:
+            return
+        if name is None:
+            name = cls.__name__
+
+        conn = cls.db_pool().connect()
+        # The connection is shared by the thread, so don't touch someone else's transaction.
+        if conn.in_transaction:
+            raise sqlite3.OperationalError("Can't migrate '{}' while this thread's connection is in a transaction."
+                .format(name))
+        isolation_level = conn.isolation_level
+        # Python's sqlite3 commits before DDL statements unless we handle transactions ourselves.
+        conn.isolation_level = None
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN")
+            try:
+                cls.__create_migrations_table(cursor)
+                version = cursor.execute("SELECT MAX(version) FROM Migrations WHERE plugin=?", (name,)).fetchone()[0] or 0
+                for i, migration in enumerate(cls.db_migrations[version:], version + 1):
+                    if callable(migration):
+                        migration(cursor)
+                    else:
+                        cursor.execute(migration)
+                    # No OR REPLACE, so that a bot migrating at the same time makes us roll back.
+                    cursor.execute("INSERT INTO Migrations VALUES (?, ?, ?)", (name, i, int(time.time())))
+                if version < len(cls.db_migrations):
+                    cls.debug("Migrated schema from version {} to {}.".format(version, len(cls.db_migrations)))
+                cursor.execute("COMMIT")
+            except:
+                # Only roll back our own transaction, and only if it's still open.
+                if conn.in_transaction:
+                    cursor.execute("ROLLBACK")
+                raise
+        finally:
+            conn.isolation_level = isolation_level
+
+    @staticmethod
+    def __create_migrations_table(cursor):
+        columns = [row[1] for row in cursor.execute("PRAGMA table_info(Migrations)")]
+        if columns and "time" not in columns:
+            # Databases from before migrations were recorded one by one only kept the number
+            # that had been run, so write out a row for each of them.
+            rows = cursor.execute("SELECT plugin, version FROM Migrations").fetchall()
+            cursor.execute("DROP TABLE Migrations")
+        else:
+            rows = []
+        cursor.execute("CREATE TABLE IF NOT EXISTS Migrations (plugin TEXT NOT NULL, version INTEGER NOT NULL, "
+            "time INTEGER, PRIMARY KEY (plugin, version))")
+        cursor.executemany("INSERT INTO Migrations VALUES (?, ?, NULL)",
+            [(plugin, v) for plugin, version in rows for v in range(1, version + 1)])
     
     def db_querymany(self, query, *params):
         c = self.db_connect().cursor()
         return c.executemany(query, params)
 
+    @classmethod
+    def db_pool(cls):
+        """Get the connection pool of the database specified in the config.
+
+        """
+        return ConnectionPool.get(minqlbot.get_config()["Core"]["DatabasePath"])
+
     def db_connect(self):
         """Returns a connection for the current thread.
 
+        The connection is shared with every other plugin on the same thread.
+
         """
-        thread = threading.current_thread()
-        if not self.db_is_connected(thread):
-            db = minqlbot.get_config()["Core"]["DatabasePath"]
-            conn = sqlite3.connect(db)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("PRAGMA foreign_keys = ON") # Enforce foreign keys.
-            cursor.execute("PRAGMA busy_timeout = 5000") # Wait 5s if it gets locked.
-            with self.db_lock:
-                self.db_connections[thread] = conn
-            return conn
-        else:
-            with self.db_lock:
-                return self.db_connections[thread]
+        return self.db_pool().connect()
 
     def db_is_connected(self, thread=None):
         """Check if the current thread has a connection open.
 
         """
-        if thread == None:
-            thread = threading.current_thread()
+        return self.db_pool().is_connected(thread)
+    
+    def db_write_async(self, query, *params, callback=None):
+        """Queue a write to be done on the database writer's thread, batched with other writes.
+
+        Use this instead of db_query followed by db_commit when writing on every event and
+        the result isn't needed right away. If 'callback' is passed, it'll be called from the
+        writer's thread once the write is committed, with None or the exception as the argument.
+
+        """
+        DatabaseWriter.get(minqlbot.get_config()["Core"]["DatabasePath"]).write(query, params, callback)
 
-        # A lock for accessing the connections dictionary.
-        if not hasattr(self, "db_lock"):
-            self.db_lock = threading.Lock()
+    def db_flush(self, timeout=None):
+        """Block until every write queued with db_write_async so far has been committed.
 
-        with self.db_lock:
-            if not hasattr(self, "db_connections"):
-                self.db_connections = {}
+        """
+        writer = DatabaseWriter.writers().get(minqlbot.get_config()["Core"]["DatabasePath"])
+        if writer:
+            return writer.flush(timeout)
+        return True
 
-            if thread in self.db_connections:
-                return True
-            else:
-                return False
-    
     def db_commit(self):
         """Commit database changes on the plugin's connection.
 
+        The connection is shared with every other plugin on the same thread, so this also
+        commits anything they've left uncommitted on it.
+
         """
         if self.db_is_connected():
             self.db_connect().commit()
@@ -1150,68 +2889,98 @@ class Plugin():
     def db_close(self):
         """Close the database connection of the current thread.
 
-        Connections can be left open, but keep in mind that open transactions will
-        be discarded if the connection is unreferenced by the time the garbage collector
-        comes around. However, considering we keep a dictionary with the connections,
-        we could potentially end up with a lot of open connections on dead threads.
-        To avoid that, we make this function also check for dead threads and remove
-        the reference to them.
+        Connections are closed automatically when their thread exits, so this can be
+        left out. Since the connection is shared with other plugins on the same thread,
+        it's left open if it's in the middle of a transaction, as closing it would
+        discard the changes.
 
         """
-        if self.db_is_connected():
-            self.db_connect().close()
-            thread = threading.current_thread()
-            del self.db_connections[thread]
-
-        self.db_check_dead_threads()
-
+        pool = self.db_pool()
+        if pool.is_connected() and not pool.connect().in_transaction:
+            pool.close()
 
     def db_check_dead_threads(self):
-        """Check for dead threads and remove the reference to its connection.
+        """Kept for compatibility. Connections of dead threads are now closed by the pool.
 
         """
-        # A lock for accessing the connections dictionary.
-        if not hasattr(self, "db_lock"):
-            self.db_lock = threading.Lock()
-
-        with self.db_lock:
-            for thread in self.db_connections.copy():
-                # threading.current_thread() returns a _DummyThread instance if it's a thread not
-                # created by Python. Unfortunately, calling is_alive() on one will throw an exception.
-                # It's some really fucked up behavior by Python, because even __repr__() calls
-                # is_alive() at some point, meaning we can't even use str() on the god damn instance.
-                # Luckily, we don't really make threads outside of Python that die, so if an
-                # AssertionError exception is raised, we know it's a dummy thread we can skip.
-                try:
-                    if not thread.is_alive():
-                        self.debug("Thread reference '{}' deleted!".format(thread.ident))
-                        del self.db_connections[thread]
-                except AssertionError:
-                    continue
+        pass
 
     
-    def get_permission(self, player):
-        """Get a player's permission level.
-
-        """
+    @classmethod
+    def __permission_key(cls, player):
         if isinstance(player, str):
-            clean = self.clean_name(player).lower()
+            return cls.clean_name(player).lower()
         elif isinstance(player, Player):
-            clean = player.clean_name.lower()
+            return player.clean_name.lower()
         elif isinstance(player, int):
-            clean = self.player(player).clean_name.lower()
+            return cls.player(player).clean_name.lower()
         else:
             return None
 
+    def get_permission(self, player):
+        """Get a player's permission level.
+
+        Levels are cached by minqlbot.PERMISSION_CACHE.
+
+        """
+        clean = self.__permission_key(player)
+        if clean is None:
+            return None
+
         if clean == minqlbot.NAME.lower():
             return 999
+
+        level = permission_cache.get(clean)
+        if level is not PermissionCache.MISSING:
+            return level
         
         c = self.db_query("SELECT permission FROM Players WHERE name=?", clean)
         row = c.fetchone()
         if row:
-            return row[0]
+            level = row[0]
         else:
-            return None
+            level = None
+
+        permission_cache.put(clean, level)
+        return level
+
+    def warm_permissions(self, players=None):
+        """Cache the permission levels of several players with a single query.
+
+        Args:
+            players (list, optional): Names or Player instances. Defaults to the
+                players currently on the server.
+
+        """
+        if players is None:
+            players = self.players()
+
+        names = set(self.__permission_key(p) for p in players)
+        names.discard(None)
+        names = permission_cache.missing(names)
+        if not names:
+            return
+
+        levels = dict.fromkeys(names)
+        c = self.db_query("SELECT name, permission FROM Players WHERE name IN ({})"
+            .format(", ".join("?" * len(names))), *names)
+        for row in c:
+            levels[row[0]] = row[1]
+
+        for name in levels:
+            permission_cache.put(name, levels[name])
+
+    @classmethod
+    def invalidate_permission(cls, player=None):
+        """Drop a player's cached permission level. Should be called whenever a plugin
+        changes a player's permission in the database. Drops every player's cached
+        level if no player is passed.
+
+        """
+        if player is None:
+            permission_cache.invalidate()
+        else:
+            permission_cache.invalidate(cls.__permission_key(player))
 
     def has_permission(self, player, level=5):
         """Check if a player has at least a certain permission level.
@@ -1230,6 +2999,7 @@ class Plugin():
 
 
 # Export the classes.
+setattr(minqlbot, "NonexistentPlayerError",  NonexistentPlayerError)
 setattr(minqlbot, "Player",  Player)
 setattr(minqlbot, "DummyPlayer", DummyPlayer)
 setattr(minqlbot, "Game",  Game)
@@ -1238,6 +3008,11 @@ setattr(minqlbot, "Stats",  Stats)
 setattr(minqlbot, "CaScores",  CaScores)
 setattr(minqlbot, "CaEndStats",  CaEndStats)
 setattr(minqlbot, "RaceScores",  RaceScores)
+setattr(minqlbot, "PermissionCache",  PermissionCache)
+setattr(minqlbot, "QueuedCommand",  QueuedCommand)
+setattr(minqlbot, "CommandScheduler",  CommandScheduler)
+setattr(minqlbot, "ConnectionPool",  ConnectionPool)
+setattr(minqlbot, "DatabaseWriter",  DatabaseWriter)
 setattr(minqlbot, "Plugin",  Plugin)
 
 # ====================================================================
@@ -0,0 +1,291 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Runs plugins in a process of their own, so that heavy ones don't hold up the game.
+
+The bot streams whatever the native module passes to it to the address in its PluginHost
+option. This runs plugin.py and minqlbot.py against a stand-in for the native module that
+is fed by that stream, so plugins get the same API and events they'd get in the game.
+Commands and console prints go back to the bot, where they're queued like any plugin's.
+
+Usage:
+    python plugin_host.py unix:/tmp/minqlbot.sock --config python/host.cfg
+
+The config is a regular one with the plugins to run here in Plugins, but with its own
+DatabasePath and an empty PluginHost. If the bot goes away, we keep trying to reconnect.
+
+"""
+
+import os
+import sys
+import time
+import types
+import socket
+import argparse
+import threading
+import traceback
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Connection states in the same order as the client's.
+CA_DISCONNECTED = 1
+CA_CONNECTING = 3
+CA_LOADING = 6
+CA_PRIMED = 7
+CA_ACTIVE = 8
+
+class RemoteQuake:
+    """The stand-in for the native module, with a mirror of the bot's configstrings."""
+    # Seconds between attempts to reconnect, doubled up to RETRY_MAX.
+    RETRY_MIN = 0.5
+    RETRY_MAX = 10
+
+    def __init__(self, address, config_file):
+        self.address = address
+        self.config_file = config_file
+        self.configstrings = {}
+        self.status = CA_DISCONNECTED
+        self.namespace = None
+        self.dropped = 0
+        self.__sock = None
+        self.__send_lock = threading.Lock()
+        self.__bcs = {}
+        self.__running = False
+        self.module = self.__make_module()
+
+    def __make_module(self):
+        module = types.ModuleType("minqlbot")
+        module.debug = self.debug
+        module.debug_ex = self.debug_ex
+        module.send_command = self.send_command
+        module.console_print = self.console_print
+        module._configstring = self._configstring
+        module._configstring_range = self._configstring_range
+        module.version = lambda: "plugin host"
+        module.reinitialize = lambda: 0
+        module.connection_status = lambda: self.status
+        module.get_cvar = self.get_cvar
+        module.console_command = self.console_command
+        module.IS_DEBUG = False
+        return module
+
+    # ====================================================================
+    #                     THE NATIVE MODULE'S FUNCTIONS
+    # ====================================================================
+
+    def debug(self, msg):
+        print(msg, flush=True)
+
+    def debug_ex(self, msg, newline=True):
+        print(msg, end="\n" if newline else "", flush=True)
+
+    def send_command(self, cmd):
+        self.__send("send", cmd)
+
+    def console_print(self, msg):
+        # The bot echoes it back to us like the game does.
+        self.__send("print", msg)
+
+    def _configstring(self, index):
+        return self.configstrings.get(index, "")
+
+    def _configstring_range(self, i, j):
+        if i > 1023 or j > 1023:
+            return {}
+        return dict((k, v) for k, v in self.configstrings.items() if i <= k <= j)
+
+    def get_cvar(self, name):
+        # Cvars live in the game, and the stream doesn't carry them.
+        return None
+
+    def console_command(self, cmd):
+        self.debug("The plugin host can't execute console commands: {}".format(cmd))
+
+    def __send(self, *frame):
+        # Blocks while the bot isn't reading, which holds up our command queue and
+        # leaves the commands waiting there instead.
+        with self.__send_lock:
+            if self.__sock is None:
+                self.dropped += 1
+                return
+            try:
+                self.__sock.sendall(self.module.encode_frame(frame))
+            except OSError:
+                self.dropped += 1 # The reader notices and reconnects.
+
+    # ====================================================================
+    #                             RUNNING
+    # ====================================================================
+
+    def load(self):
+        """Run plugin.py and minqlbot.py like python.cpp does, and load the config and
+        plugins like the main block does."""
+        sys.modules["minqlbot"] = self.module
+        namespace = {"__name__": "minqlbot_host", "minqlbot": self.module}
+        for name in ("plugin.py", "minqlbot.py"):
+            path = os.path.join(HERE, name)
+            with open(path) as f:
+                exec(compile(f.read(), path, "exec"), namespace)
+        self.namespace = namespace
+        # The bot's queue paces what we send, so there's no need to wait here as well.
+        self.module.COMMAND_QUEUE.DELAY = 0
+        # Tell the bot which plugin sent a command, so that it can queue them fairly.
+        self.module.COMMAND_QUEUE.pass_on = lambda qcmd: self.__send("send", qcmd.cmd, qcmd.plugin)
+        namespace["load_config"](self.config_file)
+        namespace["Core"].db_migrate()
+        namespace["load_preset_plugins"]()
+
+    def unload(self):
+        self.__running = False
+        if self.namespace:
+            self.namespace["handle_unload"]()
+            self.namespace = None
+        self.__close()
+
+    def run(self):
+        """Connect to the bot and handle what it sends until unload() is called."""
+        self.__running = True
+        delay = self.RETRY_MIN
+        family, addr = self.namespace["parse_address"](self.address)
+        while self.__running:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.connect(addr)
+            except OSError as e:
+                sock.close()
+                self.debug("Couldn't connect to the bot at {}: {}".format(self.address, e))
+                time.sleep(delay)
+                delay = min(delay * 2, self.RETRY_MAX)
+                continue
+
+            delay = self.RETRY_MIN
+            with self.__send_lock:
+                self.__sock = sock
+            self.debug("Connected to the bot at {}.".format(self.address))
+            self.__read(sock)
+            self.__close()
+            if self.__running:
+                self.debug("Lost the connection to the bot.")
+            self.__lost()
+
+    def __close(self):
+        with self.__send_lock:
+            sock, self.__sock = self.__sock, None
+        if sock:
+            sock.close()
+
+    def __lost(self):
+        """The bot's gone, so as far as plugins know, we're disconnected."""
+        self.__bcs.clear()
+        if self.status != CA_DISCONNECTED and self.namespace:
+            self.status = CA_DISCONNECTED
+            self.namespace["handle_connection_status"](CA_DISCONNECTED)
+
+    def __read(self, sock):
+        reader = self.module.FrameReader()
+        while self.__running:
+            try:
+                data = sock.recv(65536)
+                frames = reader.feed(data)
+            except (OSError, ValueError) as e:
+                if self.__running:
+                    self.debug("Plugin host connection error: {}".format(e))
+                return
+            if not data:
+                return
+            for frame in frames:
+                try:
+                    self.__handle(frame)
+                except Exception:
+                    # Like the game, print it and carry on.
+                    self.debug(traceback.format_exc().rstrip("\n"))
+
+    def __handle(self, frame):
+        kind = frame[0]
+        ns = self.namespace
+        if kind == "msg":
+            ns["handle_message"](frame[1])
+            self.__update(frame[1])
+        elif kind == "gamestate":
+            self.configstrings[frame[1]] = frame[2]
+            ns["handle_gamestate"](frame[1], frame[2])
+        elif kind == "status":
+            if frame[1] == CA_LOADING:
+                self.configstrings.clear() # A new gamestate's coming.
+            self.status = frame[1]
+            ns["handle_connection_status"](frame[1])
+        elif kind == "print":
+            ns["handle_console_print"](frame[1])
+        elif kind == "hello":
+            self.__hello(frame[1])
+        else:
+            self.debug("Unknown frame from the bot: {}".format(kind))
+
+    def __hello(self, hello):
+        """Catch up with the bot as if we'd just connected to the server along with it."""
+        self.__lost()
+        setattr(self.module, "__version__", hello["version"])
+        if hello["name"]:
+            setattr(self.module, "NAME", hello["name"])
+        self.configstrings = dict((int(k), v) for k, v in hello["configstrings"].items())
+        if hello["status"] != CA_ACTIVE:
+            self.status = hello["status"]
+            self.namespace["handle_connection_status"](self.status)
+            return
+
+        for status in (CA_CONNECTING, CA_LOADING):
+            self.status = status
+            self.namespace["handle_connection_status"](status)
+        for index in sorted(self.configstrings):
+            self.namespace["handle_gamestate"](index, self.configstrings[index])
+        for status in (CA_PRIMED, CA_ACTIVE):
+            self.status = status
+            self.namespace["handle_connection_status"](status)
+
+    def __update(self, cmd):
+        """Update the mirror like the client does after the bot's seen the command."""
+        if cmd.startswith("cs "):
+            index, _, value = cmd[3:].partition(" ")
+            self.configstrings[int(index)] = value.strip('"')
+        elif cmd.startswith("bcs"):
+            index, _, value = cmd[5:].partition(" ")
+            index = int(index)
+            if cmd[3] == "0":
+                self.__bcs[index] = value.strip('"')
+            elif index in self.__bcs:
+                self.__bcs[index] += value.strip('"')
+                if cmd[3] == "2":
+                    self.configstrings[index] = self.__bcs.pop(index)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("address", help='The bot\'s PluginHost, like "unix:/tmp/minqlbot.sock" or "127.0.0.1:27961".')
+    parser.add_argument("--config", default=os.path.join("python", "host.cfg"))
+    args = parser.parse_args()
+
+    host = RemoteQuake(args.address, args.config)
+    host.load()
+    try:
+        host.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        host.unload()
+
+if __name__ == "__main__":
+    main()
@@ -45,6 +45,53 @@ object handle_unload;
 
 using namespace boost::python;
 
+// Runs the core scripts from cached code objects when possible. They're kept in memory
+// on the minqlbot module for "\bot restart", and marshaled to python/__pycache__ for the
+// next time the game starts. Either way, they're keyed by the hash of the source, so
+// a changed script is always recompiled. Timings end up in minqlbot.STARTUP_TIMES.
+const char * BOOTSTRAP = R"PY(
+import os
+import time
+import marshal
+import hashlib
+import importlib.util
+import minqlbot
+
+CACHE_DIR = os.path.join("python", "__pycache__")
+
+def run(source, filename, namespace):
+    start = time.perf_counter()
+    key = hashlib.sha1(source.encode("utf-8")).hexdigest()
+    cache = minqlbot.__dict__.setdefault("_CODE_CACHE", {})
+    path = os.path.join(CACHE_DIR, "{}.{}.bin".format(filename, key[:16]))
+    code, origin = cache.get((filename, key)), "memory"
+    if code is None:
+        try:
+            with open(path, "rb") as f:
+                if f.read(len(importlib.util.MAGIC_NUMBER)) == importlib.util.MAGIC_NUMBER:
+                    code, origin = marshal.load(f), "disk"
+        except (OSError, EOFError, ValueError, TypeError):
+            code = None
+    if code is None:
+        code, origin = compile(source, filename, "exec"), "compiled"
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            for old in os.listdir(CACHE_DIR):
+                if old.startswith(filename + "."):
+                    os.remove(os.path.join(CACHE_DIR, old))
+            with open(path, "wb") as f:
+                f.write(importlib.util.MAGIC_NUMBER)
+                marshal.dump(code, f)
+        except OSError:
+            pass
+    cache[(filename, key)] = code
+
+    loaded = time.perf_counter()
+    exec(code, namespace)
+    minqlbot.__dict__.setdefault("STARTUP_TIMES", {})[filename] = {
+        "load": loaded - start, "exec": time.perf_counter() - loaded, "origin": origin}
+)PY";
+
 BOOST_PYTHON_MODULE(minqlbot)
 {
   PyEval_InitThreads();
@@ -107,15 +154,20 @@ int Initialize() {
     object minqlbot_module = import("minqlbot");
     main_namespace["minqlbot"] = minqlbot_module;
 
+    dict bootstrap_namespace;
+    bootstrap_namespace["__builtins__"] = import("builtins");
+    exec(BOOTSTRAP, bootstrap_namespace, bootstrap_namespace);
+    object run_script = bootstrap_namespace["run"];
+
     // Let Python know if this is a debug build or not.
 #ifdef _DEBUG
     minqlbot_module.attr("IS_DEBUG") = true;
-    exec(plugin_s.c_str(), main_namespace, main_namespace);
-    exec(minql_s.c_str(), main_namespace, main_namespace);
+    run_script(str(plugin_s.c_str()), "plugin.py", main_namespace);
+    run_script(str(minql_s.c_str()), "minqlbot.py", main_namespace);
 #else
     minqlbot_module.attr("IS_DEBUG") = false;
-    exec(plugin_base, main_namespace, main_namespace);
-    exec(main_script, main_namespace, main_namespace);
+    run_script(str(plugin_base), "plugin.py", main_namespace);
+    run_script(str(main_script), "minqlbot.py", main_namespace);
 #endif
 
     handle_message = main_namespace["handle_message"];
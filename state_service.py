@@ -0,0 +1,283 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Owns the database on behalf of several bots running on the same host.
+
+Bots with their StateService option set to our address send their queries here instead
+of opening the database file, so they all see the same permissions, bans and ratings, and
+only this process touches the file. Whenever a bot commits a change to one of the watched
+tables, every bot is told to drop whatever it has cached from it.
+
+Usage:
+    python state_service.py unix:/tmp/minqlbot_state.sock --database python/minqlbot.db
+
+"""
+
+import os
+import re
+import json
+import base64
+import socket
+import ipaddress
+import sqlite3
+import struct
+import argparse
+import threading
+
+# The same framing as encode_frame() and FrameReader in minqlbot.py, which can't be
+# imported outside of the game.
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 1 << 24
+
+def _encode_bytes(obj):
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return {"$b": base64.b64encode(bytes(obj)).decode()}
+    raise TypeError("{} can't be sent in a frame.".format(type(obj).__name__))
+
+def _decode_bytes(obj):
+    if len(obj) == 1 and "$b" in obj:
+        return base64.b64decode(obj["$b"])
+    return obj
+
+def encode_frame(obj):
+    data = json.dumps(obj, separators=(",", ":"), default=_encode_bytes).encode()
+    return FRAME_HEADER.pack(len(data)) + data
+
+class FrameReader:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        while len(self.buffer) >= FRAME_HEADER.size:
+            size = FRAME_HEADER.unpack_from(self.buffer)[0]
+            if size > MAX_FRAME_SIZE:
+                raise ValueError("Frame of {} bytes is too big.".format(size))
+            end = FRAME_HEADER.size + size
+            if len(self.buffer) < end:
+                break
+            frames.append(json.loads(self.buffer[FRAME_HEADER.size:end].decode(), object_hook=_decode_bytes))
+            del self.buffer[:end]
+        return frames
+
+def parse_address(address):
+    """Like parse_address() in minqlbot.py. Whoever can connect gets to run any SQL on the
+    database, so other TCP hosts than the loopback address are refused."""
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[5:]
+    host, _, port = address.rpartition(":")
+    host = host or "127.0.0.1"
+    if host != "localhost":
+        try:
+            ip = ipaddress.ip_address(host)
+        except ValueError:
+            ip = None
+        if ip is None or ip.version != 4 or not ip.is_loopback:
+            raise ValueError("Only loopback addresses like 127.0.0.1 can be used, not '{}'.".format(host))
+    return socket.AF_INET, (host, int(port))
+
+# The table a statement writes to, if any.
+re_write = re.compile(r'^\s*(?:(?:INSERT|REPLACE)(?:\s+OR\s+\w+)?\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)'
+    r'\s+["`\[]?(?P<table>\w+)', re.IGNORECASE)
+
+class Client:
+    """A connected bot, with a database connection for each of its sessions."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.sessions = {}
+        self.send_lock = threading.Lock()
+
+    def send(self, frames):
+        with self.send_lock:
+            try:
+                self.sock.sendall(b"".join(encode_frame(frame) for frame in frames))
+            except OSError:
+                pass # The reader notices.
+
+class StateService:
+    def __init__(self, database, watch=("Players", "Bans")):
+        self.database = database
+        self.watch = dict((t.lower(), t) for t in watch)
+        self.clients = []
+        self.__lock = threading.Lock()
+        self.__dirty = {} # Session connection -> tables changed in its current transaction.
+
+    def serve(self, address):
+        family, addr = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.remove(addr) # Left behind by an earlier run.
+        server = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(addr)
+        server.listen(16)
+        print("Serving {} on {}.".format(self.database, address), flush=True)
+        try:
+            while True:
+                sock, _ = server.accept()
+                client = Client(sock)
+                with self.__lock:
+                    self.clients.append(client)
+                thread = threading.Thread(target=self.__serve_client, args=(client,), name="state client")
+                thread.daemon = True
+                thread.start()
+        finally:
+            server.close()
+            if family == socket.AF_UNIX:
+                os.remove(addr)
+
+    def push(self, tables):
+        """Tell every bot to drop what it's cached from the tables."""
+        with self.__lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.send([["invalidate", sorted(tables)]])
+
+    def connect(self):
+        # Same settings as the bot's ConnectionPool.
+        conn = sqlite3.connect(self.database, cached_statements=256)
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute("PRAGMA busy_timeout = 5000")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    def __serve_client(self, client):
+        reader = FrameReader()
+        print("A bot connected.", flush=True)
+        try:
+            while True:
+                try:
+                    data = client.sock.recv(65536)
+                    frames = reader.feed(data)
+                except (OSError, ValueError):
+                    return
+                if not data:
+                    return
+
+                # Everything a read gave us is answered in one go.
+                replies = []
+                for frame in frames:
+                    reply = self.__handle(client, frame)
+                    if reply:
+                        replies.append(reply)
+                if replies:
+                    client.send(replies)
+        finally:
+            with self.__lock:
+                self.clients.remove(client)
+            for conn in client.sessions.values():
+                self.__dirty.pop(conn, None)
+                conn.close() # Anything uncommitted is rolled back.
+            client.sock.close()
+            print("A bot disconnected.", flush=True)
+
+    def __handle(self, client, frame):
+        rid = conn = None
+        try:
+            if not isinstance(frame, list) or len(frame) < 2:
+                raise sqlite3.InterfaceError("Malformed frame: {:.100}".format(repr(frame)))
+            if frame[0] == "close":
+                conn = client.sessions.pop(frame[1], None)
+                if conn:
+                    self.__dirty.pop(conn, None)
+                    conn.close()
+                return None
+            elif frame[0] != "req" or len(frame) < 4:
+                raise sqlite3.InterfaceError("Malformed frame: {:.100}".format(repr(frame)))
+
+            rid, session, op, args = frame[1], frame[2], frame[3], frame[4:]
+            conn = client.sessions.get(session)
+            if conn is None:
+                conn = client.sessions[session] = self.connect()
+            return ["ok", rid, self.__execute(conn, op, args)]
+        except Exception as e:
+            return ["err", rid, type(e).__name__, str(e)]
+        finally:
+            if conn is not None and rid is not None:
+                self.__committed(conn)
+
+    def __execute(self, conn, op, args):
+        if op == "exec":
+            changes = conn.total_changes
+            cursor = conn.execute(args[0], args[1])
+            rows = [list(row) for row in cursor.fetchall()]
+            columns = [d[0] for d in cursor.description] if cursor.description else None
+            self.__changed(conn, args[0], changes)
+            return {"rows": rows, "columns": columns, "lastrowid": cursor.lastrowid, "rowcount": cursor.rowcount}
+        elif op == "many":
+            changes = conn.total_changes
+            cursor = conn.executemany(args[0], args[1])
+            self.__changed(conn, args[0], changes)
+            return {"rows": [], "columns": None, "lastrowid": cursor.lastrowid, "rowcount": cursor.rowcount}
+        elif op == "batch":
+            errors = []
+            for query, params in args[0]:
+                changes = conn.total_changes
+                try:
+                    conn.execute(query, params)
+                    errors.append(None)
+                except sqlite3.Error as e:
+                    # A failed statement only rolls back itself, like with the bot's DatabaseWriter.
+                    errors.append([type(e).__name__, str(e)])
+                self.__changed(conn, query, changes)
+            conn.commit()
+            return errors
+        elif op == "commit":
+            conn.commit()
+        elif op == "rollback":
+            conn.rollback()
+            self.__dirty.pop(conn, None)
+        elif op == "isolation":
+            conn.isolation_level = args[0]
+        elif op == "state":
+            return {"in_transaction": conn.in_transaction}
+        else:
+            raise sqlite3.ProgrammingError("Unknown operation '{}'.".format(op))
+
+    def __changed(self, conn, query, changes):
+        """Remember a watched table a statement changed rows of."""
+        if conn.total_changes == changes:
+            return
+        res = re_write.match(query)
+        if res and res.group("table").lower() in self.watch:
+            self.__dirty.setdefault(conn, set()).add(self.watch[res.group("table").lower()])
+
+    def __committed(self, conn):
+        """Push the watched tables a session changed once they're committed."""
+        if conn.in_transaction or conn not in self.__dirty:
+            return
+        self.push(self.__dirty.pop(conn))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("address", help='Where to listen, like "unix:/tmp/minqlbot_state.sock" or "127.0.0.1:27962".')
+    parser.add_argument("--database", default=os.path.join("python", "minqlbot.db"))
+    parser.add_argument("--watch", default="Players,Bans",
+        help="Comma-separated tables whose changes bots are told about, so that they can drop their caches.")
+    args = parser.parse_args()
+
+    service = StateService(args.database, [t.strip() for t in args.watch.split(",") if t.strip()])
+    try:
+        service.serve(args.address)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
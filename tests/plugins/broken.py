@@ -0,0 +1,5 @@
+import minqlbot
+
+# Counts how many times the module ran, for the tests.
+minqlbot.BROKEN_IMPORTS = getattr(minqlbot, "BROKEN_IMPORTS", 0) + 1
+raise RuntimeError("Broken on purpose.")
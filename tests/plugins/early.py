@@ -0,0 +1,10 @@
+import minqlbot
+
+class early(minqlbot.Plugin):
+    """Hooks the map event at the normal priority, for the tests."""
+    def __init__(self):
+        super().__init__()
+        self.add_hook("map", self.handle_map)
+
+    def handle_map(self, map):
+        minqlbot.TEST_CALLS.append(("early", map))
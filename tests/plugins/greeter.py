@@ -0,0 +1,13 @@
+import minqlbot
+
+class greeter(minqlbot.Plugin):
+    """Counts the bot_connect events it gets, and keeps some memory for each, for the tests."""
+    def __init__(self):
+        super().__init__()
+        self.connects = 0
+        self.greetings = []
+        self.add_hook("bot_connect", self.handle_bot_connect)
+
+    def handle_bot_connect(self):
+        self.connects += 1
+        self.greetings.append(bytearray(64 * 1024))
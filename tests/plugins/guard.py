@@ -0,0 +1,14 @@
+import minqlbot
+
+class guard(minqlbot.Plugin):
+    """A plugin with an admin command and one anyone can use, for the tests."""
+    def __init__(self):
+        super().__init__()
+        self.add_command("secret", self.cmd_secret, permission=3)
+        self.add_command("ping", self.cmd_ping)
+
+    def cmd_secret(self, player, msg, channel):
+        minqlbot.TEST_CALLS.append(("secret", player.clean_name))
+
+    def cmd_ping(self, player, msg, channel):
+        minqlbot.TEST_CALLS.append(("ping", player.clean_name))
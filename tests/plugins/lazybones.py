@@ -0,0 +1,19 @@
+import minqlbot
+
+class lazybones(minqlbot.Plugin):
+    """A lazy plugin with a command and a low priority hook, for the tests."""
+    lazy_commands = ("nap",)
+    lazy_events = ("map",)
+
+    def __init__(self):
+        super().__init__()
+        self.add_hook("map", self.handle_map, priority=minqlbot.PRI_LOWEST)
+        self.add_command("nap", self.cmd_nap, usage="<minutes>")
+
+    def handle_map(self, map):
+        minqlbot.TEST_CALLS.append(("lazybones", map))
+
+    def cmd_nap(self, player, msg, channel):
+        if len(msg) < 2:
+            return minqlbot.RET_USAGE
+        minqlbot.TEST_CALLS.append(("nap", msg[1]))
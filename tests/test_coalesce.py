@@ -0,0 +1,56 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fake_minqlbot
+
+class CoalescedHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_minqlbot.FakeQuake()
+        self.ns = self.fake.load()
+        self.context = self.fake.module.COMMAND_QUEUE.context
+
+    def tearDown(self):
+        self.context.plugin = None
+        self.fake.unload()
+
+    def test_flush_restores_context(self):
+        calls = []
+        def handler(value):
+            calls.append((value, self.context.plugin))
+
+        hook = self.ns["CoalescedHandler"]("inner", handler, self.fake.module.COALESCE_BURST, 10000)
+        for i in range(3):
+            hook(i)
+        self.assertEqual(hook.stats(), (3, 0, 2))
+        self.assertTrue(hook.pending)
+
+        # Like a plugin's command flushing another plugin's hook.
+        self.context.plugin = "outer"
+        hook.flush()
+        self.assertEqual(calls, [(2, "inner")])
+        self.assertEqual(self.context.plugin, "outer")
+        self.assertEqual(hook.stats(), (3, 1, 2))
+        self.assertFalse(hook.pending)
+
+if __name__ == "__main__":
+    unittest.main()
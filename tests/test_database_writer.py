@@ -0,0 +1,52 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import sqlite3
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fake_minqlbot
+
+class DatabaseWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_minqlbot.FakeQuake()
+        self.ns = self.fake.load()
+        self.core = self.ns["core_plugin"]
+
+    def tearDown(self):
+        self.fake.unload()
+
+    def test_write_and_flush(self):
+        self.core.db_query("CREATE TABLE Things (name TEXT)")
+        self.core.db_commit()
+        for name in ("one", "two"):
+            self.core.db_write_async("INSERT INTO Things VALUES (?)", name)
+        self.assertTrue(self.core.db_flush(5))
+        self.assertEqual(self.core.db_query("SELECT COUNT(*) FROM Things").fetchone()[0], 2)
+
+    def test_write_after_stop_raises(self):
+        self.core.db_write_async("CREATE TABLE Things (name TEXT)")
+        self.fake.module.DatabaseWriter.stop_writers()
+        with self.assertRaises(sqlite3.ProgrammingError):
+            self.core.db_write_async("INSERT INTO Things VALUES (?)", "late")
+        self.assertEqual(self.fake.module.DatabaseWriter.writers(), {})
+
+if __name__ == "__main__":
+    unittest.main()
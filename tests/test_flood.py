@@ -0,0 +1,74 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import fake_minqlbot
+
+class FloodControlTest(unittest.TestCase):
+    def load(self, **options):
+        self.fake = fake_minqlbot.FakeQuake()
+        self.ns = self.fake.load(plugins="guard", plugins_folder=os.path.join(HERE, "plugins"), **options)
+        self.fake.connect({0: ("bot", "spectator"), 1: ("mino", "red"), 2: ("admin", "blue")})
+        self.fake.module.TEST_CALLS = self.calls = []
+        # Keep the permissions out of the database.
+        self.fake.module.PERMISSION_CACHE.put("mino", 0)
+        self.fake.module.PERMISSION_CACHE.put("admin", 5)
+        self.flood = self.ns["commands"].flood_control
+
+    def tearDown(self):
+        self.fake.unload()
+
+    def chat(self, cid, name, msg):
+        self.fake.server_command('chat "{:02} {}^7\x19: ^2{}"'.format(cid, name, msg))
+
+    def test_defaults_allow_normal_use(self):
+        self.load()
+        for i in range(5):
+            self.chat(1, "mino", "!ping")
+        self.assertEqual(len(self.calls), 5)
+        self.assertEqual(self.flood.throttled, 0)
+
+    def test_denied_commands_are_free(self):
+        self.load(FloodRate="0.001", FloodBurst="2")
+        for i in range(5):
+            self.chat(1, "mino", "!secret")
+        self.assertEqual(self.calls, [])
+        self.assertEqual(self.flood.throttled, 0)
+
+        for i in range(3):
+            self.chat(1, "mino", "!ping")
+        self.assertEqual(self.calls, [("ping", "mino")] * 2)
+        self.assertEqual(self.flood.throttled, 1)
+
+    def test_exempt_players_keep_their_tokens(self):
+        self.load(FloodRate="0.001", FloodBurst="2")
+        for i in range(5):
+            self.chat(2, "admin", "!secret")
+        self.assertEqual(len(self.calls), 5)
+        self.flood.exempt_level = 0
+        for i in range(3):
+            self.chat(2, "admin", "!ping")
+        self.assertEqual(len(self.calls), 7)
+
+if __name__ == "__main__":
+    unittest.main()
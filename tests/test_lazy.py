@@ -0,0 +1,77 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import fake_minqlbot
+
+class LazyPluginTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_minqlbot.FakeQuake()
+        self.ns = self.fake.load(plugins="early,lazybones", plugins_folder=os.path.join(HERE, "plugins"))
+        self.fake.connect({0: ("bot", "spectator"), 1: ("mino", "red")})
+        self.fake.module.TEST_CALLS = self.calls = []
+        # Flood control looks up whether mino's exempt, so keep that out of the database.
+        self.fake.module.PERMISSION_CACHE.put("mino", 0)
+
+    def tearDown(self):
+        self.fake.unload()
+
+    def loaded(self):
+        return self.fake.module.Plugin._Plugin__loaded_plugins
+
+    def chat(self, msg):
+        self.fake.server_command('chat "01 mino^7\x19: ^2{}"'.format(msg))
+
+    def test_event_activates_at_own_priority(self):
+        self.assertIsInstance(self.loaded()["lazybones"], self.ns["LazyPlugin"])
+        self.ns["event_handlers"]["map"].trigger("campgrounds")
+        # The real hook is PRI_LOWEST, so it comes after early's even on activation.
+        self.assertEqual(self.calls, [("early", "campgrounds"), ("lazybones", "campgrounds")])
+        self.assertNotIsInstance(self.loaded()["lazybones"], self.ns["LazyPlugin"])
+        self.ns["event_handlers"]["map"].trigger("bloodrun")
+        self.assertEqual(self.calls[2:], [("early", "bloodrun"), ("lazybones", "bloodrun")])
+
+    def test_command_activates_through_the_usual_path(self):
+        self.chat("!nap")
+        self.assertNotIsInstance(self.loaded()["lazybones"], self.ns["LazyPlugin"])
+        self.chat("!nap 5")
+        self.assertEqual(self.calls, [("nap", "5")])
+        self.fake.module.REPLY_PACKER.flush()
+        self.fake.module.COMMAND_QUEUE.stop()
+        self.fake.advance(10)
+        self.assertTrue(any("Usage: ^6!nap <minutes>" in cmd for t, cmd in self.fake.sent))
+
+    def test_unload_before_activation(self):
+        self.ns["unload_plugin"]("lazybones")
+        self.ns["event_handlers"]["map"].trigger("campgrounds")
+        self.chat("!nap 5")
+        self.assertEqual(self.calls, [("early", "campgrounds")])
+
+    def test_failed_import_runs_once(self):
+        self.ns["import_plugins"](["early", "broken"], 4)
+        with self.assertRaises(RuntimeError):
+            self.ns["load_plugin"]("broken")
+        self.assertEqual(self.fake.module.BROKEN_IMPORTS, 1)
+
+if __name__ == "__main__":
+    unittest.main()
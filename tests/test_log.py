@@ -0,0 +1,63 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fake_minqlbot
+
+class LogPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_minqlbot.FakeQuake()
+        self.ns = self.fake.load()
+
+    def tearDown(self):
+        self.fake.unload()
+
+    def writers(self):
+        return [t for t in threading.enumerate() if t.name == "minqlbot log writer"]
+
+    def test_single_writer_and_line_per_record(self):
+        self.fake.module.LOG.stop()
+        before = len(self.writers())
+        log = self.ns["LogPipeline"]()
+        log.interval = 60
+        barrier = threading.Barrier(8)
+        def run(i):
+            barrier.wait()
+            log.info("line {}", i)
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(self.writers()) - before, 1)
+
+        del self.fake.debug_lines[:]
+        log.stop()
+        self.assertEqual(sorted(self.fake.debug_lines), sorted("line {}".format(i) for i in range(8)))
+
+    def test_no_log_file_by_default(self):
+        self.assertEqual(self.ns["get_config"]()["DEFAULT"]["LogFile"], "")
+
+if __name__ == "__main__":
+    unittest.main()
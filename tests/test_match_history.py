@@ -0,0 +1,63 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import array
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fake_minqlbot
+
+class MatchHistoryTest(unittest.TestCase):
+    def load(self, **options):
+        self.fake = fake_minqlbot.FakeQuake()
+        self.ns = self.fake.load(**options)
+        self.history = self.fake.module.MATCH_HISTORY
+
+    def tearDown(self):
+        self.fake.unload()
+
+    def tables(self):
+        cursor = self.history.db_connect().cursor()
+        return [row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+
+    def test_off_by_default(self):
+        self.load()
+        self.assertFalse(self.history.enabled)
+        self.assertNotIn("MatchHistory", self.ns["event_handlers"]["stats"].plugins)
+        self.assertNotIn("Matches", self.tables())
+
+    def test_record(self):
+        self.load(MatchHistory="on")
+        self.assertIn("MatchHistory", self.ns["event_handlers"]["stats"].plugins)
+        weapons = array.array("i", range(30)).tobytes()
+        for t, score in ((1000, 10), (2000, 20)):
+            self.history.record((t, "campgrounds", "ca", 5, 3),
+                [("mino", "red", score, 5, 2, 1000, 800, weapons), ("cain", "blue", 1, 0, 5, 100, 900, weapons)])
+        self.assertTrue(self.history.db_flush(5))
+
+        res = self.history.history("mino")
+        self.assertEqual(list(res["time"]), [2000, 1000])
+        self.assertEqual(list(res["score"]), [20, 10])
+        self.assertEqual(res["team"], ["red", "red"])
+        self.assertEqual(list(self.history.weapon_column(res, "rl")), [8, 8])
+        self.assertEqual(list(self.history.history("cain")["match"]), list(res["match"]))
+
+if __name__ == "__main__":
+    unittest.main()
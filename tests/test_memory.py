@@ -0,0 +1,51 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import fake_minqlbot
+
+class MemoryTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_minqlbot.FakeQuake()
+        self.ns = self.fake.load(plugins="greeter", plugins_folder=os.path.join(HERE, "plugins"))
+        self.tracker = self.fake.module.MEMORY_TRACKER
+
+    def tearDown(self):
+        self.fake.unload()
+
+    def test_growth_by_line(self):
+        self.assertTrue(self.tracker.start(3600))
+        for i in range(4):
+            self.ns["event_handlers"]["bot_connect"].trigger()
+        sizes = self.tracker.snapshot()
+        self.assertGreaterEqual(sizes["greeter"], 4 * 64 * 1024)
+
+        report = self.tracker.report()
+        self.assertTrue(report[0].startswith("greeter: "), report)
+        self.assertRegex(report[1], r"^    greeter\.py:\d+: \+2\d\d\.\d KiB$")
+        # Only the numbers are kept around, not the snapshots.
+        self.assertIsInstance(self.tracker.latest[2], dict)
+        self.assertTrue(self.tracker.stop())
+
+if __name__ == "__main__":
+    unittest.main()
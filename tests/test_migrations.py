@@ -0,0 +1,75 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fake_minqlbot
+
+class MigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_minqlbot.FakeQuake()
+        self.fake.load()
+
+        class votes(self.fake.module.Plugin):
+            db_migrations = [
+                "CREATE TABLE Votes (name TEXT)",
+                "ALTER TABLE Votes ADD COLUMN time INTEGER"
+                ]
+        self.plugin = votes
+        self.cursor = votes.db_pool().connect().cursor()
+
+    def tearDown(self):
+        self.fake.unload()
+
+    def versions(self, name):
+        return [row[0] for row in
+            self.cursor.execute("SELECT version FROM Migrations WHERE plugin=? ORDER BY version", (name,))]
+
+    def test_row_per_version(self):
+        self.plugin.db_migrate("votes")
+        self.assertEqual(self.versions("votes"), [1, 2])
+
+        self.plugin.db_migrations = self.plugin.db_migrations + ["CREATE INDEX Votes_name ON Votes(name)"]
+        self.plugin.db_migrate("votes")
+        self.assertEqual(self.versions("votes"), [1, 2, 3])
+
+    def test_keyed_by_plugin_name(self):
+        self.plugin.db_migrate("votes")
+        self.cursor.execute("DROP TABLE Votes")
+        # The same class loaded under another name has its own versions.
+        self.plugin.db_migrate("polls")
+        self.assertEqual(self.versions("polls"), [1, 2])
+        self.assertEqual(self.versions("votes"), [1, 2])
+
+    def test_old_layout(self):
+        self.cursor.execute("DROP TABLE IF EXISTS Migrations")
+        self.cursor.execute("CREATE TABLE Migrations (plugin TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+        self.cursor.executemany("INSERT INTO Migrations VALUES (?, ?)", (("votes", 1), ("other", 2)))
+        self.cursor.execute("CREATE TABLE Votes (name TEXT)")
+        self.cursor.connection.commit()
+
+        self.plugin.db_migrate("votes")
+        self.assertEqual(self.versions("votes"), [1, 2])
+        self.assertIn("time", [row[1] for row in self.cursor.execute("PRAGMA table_info(Votes)")])
+        self.assertEqual(self.versions("other"), [1, 2])
+
+if __name__ == "__main__":
+    unittest.main()
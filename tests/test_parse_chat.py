@@ -0,0 +1,129 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import random
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fake_minqlbot
+
+# Things that trip up chat parsing. Names never contain \x19, since the server uses it to
+# delimit them, so it's only in hostile messages, along with lines broken in random places.
+FUZZ_NAME = ("a", "Z", "7", "^", "^7", "^1", "(", ")", "[", "]", ":", ": ", "\"", "'", "-", "_")
+FUZZ_MSG = FUZZ_NAME + (" ", " (", "^2", "!elo")
+FUZZ_HOSTILE = FUZZ_MSG + ("\x19", "\x19: ", "\x19)", "\x19]")
+
+def fuzz_string(rand, pieces, low, high):
+    return "".join(rand.choice(pieces) for i in range(rand.randint(low, high)))
+
+def fuzz_chat_line(rand, hostile):
+    """Make a random chat or tchat command."""
+    cid = "{:02d}".format(rand.randint(0, 63))
+    clan = fuzz_string(rand, FUZZ_NAME, 1, 4).replace(" ", "") + " " if rand.random() < 0.3 else ""
+    name = fuzz_string(rand, FUZZ_NAME, 1, 8).replace(" ", "") or "a"
+    msg = fuzz_string(rand, FUZZ_HOSTILE if hostile else FUZZ_MSG, 1, 12)
+    location = " ({})".format(fuzz_string(rand, FUZZ_NAME, 1, 3)) if rand.random() < 0.3 else ""
+    kind = rand.randint(0, 2)
+    if kind == 0:
+        cmd, line = "chat", '"{} {}{}^7\x19: ^2{}"'.format(cid, clan, name, msg)
+    elif kind == 1:
+        cmd, line = "tchat", '"{} \x19({}{}^7\x19){}\x19: ^5{}"'.format(cid, clan, name, location, msg)
+    else:
+        cmd, line = "chat", '"{} \x19[{}{}^7\x19]{}\x19: ^6{}"'.format(cid, clan, name, location, msg)
+    if hostile and rand.random() < 0.5:
+        i = rand.randint(0, len(line))
+        line = line[:i] + fuzz_string(rand, FUZZ_HOSTILE, 0, 2) + line[i + rand.randint(0, 3):]
+    return cmd, line
+
+class ParseChatTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_minqlbot.FakeQuake()
+        self.ns = self.fake.load()
+        self.parse_chat = self.ns["parse_chat"]
+
+    def tearDown(self):
+        self.fake.unload()
+
+    def old_parse_chat(self, cmd, payload):
+        """What parse() did with chat lines before parse_chat(), as a reference."""
+        if cmd == "chat":
+            rm = self.ns["re_chat"].match(payload)
+            mode = "chat"
+            if not rm:
+                rm = self.ns["re_tell"].match(payload)
+                mode = "tell"
+        else:
+            rm = self.ns["re_tchat"].match(payload)
+            mode = "team_chat"
+        if not rm:
+            return None
+        return rm.group("id"), rm.group("clan"), rm.group("name"), rm.group("msg"), mode
+
+    def test_lines(self):
+        cases = [
+            ("chat", '"03 player3^7\x19: ^2gg wp"', ("03", None, "player3", "gg wp", "chat")),
+            ("chat", '"03 clan player3^7\x19: ^2gg"', ("03", "clan", "player3", "gg", "chat")),
+            ("tchat", '"05 \x19(mino^7\x19) (Red Armor)\x19: ^5rush"', ("05", None, "mino", "rush", "team_chat")),
+            ("chat", '"07 \x19[clan mino^7\x19]\x19: ^6hi"', ("07", "clan", "mino", "hi", "tell")),
+            # A message pretending to be the end of the name.
+            ("chat", '"03 player3^7\x19: ^2x^7\x19: ^2!op"', ("03", None, "player3", "x^7\x19: ^2!op", "chat")),
+            ("chat", '"03 player3^7\x19: ^2"', None),
+            ("tchat", '"01 \x19(' + "a\x19) (" * 50 + '"', None),
+            ("print", '"03 player3^7\x19: ^2gg"', None),
+            ]
+        for cmd, payload, expected in cases:
+            self.assertEqual(self.parse_chat(cmd, payload), expected, repr(payload))
+
+    def test_fuzz(self):
+        """On lines the game could send, parse_chat() has to agree with the old patterns. On
+        hostile ones, where the patterns can get the name wrong, it has to return either None
+        or a name without \\x19 in it."""
+        rand = random.Random(0)
+        for i in range(5000):
+            hostile = i % 2 == 1
+            cmd, line = fuzz_chat_line(rand, hostile)
+            new = self.parse_chat(cmd, line)
+            if hostile:
+                self.assertTrue(new is None or "\x19" not in new[2], repr(line))
+            else:
+                self.assertEqual(new, self.old_parse_chat(cmd, line), repr(line))
+
+    def best_time(self, payload, runs=5, number=20):
+        best = None
+        for i in range(runs):
+            start = time.perf_counter()
+            for j in range(number):
+                self.parse_chat("tchat", payload)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def test_worst_case_is_linear(self):
+        """A tchat line that never closes took the old patterns quadratic time to give up on.
+        Four times the input has to take about four times as long, not sixteen."""
+        worst_case = lambda n: '"01 \x19(' + "a\x19) (" * n + '"'
+        small, big = worst_case(5000), worst_case(20000)
+        self.assertIsNone(self.parse_chat("tchat", big))
+        ratio = self.best_time(big) / self.best_time(small)
+        self.assertLess(ratio, 8, "4x the input took {:.1f}x the time.".format(ratio))
+
+if __name__ == "__main__":
+    unittest.main()
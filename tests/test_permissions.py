@@ -0,0 +1,77 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fake_minqlbot
+
+class WarmPermissionsTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        database = os.path.join(self.tempdir.name, "minqlbot.db")
+        conn = sqlite3.connect(database)
+        conn.execute("CREATE TABLE Players (name TEXT PRIMARY KEY, permission INTEGER DEFAULT 0)")
+        conn.executemany("INSERT INTO Players VALUES (?, ?)", [("mino", 5), ("cain", 1)])
+        conn.commit()
+        conn.close()
+
+        self.fake = fake_minqlbot.FakeQuake()
+        self.ns = self.fake.load(database=database)
+        self.core = self.ns["core_plugin"]
+        self.threads = []
+        warm = self.core.warm_permissions
+        def record(*args, **kwargs):
+            self.threads.append(threading.current_thread())
+            return warm(*args, **kwargs)
+        self.core.warm_permissions = record
+
+    def tearDown(self):
+        self.fake.unload()
+        self.tempdir.cleanup()
+
+    def wait(self, n):
+        deadline = time.time() + 5
+        while len(self.threads) < n and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_warmed_off_the_network_thread_per_gamestate(self):
+        self.fake.connect({0: ("bot", "spectator"), 1: ("mino", "red"), 2: ("cain", "blue")})
+        self.wait(1)
+        cache = self.fake.module.PERMISSION_CACHE
+        self.assertEqual(cache.get("mino"), 5)
+        self.assertEqual(cache.get("cain"), 1)
+        self.assertNotIn(threading.current_thread(), self.threads)
+
+        # A burst of connects is a single query.
+        self.threads.clear()
+        for cid, name in ((3, "one"), (4, "two"), (5, "three")):
+            self.fake.set_configstring(529 + cid, fake_minqlbot.player_configstring(name))
+        self.wait(1)
+        time.sleep(0.3)
+        self.assertEqual(len(self.threads), 1)
+        self.assertIsNone(cache.get("two"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import socket
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fake_minqlbot
+
+class PluginBridgeTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tempdir.name, "host.sock")
+        self.fake = fake_minqlbot.FakeQuake()
+        self.ns = self.fake.load(PluginHost="unix:" + path)
+        self.fake.connect({0: ("bot", "spectator")})
+        self.bridge = self.fake.module.PLUGIN_BRIDGE
+        self.queue = self.fake.module.COMMAND_QUEUE
+        self.host = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.host.connect(path)
+        self.wait(lambda: self.bridge.connected)
+
+    def tearDown(self):
+        self.host.close()
+        self.fake.unload()
+        self.tempdir.cleanup()
+
+    def wait(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_backpressure_and_plugin_names(self):
+        self.bridge.MAX_QUEUED = 5
+        # Hold on to everything queued after this.
+        self.queue.DELAY = 60
+        self.queue.send("print hold")
+        self.wait(lambda: not self.queue.stats()["classes"][self.fake.module.SEND_PRI_DEFAULT]["depth"])
+
+        frames = lambda r: b"".join(self.fake.module.encode_frame(["send", "print {}".format(i), "balance"]) for i in r)
+        self.host.sendall(frames(range(5)))
+        self.assertTrue(self.wait(lambda: self.bridge.received == 5))
+        self.host.sendall(frames(range(5, 12)))
+        time.sleep(0.2)
+        self.assertEqual(self.bridge.received, 5)
+
+        # Cancelling them completes them, which lets the bridge read the rest.
+        self.assertEqual(self.queue.cancel_plugin("plugin host:balance"), 5)
+        self.assertTrue(self.wait(lambda: self.bridge.received == 12))
+        self.assertEqual(self.queue.cancel_plugin("plugin host:balance"), 7)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fake_minqlbot
+
+class DispatchProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_minqlbot.FakeQuake()
+        self.ns = self.fake.load()
+        self.fake.connect({0: ("bot", "spectator")})
+        self.profiler = self.fake.module.PROFILER
+        self.deadlocked = False
+
+    def tearDown(self):
+        if not self.deadlocked: # Or stop() would wait on the stuck thread.
+            self.profiler.stop()
+            self.fake.unload()
+
+    def dispatch(self, msg):
+        """Dispatch on another thread, so that a deadlock fails the test instead of hanging it."""
+        thread = threading.Thread(target=self.fake.server_command, args=(msg,))
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.deadlocked = thread.is_alive()
+        self.assertFalse(thread.is_alive(), "Dispatching deadlocked.")
+
+    def test_nested_targeted_dispatch(self):
+        events = self.ns["event_handlers"]
+        calls = []
+
+        def outer(msg):
+            calls.append("raw")
+            # A targeted handler dispatching into another targeted handler.
+            events["console"].trigger("nested")
+
+        def inner(text):
+            calls.append("console")
+
+        events["raw"].add_hook("nested", outer)
+        events["console"].add_hook("nested", inner)
+        try:
+            self.assertTrue(self.profiler.start(60, target="nested"))
+            self.dispatch("print \"hello\"")
+            self.dispatch("print \"again\"")
+        finally:
+            events["raw"].remove_hook("nested", outer)
+            events["console"].remove_hook("nested", inner)
+
+        self.assertEqual(calls, ["raw", "console"] * 2)
+        self.assertEqual(self.profiler.plugin_times[("nested", "raw")][0], 2)
+        self.assertEqual(self.profiler.plugin_times[("nested", "console")][0], 2)
+        self.assertIn("outer", self.profiler.report())
+
+    def test_nested_untargeted_dispatch(self):
+        def outer(msg):
+            if msg.startswith("print"):
+                self.ns["handle_message"]("cs 5 \"nested\"")
+
+        self.ns["event_handlers"]["raw"].add_hook("nested", outer)
+        try:
+            self.assertTrue(self.profiler.start(60))
+            self.dispatch("print \"hello\"")
+        finally:
+            self.ns["event_handlers"]["raw"].remove_hook("nested", outer)
+        self.assertEqual(self.profiler.plugin_times[("nested", "raw")][0], 2)
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_minqlbot.FakeQuake()
+        self.ns = self.fake.load()
+        self.context = self.fake.module.COMMAND_QUEUE.context
+
+    def tearDown(self):
+        self.fake.unload()
+
+    def test_nested_message_keeps_outer_trace(self):
+        traces = []
+        def outer(msg):
+            if msg.startswith("print"):
+                trace = self.context.trace
+                self.ns["handle_message"]("cs 5 \"nested\"")
+                traces.append((trace, self.context.trace))
+
+        self.ns["event_handlers"]["raw"].add_hook("nested", outer)
+        try:
+            self.fake.server_command("print \"hello\"")
+        finally:
+            self.ns["event_handlers"]["raw"].remove_hook("nested", outer)
+        self.assertIsNotNone(traces[0][0])
+        self.assertIs(traces[0][0], traces[0][1])
+        self.assertIsNone(self.context.trace)
+
+if __name__ == "__main__":
+    unittest.main()
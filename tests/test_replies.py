@@ -0,0 +1,87 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fake_minqlbot
+
+class RepliesTest(unittest.TestCase):
+    def load(self, **options):
+        self.fake = fake_minqlbot.FakeQuake()
+        self.ns = self.fake.load(**options)
+        self.fake.connect({0: ("bot", "spectator")})
+        self.queue = self.fake.module.COMMAND_QUEUE
+
+    def tearDown(self):
+        self.queue.context.plugin = None
+        self.fake.unload()
+
+    def hold(self):
+        """Get the scheduler to hold on to what's queued next until it's stopped."""
+        self.queue.DELAY = 60
+        self.queue.send("print hold")
+        deadline = time.time() + 5
+        pri = self.fake.module.SEND_PRI_DEFAULT
+        while self.queue.stats()["classes"][pri]["depth"] and time.time() < deadline:
+            time.sleep(0.01)
+
+    def sent(self):
+        self.queue.stop()
+        return [cmd for _, cmd in self.fake.sent] + list(self.fake.queue)
+
+    def test_not_packed_by_default(self):
+        self.load()
+        self.hold()
+        self.queue.context.plugin = "greeter"
+        self.ns["chat_channel"].reply("one")
+        self.ns["chat_channel"].reply("two")
+        self.assertEqual(self.sent(), ["print hold", 'say "one"', 'say "two"'])
+
+    def test_reply_then_kick(self):
+        for options in ({}, {"PackReplies": "chat"}):
+            self.load(**options)
+            self.hold()
+            self.queue.context.plugin = "greeter"
+            self.ns["chat_channel"].reply("Bye!")
+            self.queue.send("kick 3")
+            self.queue.context.plugin = None
+            self.assertEqual(self.sent(), ["print hold", 'say "Bye!"', "kick 3"], options)
+            self.tearDown()
+
+        # Another plugin's chat doesn't hold up the kick.
+        self.load()
+        self.hold()
+        self.queue.send('say "chatty"', "other")
+        self.queue.send("kick 3", "greeter")
+        self.assertEqual(self.sent(), ["print hold", "kick 3", 'say "chatty"'])
+
+    def test_packed_length(self):
+        self.load(PackReplies="chat, team_chat")
+        packer = self.fake.module.REPLY_PACKER
+        channel = self.ns["chat_channel"]
+        msgs = ["^1" + "word " * 60, "^3short", "x" * 250, "plain " * 30]
+        for packed in packer.pack(channel, msgs):
+            self.assertLessEqual(len(packed), packer.limit, packed)
+        self.assertEqual(packer.channels, {"chat", "team_chat"})
+
+if __name__ == "__main__":
+    unittest.main()
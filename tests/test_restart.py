@@ -0,0 +1,61 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import fake_minqlbot
+
+class RestartTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_minqlbot.FakeQuake()
+        self.ns = self.fake.load(plugins="greeter", plugins_folder=os.path.join(HERE, "plugins"))
+        self.fake.connect({0: ("bot", "spectator"), 1: ("mino", "red")})
+
+    def tearDown(self):
+        self.fake.unload()
+
+    def plugin(self):
+        return self.fake.module.Plugin._Plugin__loaded_plugins["greeter"]
+
+    def test_bot_connect_after_restart(self):
+        self.assertEqual(self.plugin().connects, 1)
+        ns = self.fake.restart()
+        # The snapshot keeps the configstrings, but the fresh plugin still gets bot_connect.
+        self.assertEqual(self.plugin().connects, 1)
+        self.assertIsNot(ns, self.ns)
+        self.assertTrue(ns["connected"])
+        self.assertEqual(ns["get_player"]("mino").id, 1)
+
+    def test_leak_check_after_restart(self):
+        tracker = self.fake.module.MEMORY_TRACKER
+        tracker.LEAK_CHECK_DELAY = 0.05
+        leaked = self.plugin()
+        self.fake.restart()
+        deadline = time.time() + 5
+        while not tracker.leaks and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(tracker.leaks, ["greeter"])
+        del leaked
+
+if __name__ == "__main__":
+    unittest.main()
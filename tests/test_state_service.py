@@ -0,0 +1,85 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fake_minqlbot
+import state_service
+
+@unittest.skipUnless(hasattr(__import__("socket"), "AF_UNIX"), "Needs Unix sockets.")
+class StateServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="minqlbot_state_")
+        self.database = os.path.join(self.tempdir, "shared.db")
+        self.address = "unix:" + os.path.join(self.tempdir, "state.sock")
+        conn = sqlite3.connect(self.database)
+        conn.execute("CREATE TABLE Players (name TEXT PRIMARY KEY, permission INTEGER DEFAULT 0)")
+        conn.commit()
+        conn.close()
+
+        self.service = state_service.StateService(self.database)
+        thread = threading.Thread(target=self.service.serve, args=(self.address,))
+        thread.daemon = True
+        thread.start()
+        while not os.path.exists(self.address[5:]):
+            time.sleep(0.01)
+
+        self.fake = fake_minqlbot.FakeQuake()
+        self.ns = self.fake.load(StateService=self.address, database=self.database)
+        self.plugin = self.ns["Plugin"]()
+
+    def tearDown(self):
+        self.fake.unload()
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def test_connection_context_manager(self):
+        with self.plugin.db_connect() as conn:
+            conn.execute("INSERT INTO Players VALUES (?, ?)", ("mino", 3))
+        with self.assertRaises(ZeroDivisionError):
+            with self.plugin.db_connect() as conn:
+                conn.execute("INSERT INTO Players VALUES (?, ?)", ("someone", 5))
+                1 / 0
+        names = [r["name"] for r in self.plugin.db_query("SELECT name FROM Players")]
+        self.assertEqual(names, ["mino"])
+        self.assertEqual(self.plugin.get_permission("mino"), 3)
+
+    def test_other_databases_stay_local(self):
+        other = self.ns["ConnectionPool"].get(os.path.join(self.tempdir, "other.db"))
+        self.assertIsInstance(other, self.ns["ConnectionPool"])
+        self.assertIsInstance(self.plugin.db_pool(), self.ns["StatePool"])
+
+    def test_configure_doesnt_wait(self):
+        client = self.ns["StateClient"]()
+        start = time.perf_counter()
+        client.configure("unix:" + os.path.join(self.tempdir, "nobody.sock"), self.database)
+        try:
+            self.assertLess(time.perf_counter() - start, 1)
+            self.assertFalse(client.connected)
+        finally:
+            client.stop()
+
+if __name__ == "__main__":
+    unittest.main()